@@ -2,21 +2,25 @@ import json
 import logging
 import time
 from dotenv import load_dotenv
-from fastapi import APIRouter, HTTPException, Security, requests as request
+from fastapi import APIRouter, Depends, HTTPException, Request, Security
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import os
-from starlette.status import HTTP_403_FORBIDDEN, HTTP_500_INTERNAL_SERVER_ERROR
+from starlette.status import HTTP_403_FORBIDDEN, HTTP_500_INTERNAL_SERVER_ERROR, HTTP_503_SERVICE_UNAVAILABLE, \
+    HTTP_504_GATEWAY_TIMEOUT
 from fastapi.security import APIKeyHeader
 from app.src.model.LLMOutput import LLMOutput
 from app.src.model.LLMInput import LLMInput
-from app.src.services.embedding import Embedding
-from app.src.services.hanadb import HanaDB
-from app.src.services.llmservice import LLMService
-
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger('main')
+from app.src.model.LLMBatchInput import LLMBatchInput
+from app.src.services import instrumentation
+from app.src.services.app_services import AppServices
+from app.src.services.rag_pipeline import PipelineOverloadedError
+from app.src.services.resilience import DeadlineExceededError, UpstreamUnavailableError
 
 load_dotenv()
 
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger('main')
+
 rag_api_route = APIRouter()
 
 AICORE_AUTH_URL=os.environ.get("AICORE_AUTH_URL")
@@ -24,21 +28,13 @@ AICORE_CLIENT_ID=os.environ.get("AICORE_CLIENT_ID")
 AICORE_CLIENT_SECRET=os.environ.get("AICORE_CLIENT_SECRET")
 AICORE_RESOURCE_GROUP=os.environ.get("AICORE_RESOURCE_GROUP")
 AICORE_BASE_URL=os.environ.get("AICORE_BASE_URL")
-HANA_DB_HOST=os.environ.get("HANA_DB_HOST")
-HANA_DB_USER=os.environ.get("HANA_DB_USER")
-HANA_DB_PASSWORD=os.environ.get("HANA_DB_PASSWORD")
-HANA_DB_TABLE_NAME=os.environ.get("HANA_DB_TABLE_NAME")
-
-hana_db: HanaDB = HanaDB(
-    HANA_DB_HOST,
-    HANA_DB_USER,
-    HANA_DB_PASSWORD,
-    HANA_DB_TABLE_NAME  
-)
-embdedding: Embedding = Embedding()
 
 API_PREFIX = "/v2"
 
+## The clients are created and warmed up once by the lifespan hook of the app (see main.py)
+def get_services(request: Request) -> AppServices:
+    return request.app.state.services
+
 ## This routes returns the text to SQL from a given context and a sql query
 @rag_api_route.get(API_PREFIX + "/status")
 def root_api_v2():
@@ -46,29 +42,159 @@ def root_api_v2():
         "msg": "status working!"
     }
 
+## This route reports ready only once the clients are warmed up, for readiness probes
+@rag_api_route.get(API_PREFIX + "/ready")
+def ready_api_v2(services: AppServices = Depends(get_services)):
+    status_code = 200 if services.ready else HTTP_503_SERVICE_UNAVAILABLE
+    return JSONResponse(status_code=status_code, content={"ready": services.ready, "warm_up_time": services.warm_up_time})
+
+## This route exports the latency histograms, token counts, and pool and cache statistics to Prometheus
+@rag_api_route.get("/metrics")
+def metrics():
+    body, content_type = instrumentation.render_metrics()
+    return Response(content=body, media_type=content_type)
+
+## This route returns the utilisation and wait times of the HANA connection pool
+@rag_api_route.get(API_PREFIX + "/status/hana-pool")
+def hana_pool_status(services: AppServices = Depends(get_services)):
+    return services.hana_db.pool_stats()
+
+## This route returns the calls, retries, hedged requests, and circuit breaker state of the embedding model and the LLM
+@rag_api_route.get(API_PREFIX + "/status/upstreams")
+def upstreams_status(services: AppServices = Depends(get_services)):
+    return services.upstream_stats()
+
+## This route returns the metadata and search times of every shard of the document tables
+@rag_api_route.get(API_PREFIX + "/status/shards")
+def shards_status(services: AppServices = Depends(get_services)):
+    return services.hana_db.shard_stats()
+
+## This route returns the requests in flight and the concurrency of every stage of /v2/generate
+@rag_api_route.get(API_PREFIX + "/status/pipeline")
+def pipeline_status(services: AppServices = Depends(get_services)):
+    return services.pipeline.stats()
+
+## This route returns the size and hit rate of the query embedding cache
+@rag_api_route.get(API_PREFIX + "/status/embedding-cache")
+def embedding_cache_status(services: AppServices = Depends(get_services)):
+    embedding_cache = services.embedding.cache
+    if embedding_cache is None:
+        raise HTTPException(status_code=404, detail="The embedding cache is disabled")
+    return embedding_cache.stats()
+
+## This route returns the generation, size, and search times of the in-process vector replica
+@rag_api_route.get(API_PREFIX + "/status/vector-replica")
+def vector_replica_status(services: AppServices = Depends(get_services)):
+    replica = services.hana_db.replica
+    if replica is None:
+        raise HTTPException(status_code=404, detail="The vector replica is disabled")
+    return replica.stats()
+
+## This route brings the vector replica up to date right away, e.g. after indexing documents
+@rag_api_route.post(API_PREFIX + "/vector-replica/refresh")
+def vector_replica_refresh(services: AppServices = Depends(get_services)):
+    replica = services.hana_db.replica
+    if replica is None:
+        raise HTTPException(status_code=404, detail="The vector replica is disabled")
+    return replica.refresh(services.hana_db)
+
+## This route returns the token budget of the context and how many candidates fill it on average
+@rag_api_route.get(API_PREFIX + "/status/context-packer")
+def context_packer_status(services: AppServices = Depends(get_services)):
+    context_packer = services.llm_service.context_packer
+    if context_packer is None:
+        raise HTTPException(status_code=404, detail="The context packer is disabled")
+    return context_packer.stats()
+
+## This route returns the hit rate and the latency saved by the semantic answer cache
+@rag_api_route.get(API_PREFIX + "/status/answer-cache")
+def answer_cache_status(services: AppServices = Depends(get_services)):
+    answer_cache = services.pipeline.answer_cache
+    if answer_cache is None:
+        raise HTTPException(status_code=404, detail="The answer cache is disabled")
+    return answer_cache.stats()
+
+## This route drops the cached answers, e.g. right after re-indexing the documents
+@rag_api_route.delete(API_PREFIX + "/answer-cache")
+def answer_cache_clear(services: AppServices = Depends(get_services)):
+    answer_cache = services.pipeline.answer_cache
+    if answer_cache is None:
+        raise HTTPException(status_code=404, detail="The answer cache is disabled")
+    answer_cache.clear()
+    return answer_cache.stats()
+
+## The stages of the pipeline are awaited, so the event loop keeps serving other requests meanwhile
 @rag_api_route.post(API_PREFIX + "/generate")
-def llm_generate(llm_input: LLMInput) -> LLMOutput:
-    info = {}
-    tic = time.perf_counter()
+async def llm_generate(llm_input: LLMInput, services: AppServices = Depends(get_services)) -> LLMOutput:
     query = llm_input.query
 
-    ## Step 1: Get the question/query embedding
-    query_embedding = embdedding.get_embedding_gen_ai(query)
-    toc = time.perf_counter()
-    info["embedding_time"] = toc - tic
+    ## Embedding, vector search, and LLM generation, each within its own concurrency limit.
+    ## An unhealthy model fails fast with 503, a model missing its deadline with 504.
+    try:
+        llm_response, info = await services.pipeline.generate(query, llm_input.filters)
+    except (PipelineOverloadedError, UpstreamUnavailableError) as e:
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    except DeadlineExceededError as e:
+        raise HTTPException(status_code=HTTP_504_GATEWAY_TIMEOUT, detail=str(e))
 
-    tic = time.perf_counter()
+    instrumentation.log_sampled(logger, "Response: %s, timings: %s", llm_response, info)
+    return LLMOutput(response=llm_response)
 
-    ## Step 2: Getting LLM Service Instance
-    llm_service = LLMService(hana_db)
+def server_sent_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-    ## Step 3: LLM Generation
-    llm_response = llm_service.generate(query, query_embedding)
+## This route streams the answer as server-sent events: "metadata" with the source documents first,
+## then a "token" event for every piece of the answer as the LLM generates it, and "done" with the timings
+@rag_api_route.post(API_PREFIX + "/generate/stream")
+async def llm_generate_stream(llm_input: LLMInput, services: AppServices = Depends(get_services)):
+    ## Overloaded pods answer 503 before the stream starts
+    try:
+        services.pipeline.check_capacity()
+    except PipelineOverloadedError as e:
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
 
-    print(llm_response)
+    async def events():
+        try:
+            async for event, data in services.pipeline.stream(llm_input.query, llm_input.filters):
+                if event == "done":
+                    instrumentation.log_sampled(logger, "Timings: %s", data)
+                yield server_sent_event(event, data)
+        except Exception as e:
+            logger.exception("Failed to stream the answer")
+            yield server_sent_event("error", {"detail": str(e)})
 
-    toc = time.perf_counter()
-    info["llm_response_time"] = toc - tic
-    logging.info(json.dumps(info, indent=4))
-    return LLMOutput(response=llm_response)
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+## This route answers many queries, e.g. for evaluation jobs, streaming one JSON line per query as it is answered.
+## The lines come in the order of completion, with the index of the query they answer.
+@rag_api_route.post(API_PREFIX + "/generate_batch")
+async def llm_generate_batch(llm_batch_input: LLMBatchInput, services: AppServices = Depends(get_services)):
+    queries = llm_batch_input.queries
+    if len(queries) > services.pipeline.batch_max_queries:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {services.pipeline.batch_max_queries} queries can be sent in a batch"
+        )
+    try:
+        services.pipeline.check_capacity()
+    except PipelineOverloadedError as e:
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+
+    async def results():
+        tic = time.perf_counter()
+        failed = 0
+        try:
+            async for result in services.pipeline.generate_batch(queries, llm_batch_input.filters):
+                failed += "error" in result
+                yield json.dumps(result) + "\n"
+        except Exception as e:
+            logger.exception("Failed to answer the batch")
+            yield json.dumps({"error": str(e)}) + "\n"
+            return
+        logging.info(f"Answered a batch of {len(queries)} queries in {time.perf_counter() - tic:.2f}s, {failed} failed")
 
+    return StreamingResponse(results(), media_type="application/x-ndjson")
@@ -0,0 +1,8 @@
+from typing import Optional
+
+from pydantic import BaseModel
+
+class LLMBatchInput(BaseModel):
+    queries: list[str]
+    # Metadata routing the searches of all queries to the matching shards
+    filters: Optional[dict[str, str]] = None
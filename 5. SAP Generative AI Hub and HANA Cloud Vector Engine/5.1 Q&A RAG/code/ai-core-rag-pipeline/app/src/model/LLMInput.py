@@ -1,4 +1,8 @@
+from typing import Optional
+
 from pydantic import BaseModel
 
 class LLMInput(BaseModel):
     query: str
+    # Metadata routing the search to the matching shards, e.g. {"product": "s4hana"}
+    filters: Optional[dict[str, str]] = None
@@ -0,0 +1,142 @@
+# Answers of previous questions, looked up by the similarity of the question embeddings
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticAnswerCache:
+    """
+    Returns the cached answer of a question close enough to a new one.
+
+    The normalised embeddings of the cached questions are kept in one
+    float32 matrix, so a lookup is a single matrix-vector product: the most
+    similar question is a hit if its cosine similarity reaches `threshold`
+    and it is younger than `ttl` seconds. At most `max_entries` answers are
+    kept, the least recently used one being evicted first. All answers are
+    dropped when the index version changes, i.e. when the documents were
+    re-indexed.
+    """
+
+    def __init__(self, threshold=0.95, max_entries=1024, ttl=3600.0) -> None:
+        if not -1.0 <= threshold <= 1.0:
+            raise ValueError(f"The similarity threshold must be between -1 and 1, got {threshold}")
+        if max_entries < 1:
+            raise ValueError(f"The cache must hold at least one entry, got {max_entries}")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.index_version = None
+        # Allocated on the first store, once the dimension of the embeddings is known
+        self._vectors = None
+        self._expires = np.zeros(max_entries)
+        # Slot in the matrix -> question, answer, and latency of computing the answer, LRU first
+        self._entries = OrderedDict()
+        self._free = list(range(max_entries - 1, -1, -1))
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "invalidations": 0,
+            "latency_saved": 0.0
+        }
+
+    @staticmethod
+    def _normalise(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, slot):
+        del self._entries[slot]
+        self._expires[slot] = 0.0
+        self._free.append(slot)
+
+    def lookup(self, query_vector):
+        """
+        Returns the cached answer of the most similar question, or None on a miss.
+        """
+        with self._lock:
+            if not self._entries or len(query_vector) != self._vectors.shape[1]:
+                self._stats["misses"] += 1
+                return None
+            now = time.monotonic()
+            similarities = self._vectors @ self._normalise(query_vector)
+            # Free and expired slots never match
+            similarities[self._expires <= now] = -np.inf
+            slot = int(np.argmax(similarities))
+            if similarities[slot] < self.threshold:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(slot)
+            _, answer, latency = self._entries[slot]
+            self._stats["hits"] += 1
+            self._stats["latency_saved"] += latency
+            return answer
+
+    def store(self, question, query_vector, answer, latency=0.0):
+        """
+        Caches the answer of a question, with the latency a later hit saves.
+        """
+        vector = self._normalise(query_vector)
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != len(vector):
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+                for slot in list(self._entries):
+                    self._remove(slot)
+            now = time.monotonic()
+            for slot in [slot for slot in self._entries if self._expires[slot] <= now]:
+                self._remove(slot)
+            if not self._free:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+            slot = self._free.pop()
+            self._vectors[slot] = vector
+            self._expires[slot] = now + self.ttl
+            self._entries[slot] = (question, answer, latency)
+            self._stats["stores"] += 1
+
+    def clear(self):
+        with self._lock:
+            for slot in list(self._entries):
+                self._remove(slot)
+            self._stats["invalidations"] += 1
+
+    def set_index_version(self, version):
+        """
+        Records the version of the index, clearing the cache if it changed.
+
+        Returns:
+            Whether the cache was cleared.
+        """
+        if version == self.index_version:
+            return False
+        changed = self.index_version is not None
+        self.index_version = version
+        if changed:
+            logger.info("The index changed, clearing the answer cache")
+            self.clear()
+        return changed
+
+    def stats(self):
+        """
+        Returns the size, hit rate, and latency saved by the cache.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["hits"] + stats["misses"]
+            stats.update({
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "ttl": self.ttl,
+                "hit_rate": stats["hits"] / lookups if lookups else 0.0,
+                "index_version": None if self.index_version is None else str(self.index_version)
+            })
+        return stats
@@ -0,0 +1,211 @@
+# Clients shared by all requests for the lifetime of the application
+import logging
+import os
+import time
+
+from app.src.services.answer_cache import SemanticAnswerCache
+from app.src.services.context_packer import ContextPacker
+from app.src.services.embedding import Embedding
+from app.src.services.hanadb import HanaDB, parse_shards
+from app.src.services.llmservice import LLMService
+from app.src.services.query_embedding_cache import QueryEmbeddingCache, RedisEmbeddingBackend
+from app.src.services.rag_pipeline import AsyncRagPipeline
+from app.src.services.resilience import Upstream
+from app.src.services.single_flight import SingleFlight
+from app.src.services.vector_replica import VectorReplica
+
+logger = logging.getLogger(__name__)
+
+WARM_UP_QUERY = "What is SAP HANA Cloud Vector Engine?"
+
+
+def upstream_from_env(name, prefix, deadline):
+    """
+    Creates the `Upstream` of a remote model configured by the environment variables starting with `prefix`.
+    """
+    attempt_timeout = os.environ.get(f"{prefix}_ATTEMPT_TIMEOUT")
+    hedge_percentile = os.environ.get(f"{prefix}_HEDGE_PERCENTILE")
+    return Upstream(
+        name,
+        deadline=float(os.environ.get(f"{prefix}_DEADLINE", deadline)),
+        attempt_timeout=float(attempt_timeout) if attempt_timeout else None,
+        retries=int(os.environ.get(f"{prefix}_RETRIES", 2)),
+        hedge_percentile=float(hedge_percentile) if hedge_percentile else None,
+        failure_threshold=int(os.environ.get(f"{prefix}_CIRCUIT_FAILURE_THRESHOLD", 5)),
+        reset_timeout=float(os.environ.get(f"{prefix}_CIRCUIT_RESET_TIMEOUT", 30))
+    )
+
+
+class AppServices:
+    """
+    Owns the HANA connection pool, the embedding client, and the LLM service.
+
+    They are created once at startup and shared by all requests. `warm_up`
+    acquires the OAuth token, discovers the deployments, opens the pooled
+    HANA connections, and runs one embedding and one vector search, so the
+    first request does not pay for any of it.
+    """
+
+    def __init__(self, hana_db: HanaDB, embedding: Embedding, llm_service: LLMService, pipeline_options=None) -> None:
+        self.hana_db = hana_db
+        self.embedding = embedding
+        self.llm_service = llm_service
+        self.pipeline = AsyncRagPipeline(self, **(pipeline_options or {}))
+        self.ready = False
+        self.warm_up_time = None
+
+    @classmethod
+    def from_env(cls, hana_connect=None, embedding_client=None, async_embedding_client=None,
+                 proxy_client=None, orchestration_service=None):
+        """
+        Creates the services configured by the environment.
+
+        The clients of HANA and of the Generative AI Hub can be replaced,
+        e.g. by the local stand-ins of `benchmark_rag.py`.
+        """
+        shards = parse_shards(os.environ.get("HANA_DB_SHARDS", ""))
+        replica = None
+        if os.environ.get("VECTOR_REPLICA", "false").lower() == "true" and shards and \
+                os.environ.get("HANA_DB_TABLE_NAME") not in [shard.table_name for shard in shards]:
+            logger.warning("The vector replica mirrors HANA_DB_TABLE_NAME, which is not one of HANA_DB_SHARDS: "
+                           "it is disabled")
+        elif os.environ.get("VECTOR_REPLICA", "false").lower() == "true":
+            replica = VectorReplica(
+                os.environ.get("VECTOR_REPLICA_DIR", ".cache/vector-replica"),
+                os.environ.get("HANA_DB_TABLE_NAME"),
+                normalize=os.environ.get("VECTOR_REPLICA_NORMALIZE", "false").lower() == "true"
+            )
+        hana_db = HanaDB(
+            os.environ.get("HANA_DB_HOST"),
+            os.environ.get("HANA_DB_USER"),
+            os.environ.get("HANA_DB_PASSWORD"),
+            os.environ.get("HANA_DB_TABLE_NAME"),
+            POOL_MIN_SIZE=int(os.environ.get("HANA_POOL_MIN_SIZE", 1)),
+            POOL_MAX_SIZE=int(os.environ.get("HANA_POOL_MAX_SIZE", 10)),
+            POOL_IDLE_TIMEOUT=float(os.environ.get("HANA_POOL_IDLE_TIMEOUT", 300)),
+            POOL_ACQUIRE_TIMEOUT=float(os.environ.get("HANA_POOL_ACQUIRE_TIMEOUT", 30)),
+            replica=replica,
+            connect=hana_connect,
+            shards=shards
+        )
+        pipeline_options = {
+            "embedding_concurrency": int(os.environ.get("RAG_EMBEDDING_CONCURRENCY", 32)),
+            # A search takes a pooled connection per shard it fans out to
+            "hana_concurrency": int(os.environ.get("RAG_HANA_CONCURRENCY",
+                                                   max(1, hana_db.pool.max_size // len(hana_db.shards)))),
+            "llm_concurrency": int(os.environ.get("RAG_LLM_CONCURRENCY", 64)),
+            "max_in_flight": int(os.environ.get("RAG_MAX_IN_FLIGHT", 512)),
+            "embedding_batch_size": int(os.environ.get("RAG_BATCH_EMBEDDING_SIZE", 256)),
+            "batch_concurrency": int(os.environ.get("RAG_BATCH_CONCURRENCY", 16)),
+            "batch_max_queries": int(os.environ.get("RAG_BATCH_MAX_QUERIES", 5000))
+        }
+        if os.environ.get("REQUEST_COALESCING", "true").lower() == "true":
+            pipeline_options["coalescer"] = SingleFlight()
+        if os.environ.get("ANSWER_CACHE", "false").lower() == "true":
+            pipeline_options["answer_cache"] = SemanticAnswerCache(
+                threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.95)),
+                max_entries=int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", 1024)),
+                ttl=float(os.environ.get("ANSWER_CACHE_TTL", 3600))
+            )
+            pipeline_options["version_check_interval"] = float(os.environ.get("ANSWER_CACHE_VERSION_CHECK_INTERVAL", 60))
+        embedding_cache = None
+        if os.environ.get("EMBEDDING_CACHE", "true").lower() == "true":
+            ttl = float(os.environ.get("EMBEDDING_CACHE_TTL", 86400))
+            backend = None
+            if os.environ.get("EMBEDDING_CACHE_REDIS_URL"):
+                backend = RedisEmbeddingBackend(os.environ["EMBEDDING_CACHE_REDIS_URL"], ttl=ttl)
+            embedding_cache = QueryEmbeddingCache(
+                max_bytes=int(float(os.environ.get("EMBEDDING_CACHE_MAX_MB", 16)) * 1024 * 1024),
+                ttl=ttl,
+                backend=backend
+            )
+        context_packer = None
+        if os.environ.get("CONTEXT_PACKER", "false").lower() == "true":
+            context_packer = ContextPacker(
+                token_budget=int(os.environ.get("CONTEXT_TOKEN_BUDGET", 1024)),
+                candidates=int(os.environ.get("CONTEXT_CANDIDATES", 20)),
+                diversity_lambda=float(os.environ.get("CONTEXT_DIVERSITY_LAMBDA", 0.7))
+            )
+        embedding = Embedding(embedding_cache, client=embedding_client, async_client=async_embedding_client,
+                              upstream=upstream_from_env("embedding", "EMBEDDING", deadline=30))
+        llm_service = LLMService(hana_db, context_packer, proxy_client=proxy_client, orchestration_service=orchestration_service,
+                                 upstream=upstream_from_env("llm", "LLM", deadline=120))
+        return cls(hana_db, embedding, llm_service, pipeline_options)
+
+    def warm_up(self):
+        """
+        Warms up the clients, and marks the services ready once all steps succeeded.
+        """
+        tic = time.perf_counter()
+        self.llm_service.warm_up()
+        query_embedding = self.embedding.get_embedding_gen_ai(WARM_UP_QUERY)
+        self.hana_db.warm_up(query_embedding)
+        if self.hana_db.replica is not None:
+            # A replica exported by a previous run, or by another worker, is used as it is
+            if not self.hana_db.replica.load():
+                self.hana_db.replica.refresh(self.hana_db)
+        self.warm_up_time = time.perf_counter() - tic
+        self.ready = True
+        logger.info(f"Services warmed up in {self.warm_up_time:.2f}s")
+
+    def warm_up_until_ready(self, retry_delay=5.0, max_retry_delay=60.0, stopped=None):
+        """
+        Retries the warm-up with exponential back-off until it succeeds or `stopped` is set.
+        """
+        delay = retry_delay
+        while not (stopped and stopped.is_set()):
+            try:
+                self.warm_up()
+                return True
+            except Exception as e:
+                logger.warning(f"Warm-up failed, retrying in {delay:.0f}s: {e}")
+                if stopped:
+                    stopped.wait(delay)
+                else:
+                    time.sleep(delay)
+                delay = min(delay * 2, max_retry_delay)
+        return False
+
+    def refresh_replica_periodically(self, interval, stopped):
+        """
+        Refreshes the vector replica every `interval` seconds until `stopped` is set.
+        """
+        while not stopped.wait(interval):
+            try:
+                self.hana_db.replica.refresh(self.hana_db)
+            except Exception as e:
+                logger.warning(f"Failed to refresh the vector replica: {e}")
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "warm_up_time": self.warm_up_time,
+            "hana_pool": self.hana_db.pool_stats(),
+            "shards": self.hana_db.shard_stats(),
+            "vector_replica": self.hana_db.replica.stats() if self.hana_db.replica else None,
+            "pipeline": self.pipeline.stats(),
+            "upstreams": self.upstream_stats(),
+            "embedding_cache": self.embedding.cache.stats() if self.embedding.cache else None,
+            "answer_cache": self.pipeline.answer_cache.stats() if self.pipeline.answer_cache else None,
+            "context_packer": self.llm_service.context_packer.stats() if self.llm_service.context_packer else None
+        }
+
+    def upstream_stats(self):
+        return {
+            upstream.name: upstream.stats()
+            for upstream in (self.embedding.upstream, self.llm_service.upstream) if upstream is not None
+        }
+
+    async def aclose(self):
+        """
+        Closes the HTTP connections of the async clients.
+        """
+        for client in (self.embedding, self.llm_service):
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.warning(f"Failed to close {type(client).__name__}: {e}")
+
+    def close(self):
+        self.ready = False
+        self.hana_db.close()
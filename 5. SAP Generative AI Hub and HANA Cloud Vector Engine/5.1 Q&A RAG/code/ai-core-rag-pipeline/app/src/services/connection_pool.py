@@ -0,0 +1,258 @@
+# Thread-safe, bounded pool of database connections
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeoutError(Exception):
+    """
+    Raised when no connection becomes available within the acquire timeout.
+    """
+
+
+class PoolClosedError(Exception):
+    """
+    Raised when a connection is requested from a closed pool.
+    """
+
+
+class ConnectionPool:
+    """
+    Keeps between `min_size` and `max_size` open connections for reuse.
+
+    Borrowed connections are validated first: a connection which reports
+    being disconnected is replaced, and one which has been idle for more than
+    `validate_after` seconds is pinged. Connections idle for more than
+    `idle_timeout` seconds are closed down to `min_size`. When all
+    `max_size` connections are in use, callers wait up to `acquire_timeout`
+    seconds for one to be released. `on_close` is called with every
+    connection before it is closed, e.g. to drop state kept per connection.
+    """
+
+    def __init__(self,
+                 connect,
+                 min_size=1,
+                 max_size=10,
+                 idle_timeout=300.0,
+                 acquire_timeout=30.0,
+                 validate_after=30.0,
+                 ping_sql="SELECT 1 FROM DUMMY",
+                 on_close=None
+                 ) -> None:
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min {min_size}, max {max_size}")
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.validate_after = validate_after
+        self.ping_sql = ping_sql
+        self.on_close = on_close
+        self._idle = deque()
+        self._size = 0
+        self._in_use = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._stats = {
+            "acquired": 0,
+            "created": 0,
+            "discarded": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0
+        }
+
+    def open(self):
+        """
+        Opens the first `min_size` connections.
+        """
+        while True:
+            with self._condition:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            connection = self._create()
+            with self._condition:
+                self._idle.append((connection, time.monotonic()))
+                self._condition.notify()
+
+    def _create(self):
+        try:
+            connection = self.connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._stats["created"] += 1
+        return connection
+
+    def _is_usable(self, connection, idle_since):
+        try:
+            if not connection.isconnected():
+                return False
+            if time.monotonic() - idle_since > self.validate_after:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute(self.ping_sql)
+                    cursor.fetchall()
+                finally:
+                    cursor.close()
+            return True
+        except Exception as e:
+            logger.warning(f"Discarding broken HANA connection: {e}")
+            return False
+
+    def _discard(self, connection):
+        try:
+            if self.on_close:
+                self.on_close(connection)
+            connection.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._size -= 1
+            self._stats["discarded"] += 1
+            self._condition.notify()
+
+    def acquire(self, timeout=None):
+        """
+        Borrows a validated connection, opening a new one if needed.
+
+        Raises:
+            PoolTimeoutError: if no connection is available within the timeout.
+        """
+        timeout = self.acquire_timeout if timeout is None else timeout
+        tic = time.monotonic()
+        deadline = tic + timeout
+        waited = False
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        raise PoolClosedError("The connection pool is closed")
+                    if self._idle or self._size < self.max_size:
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeoutError(
+                            f"No HANA connection available within {timeout}s ({self.max_size} in use)"
+                        )
+                    waited = True
+                    self._condition.wait(remaining)
+                if self._idle:
+                    # Reuse the most recently used connection, so surplus ones can idle out
+                    connection, idle_since = self._idle.pop()
+                else:
+                    connection, idle_since = None, None
+                    self._size += 1
+                self._in_use += 1
+            if connection is None:
+                try:
+                    connection = self._create()
+                except Exception:
+                    with self._condition:
+                        self._in_use -= 1
+                    raise
+            elif not self._is_usable(connection, idle_since):
+                with self._condition:
+                    self._in_use -= 1
+                self._discard(connection)
+                continue
+            self._record_acquire(time.monotonic() - tic, waited)
+            return connection
+
+    def _record_acquire(self, wait_time, waited):
+        with self._condition:
+            self._stats["acquired"] += 1
+            if waited:
+                self._stats["waits"] += 1
+            self._stats["wait_time_total"] += wait_time
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], wait_time)
+
+    def release(self, connection, broken=False):
+        """
+        Returns a borrowed connection, closing it if it is broken or the pool is closed.
+        """
+        with self._condition:
+            self._in_use -= 1
+            keep = not broken and not self._closed
+            if keep:
+                self._idle.append((connection, time.monotonic()))
+                self._condition.notify()
+        if not keep:
+            self._discard(connection)
+        self.prune()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection for the duration of a with block.
+
+        A connection found disconnected after an error in the block is
+        discarded instead of being returned to the pool.
+        """
+        connection = self.acquire()
+        broken = False
+        try:
+            yield connection
+        except Exception:
+            try:
+                broken = not connection.isconnected()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            self.release(connection, broken)
+
+    def prune(self):
+        """
+        Closes connections idle for longer than `idle_timeout`, keeping `min_size` open.
+        """
+        expired = []
+        now = time.monotonic()
+        with self._condition:
+            # The least recently used connections are at the left
+            while (self._idle and self._size - len(expired) > self.min_size
+                   and now - self._idle[0][1] > self.idle_timeout):
+                expired.append(self._idle.popleft()[0])
+        for connection in expired:
+            self._discard(connection)
+
+    def close(self):
+        """
+        Closes the idle connections, and the borrowed ones as they are released.
+        """
+        with self._condition:
+            self._closed = True
+            idle = [connection for connection, _ in self._idle]
+            self._idle.clear()
+            self._condition.notify_all()
+        for connection in idle:
+            self._discard(connection)
+
+    def stats(self):
+        """
+        Returns the size, utilisation, and wait times of the pool.
+        """
+        with self._condition:
+            stats = dict(self._stats)
+            stats.update({
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "utilisation": self._in_use / self.max_size,
+                "wait_time_avg": stats["wait_time_total"] / stats["acquired"] if stats["acquired"] else 0.0,
+                "closed": self._closed
+            })
+        return stats
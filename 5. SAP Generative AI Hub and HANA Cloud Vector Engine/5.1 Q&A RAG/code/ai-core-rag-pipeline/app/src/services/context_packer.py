@@ -0,0 +1,235 @@
+# Builds the context of a prompt from a wider set of retrieved chunks, within a token budget
+import threading
+
+import numpy as np
+import tiktoken
+
+from app.src.services.hanadb import MAX_K
+from app.src.services.vector_replica import decode_vector
+
+# Shortest overlap, in characters, taken for the overlap of two chunks rather than a coincidence
+MIN_OVERLAP_CHARS = 32
+PASSAGE_SEPARATOR = "\n\n"
+
+
+def _normalise(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def mmr_order(query_vector, vectors, diversity_lambda):
+    """
+    Orders candidates by maximal marginal relevance.
+
+    Every step picks the candidate maximising
+    `diversity_lambda * sim(query, c) - (1 - diversity_lambda) * max sim(c, picked)`,
+    so a lambda of 1 keeps the order of relevance and lower values favour
+    candidates unlike the ones already picked. The similarities are computed
+    once as matrix products; each step is a vectorised update.
+    """
+    vectors = _normalise(np.asarray(vectors, dtype=np.float32))
+    relevance = vectors @ _normalise(np.asarray(query_vector, dtype=np.float32))
+    similarity = vectors @ vectors.T
+    redundancy = np.zeros(len(vectors), dtype=np.float32)
+    picked = np.zeros(len(vectors), dtype=bool)
+    order = []
+    for _ in range(len(vectors)):
+        scores = diversity_lambda * relevance - (1 - diversity_lambda) * redundancy
+        scores[picked] = -np.inf
+        best = int(np.argmax(scores))
+        order.append(best)
+        picked[best] = True
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return order
+
+
+def overlap_length(first, second, min_chars=MIN_OVERLAP_CHARS):
+    """
+    Returns the length of the longest suffix of `first` which is a prefix of `second`, or 0 if shorter than `min_chars`.
+    """
+    probe = second[:min_chars]
+    if len(probe) < min_chars:
+        return 0
+    start = first.find(probe)
+    # The first match leaves the longest suffix
+    while start != -1:
+        if second.startswith(first[start:]):
+            return len(first) - start
+        start = first.find(probe, start + 1)
+    return 0
+
+
+def merge_passages(chunks):
+    """
+    Merges chunks of one page, given in order of their IDs, into passages.
+
+    A chunk contained in a previous one is dropped, and a chunk starting
+    with the end of the previous one, as adjacent chunks of the splitter
+    do, is appended without the repeated text.
+
+    Returns:
+        List of passages, each a list of the merged chunks and the text.
+    """
+    passages = []
+    for chunk in chunks:
+        text = chunk[2]
+        if passages:
+            last_chunks, last_text = passages[-1]
+            if text in last_text:
+                last_chunks.append(chunk)
+                continue
+            overlap = overlap_length(last_text, text)
+            if overlap:
+                passages[-1] = (last_chunks + [chunk], last_text + text[overlap:])
+                continue
+        passages.append(([chunk], text))
+    return passages
+
+
+class ContextPacker:
+    """
+    Selects and merges retrieved chunks into a context of at most `token_budget` tokens.
+
+    The `candidates` nearest chunks are retrieved instead of the top k, and
+    ordered by relevance, or by maximal marginal relevance with their
+    vectors if `diversity_lambda` is below 1. Chunks are then taken in that
+    order as long as the context stays within the budget. Since the chunks
+    of a page overlap, each one is charged only for the tokens it adds:
+    chunks of the same page are merged into passages without the repeated
+    text, and chunks repeating the text of a selected one cost nothing and
+    are dropped. Tokens are counted with the tiktoken `encoding_name` the
+    documents were split with.
+    """
+
+    def __init__(self, token_budget=1024, candidates=20, diversity_lambda=0.7, encoding_name="gpt2") -> None:
+        if token_budget < 1:
+            raise ValueError(f"The token budget must be positive, got {token_budget}")
+        if not 1 <= candidates <= MAX_K:
+            raise ValueError(f"The candidates must be between 1 and {MAX_K}, got {candidates}")
+        if not 0.0 <= diversity_lambda <= 1.0:
+            raise ValueError(f"The diversity lambda must be between 0 and 1, got {diversity_lambda}")
+        self.token_budget = token_budget
+        self.candidates = candidates
+        self.diversity_lambda = diversity_lambda
+        self.encoding = tiktoken.get_encoding(encoding_name)
+        self._lock = threading.Lock()
+        self._stats = {
+            "packs": 0,
+            "candidates": 0,
+            "chunks_packed": 0,
+            "duplicates_dropped": 0,
+            "chunks_merged": 0,
+            "over_budget": 0,
+            "truncated": 0,
+            "candidate_tokens": 0,
+            "packed_tokens": 0
+        }
+
+    @property
+    def with_vectors(self):
+        """
+        Whether the candidates must be retrieved with their vectors.
+        """
+        return self.diversity_lambda < 1.0
+
+    def count_tokens(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def _order(self, query_vector, rows):
+        if not self.with_vectors or len(rows) < 2:
+            return list(range(len(rows)))
+        vectors = np.stack([decode_vector(row[5]) for row in rows])
+        return mmr_order(decode_vector(query_vector), vectors, self.diversity_lambda)
+
+    def pack(self, query_vector, rows):
+        """
+        Packs the context from the retrieved candidates.
+
+        Args:
+            query_vector: the query embedding, used for the diversity.
+            rows: the candidates as (ID, PAGE_NUMBER, TEXT, TITLE, URL) rows, nearest first,
+                with the vector as sixth column if `with_vectors`.
+
+        Returns:
+            The passages as (ID, PAGE_NUMBER, TEXT, TITLE, URL) rows, most relevant first,
+            with the ID of their first chunk and their merged text.
+        """
+        pages = {}
+        # Page -> tokens of its selected passages, passage text -> tokens
+        page_tokens = {}
+        token_counts = {}
+        texts = set()
+        used = 0
+        stats = dict.fromkeys(self._stats, 0)
+        stats["candidates"] = len(rows)
+
+        def tokens_of(passages):
+            for _, text in passages:
+                if text not in token_counts:
+                    token_counts[text] = self.count_tokens(text)
+            return sum(token_counts[text] for _, text in passages)
+
+        order = self._order(query_vector, rows)
+        for i in order:
+            chunk = tuple(rows[i][:5])
+            stats["candidate_tokens"] += tokens_of([(None, chunk[2])])
+            if chunk[2] in texts:
+                stats["duplicates_dropped"] += 1
+                continue
+            page = (chunk[4], chunk[1])
+            chunks = sorted(pages.get(page, []) + [chunk], key=lambda row: row[0])
+            tokens = tokens_of(merge_passages(chunks))
+            cost = tokens - page_tokens.get(page, 0)
+            if used + cost > self.token_budget:
+                stats["over_budget"] += 1
+                continue
+            pages[page] = chunks
+            page_tokens[page] = tokens
+            texts.add(chunk[2])
+            used += cost
+
+        if not pages and rows:
+            # Even the most relevant chunk exceeds the budget: it is cut rather than leaving no context
+            chunk = tuple(rows[order[0]][:5])
+            text = self.encoding.decode(self.encoding.encode(chunk[2], disallowed_special=())[:self.token_budget])
+            pages[(chunk[4], chunk[1])] = [chunk[:2] + (text,) + chunk[3:]]
+            stats["truncated"] += 1
+
+        # Passages keep the rank of their most relevant chunk
+        rank = {rows[i][0]: position for position, i in enumerate(order)}
+        packed = []
+        for chunks in pages.values():
+            for merged, text in merge_passages(chunks):
+                first = merged[0]
+                packed.append((min(rank.get(chunk[0], len(rank)) for chunk in merged),
+                               (first[0], first[1], text, first[3], first[4])))
+                stats["chunks_packed"] += len(merged)
+                stats["chunks_merged"] += len(merged) - 1
+                stats["packed_tokens"] += tokens_of([(None, text)])
+        packed.sort(key=lambda item: item[0])
+        stats["packs"] = 1
+        with self._lock:
+            for key, value in stats.items():
+                self._stats[key] += value
+        return [row for _, row in packed]
+
+    @staticmethod
+    def context_text(documents):
+        return PASSAGE_SEPARATOR.join(document[2] for document in documents)
+
+    def stats(self):
+        """
+        Returns the budget, and how many candidates and tokens were packed on average.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        packs = stats["packs"]
+        stats.update({
+            "token_budget": self.token_budget,
+            "max_candidates": self.candidates,
+            "diversity_lambda": self.diversity_lambda,
+            "avg_candidate_tokens": stats["candidate_tokens"] / packs if packs else 0.0,
+            "avg_packed_tokens": stats["packed_tokens"] / packs if packs else 0.0,
+            "avg_chunks_packed": stats["chunks_packed"] / packs if packs else 0.0
+        })
+        return stats
@@ -1,16 +1,109 @@
 # Get embeddings
+import asyncio
+import logging
+
 from dotenv import load_dotenv
 load_dotenv()
-from gen_ai_hub.proxy.native.openai import embeddings
+from gen_ai_hub.proxy.native.openai import AsyncOpenAI, embeddings
+
+logger = logging.getLogger(__name__)
 
 
 class Embedding:
-    def __init__(self) -> None:
-        pass
+    def __init__(self, cache=None, client=None, async_client=None, upstream=None) -> None:
+        # Optional QueryEmbeddingCache of the embeddings of single queries
+        self.cache = cache
+        # The clients of the Generative AI Hub SDK, unless replaced, e.g. by local stand-ins
+        self.client = client if client is not None else embeddings
+        self._async_client = async_client
+        # Optional Upstream applying deadlines, retries, hedging, and circuit breaking to the calls
+        self.upstream = upstream
+        # Writes to the shared cache backend still running, referenced until they are done
+        self._shared_writes = set()
+
+    def _create(self, model, input):
+        create = lambda: self.client.create(model_name=model, input=input)
+        return create() if self.upstream is None else self.upstream.call_sync(create)
+
+    # Writes to the shared backend in the background, the response does not wait for it
+    def _write_shared(self, function, *args):
+        future = asyncio.get_running_loop().run_in_executor(None, function, *args)
+        self._shared_writes.add(future)
+        future.add_done_callback(self._shared_write_done)
+
+    def _shared_write_done(self, future):
+        self._shared_writes.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning(f"Failed to write the shared embedding cache: {future.exception()}")
+
+    async def _acreate(self, model, input):
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI()
+        create = lambda: self._async_client.embeddings.create(model_name=model, input=input)
+        return await (create() if self.upstream is None else self.upstream.call(create))
 
     def get_embedding_gen_ai(self, input, model="text-embedding-ada-002") -> str:
-        response = embeddings.create(
-        model_name=model,
-        input=input
-        )
-        return response.data[0].embedding
\ No newline at end of file
+        cacheable = self.cache is not None and isinstance(input, str)
+        if cacheable:
+            vector = self.cache.get(model, input)
+            if vector is not None:
+                return vector.tolist()
+        response = self._create(model, input)
+        if cacheable:
+            self.cache.put(model, input, response.data[0].embedding)
+        return response.data[0].embedding
+
+    # Non-blocking variant of get_embedding_gen_ai
+    async def aget_embedding_gen_ai(self, input, model="text-embedding-ada-002") -> str:
+        cacheable = self.cache is not None and isinstance(input, str)
+        if cacheable:
+            vector = self.cache.get(model, input, shared=False)
+            if vector is None and self.cache.backend is not None:
+                vector = await asyncio.to_thread(self.cache.get_shared, model, input)
+            if vector is not None:
+                return vector.tolist()
+        response = await self._acreate(model, input)
+        if cacheable:
+            self.cache.put(model, input, response.data[0].embedding, shared=False)
+            if self.cache.backend is not None:
+                self._write_shared(self.cache.put_shared, model, input, response.data[0].embedding)
+        return response.data[0].embedding
+
+    # Non-blocking embedding of several inputs in one call, skipping the cached and repeated ones
+    async def aget_embeddings_gen_ai(self, inputs, model="text-embedding-ada-002") -> list:
+        vectors = [None] * len(inputs)
+        if self.cache is not None:
+            for i, text in enumerate(inputs):
+                vector = self.cache.get(model, text, shared=False)
+                if vector is not None:
+                    vectors[i] = vector.tolist()
+        missing = {}
+        for i, text in enumerate(inputs):
+            if vectors[i] is None:
+                missing.setdefault(text, []).append(i)
+        if missing and self.cache is not None and self.cache.backend is not None:
+            shared = await asyncio.to_thread(lambda: [self.cache.get_shared(model, text) for text in missing])
+            for text, vector in zip(list(missing), shared):
+                if vector is not None:
+                    for i in missing.pop(text):
+                        vectors[i] = vector.tolist()
+        if missing:
+            texts = list(missing)
+            response = await self._acreate(model, texts)
+            for item in response.data:
+                text = texts[item.index]
+                for i in missing[text]:
+                    vectors[i] = item.embedding
+                if self.cache is not None:
+                    self.cache.put(model, text, item.embedding, shared=False)
+            if self.cache is not None and self.cache.backend is not None:
+                self._write_shared(lambda: [
+                    self.cache.put_shared(model, texts[item.index], item.embedding) for item in response.data
+                ])
+        return vectors
+
+    async def aclose(self):
+        if self.upstream is not None:
+            self.upstream.close()
+        if self._async_client is not None:
+            await self._async_client.close()
@@ -1,20 +1,165 @@
-# Establish a secure connection to an SAP HANA database using hdbcli 
+# Establish a secure connection to an SAP HANA database using hdbcli
+import asyncio
+import contextvars
+import logging
+import struct
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import hdbcli
 from hdbcli import dbapi
 
+from app.src.services import instrumentation
+from app.src.services.connection_pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+# Sort order of the nearest neighbours for every supported similarity function
+VECTOR_SEARCH_METRICS = {
+    "COSINE_SIMILARITY": "DESC",
+    "L2DISTANCE": "ASC"
+}
+MAX_K = 100
+SEARCH_COLUMNS = "ID, PAGE_NUMBER, TEXT, TITLE, URL"
+# Prepared statements kept per pooled connection
+STATEMENT_CACHE_SIZE = 32
+
+def encode_real_vector(vector):
+    """
+    Encodes an embedding in the binary REAL_VECTOR format of SAP HANA:
+    the dimension as a 4-byte little-endian integer followed by the values
+    as little-endian float32.
+    """
+    values = array('f', vector)
+    if struct.pack('=I', 1) != struct.pack('<I', 1):
+        values.byteswap()
+    return struct.pack('<I', len(values)) + values.tobytes()
+
+def vector_search_sql(table_name, metric="COSINE_SIMILARITY", k=4, columns=SEARCH_COLUMNS, with_score=False):
+    """
+    Returns the top-k vector search statement taking the query vector as parameter.
+
+    Only the validated metric and k are part of the statement text, so
+    every search with the same options shares one statement and plan.
+    With `with_score`, the similarity is selected as last column, and the
+    query vector is bound twice.
+    """
+    if metric not in VECTOR_SEARCH_METRICS:
+        raise ValueError(f"Unsupported metric {metric!r}, use one of {', '.join(VECTOR_SEARCH_METRICS)}")
+    if isinstance(k, bool) or not isinstance(k, int) or not 1 <= k <= MAX_K:
+        raise ValueError(f"k must be an integer between 1 and {MAX_K}, got {k!r}")
+    similarity = f"{metric}(VECTOR_STR, TO_REAL_VECTOR(?))"
+    if with_score:
+        columns = f"{columns}, {similarity} AS SCORE"
+    return (f"SELECT TOP {k} {columns} FROM {table_name} "
+            f"ORDER BY {similarity} {VECTOR_SEARCH_METRICS[metric]}")
+
+def vector_search_parameter(query_vector):
+    """
+    Returns the bind parameter of a query vector: binary for a list of
+    floats, the text as is for a vector already formatted as a string.
+    """
+    if isinstance(query_vector, str):
+        return query_vector
+    return encode_real_vector(query_vector)
+
+def merge_top_k(results, metric="COSINE_SIMILARITY", k=4):
+    """
+    Merges the top-k rows of several tables, each with its score as last column, into the global top k without scores.
+    """
+    rows = [row for result in results for row in result]
+    rows.sort(key=lambda row: row[-1], reverse=VECTOR_SEARCH_METRICS[metric] == "DESC")
+    return [tuple(row[:-1]) for row in rows[:k]]
+
+class Shard:
+    """
+    A table of documents, with the metadata routing searches to it.
+
+    A search with metadata filters only goes to the shards whose metadata
+    matches every filter; a shard without a key of the filters may hold
+    any value of it, and is searched too.
+    """
+
+    def __init__(self, table_name, metadata=None) -> None:
+        self.table_name = table_name
+        self.metadata = metadata or {}
+
+    def matches(self, filters):
+        return all(self.metadata.get(key, value) == value for key, value in (filters or {}).items())
+
+    def __repr__(self) -> str:
+        return f"Shard({self.table_name!r}, {self.metadata!r})"
+
+def parse_shards(specification):
+    """
+    Parses the shards of `HANA_DB_SHARDS`: comma-separated table names, each
+    optionally followed by its metadata, e.g. `DOCS_S4HANA:product=s4hana;year=2024,DOCS_BTP:product=btp`.
+    """
+    shards = []
+    for entry in specification.split(","):
+        table_name, _, metadata = entry.strip().partition(":")
+        if not table_name:
+            continue
+        pairs = [pair.split("=", 1) for pair in metadata.split(";") if pair.strip()]
+        if any(len(pair) != 2 for pair in pairs):
+            raise ValueError(f"Invalid metadata of shard {table_name!r}, expected key=value pairs separated by ';'")
+        shards.append(Shard(table_name, {key.strip(): value.strip() for key, value in pairs}))
+    return shards
+
+def _is_connected(connection):
+    try:
+        return connection.isconnected()
+    except Exception:
+        return False
+
 class HanaDB:
     def __init__(self,
                  HANA_DB_HOST,
                  HANA_DB_USER,
                  HANA_DB_PASSWORD,
-                 HANA_DB_TABLE_NAME   
+                 HANA_DB_TABLE_NAME,
+                 POOL_MIN_SIZE=1,
+                 POOL_MAX_SIZE=10,
+                 POOL_IDLE_TIMEOUT=300.0,
+                 POOL_ACQUIRE_TIMEOUT=30.0,
+                 replica=None,
+                 connect=None,
+                 shards=None
                  ) -> None:
         self.HANA_DB_HOST = HANA_DB_HOST
         self.HANA_DB_USER = HANA_DB_USER
         self.HANA_DB_PASSWORD = HANA_DB_PASSWORD
         self.HANA_DB_TABLE_NAME = HANA_DB_TABLE_NAME
+        # Optional function opening a DB-API connection instead of hdbcli, e.g. a local stand-in
+        self._connect = connect
+        # Connections are opened on first use and reused across requests
+        self.pool = ConnectionPool(
+            self.con,
+            min_size=POOL_MIN_SIZE,
+            max_size=POOL_MAX_SIZE,
+            idle_timeout=POOL_IDLE_TIMEOUT,
+            acquire_timeout=POOL_ACQUIRE_TIMEOUT,
+            on_close=self._forget_statements
+        )
+        # Prepared cursors by connection, each connection being used by one thread at a time
+        self._statements = {}
+        self._statements_lock = threading.Lock()
+        # Optional VectorReplica answering the searches of its table it supports without a round trip to HANA
+        self.replica = replica
+        # Tables searched in parallel, the top k of each being merged; by default the single document table
+        self.shards = shards or [Shard(HANA_DB_TABLE_NAME)]
+        self._shard_stats = {shard.table_name: {"searches": 0, "failures": 0, "search_time_total": 0.0}
+                             for shard in self.shards}
+        self._shard_stats_lock = threading.Lock()
+        # hdbcli is blocking: async callers run queries on one thread per pooled connection
+        self.executor = ThreadPoolExecutor(max_workers=POOL_MAX_SIZE, thread_name_prefix="hana")
 
     def con(self):
+        if self._connect is not None:
+            return self._connect()
         cc = dbapi.connect(
             address=self.HANA_DB_HOST,
             port='443',
@@ -23,30 +168,221 @@ class HanaDB:
             encrypt=True
         )
         return cc
-    
-    # Perform a vector search on the table using the specified metric and return the top k results
-    def run_vector_search(self, query_vector: str, metric="COSINE_SIMILARITY", k=4):
+
+    def connection(self):
+        """
+        Borrows a pooled connection for the duration of a with block.
+        """
+        return self.pool.connection()
+
+    def warm_up(self, query_vector):
+        """
+        Opens the minimum number of pooled connections and prepares the vector search on them.
+        """
+        self.pool.open()
+        for shard in self.shards:
+            sql_query = vector_search_sql(shard.table_name)
+            self._execute_prepared(sql_query, (vector_search_parameter(query_vector),))
+
+    def index_version(self):
+        """
+        Returns a value which changes whenever the documents are re-indexed, in any of the shards.
+        """
+        return tuple(self.table_version(shard.table_name) for shard in self.shards)
+
+    def table_version(self, table_name):
+        """
+        Returns a value which changes whenever the documents of a table are re-indexed.
+
+        A full indexing recreates the table, which changes its creation time,
+        and an incremental one updates the manifest table of the indexer.
+        """
+        table_name = table_name.upper()
+        manifest_name = f"{table_name}_MANIFEST"
+        tables = dict(self._execute_prepared(
+            "SELECT TABLE_NAME, CREATE_TIME FROM SYS.TABLES "
+            "WHERE SCHEMA_NAME = CURRENT_SCHEMA AND TABLE_NAME IN (?, ?)",
+            (table_name, manifest_name)
+        ))
+        version = (tables.get(table_name),)
+        if manifest_name in tables:
+            version += tuple(self._execute_prepared(
+                f"SELECT COUNT(*), SUM(CHUNK_COUNT), MAX(INDEXED_AT) FROM {manifest_name}"
+            )[0])
+        return version
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def route(self, filters=None):
+        """
+        Returns the shards a search with these metadata filters goes to.
+        """
+        return [shard for shard in self.shards if shard.matches(filters)]
+
+    def shard_stats(self):
+        """
+        Returns the metadata, searches, failures, and average search time of every shard.
+        """
+        with self._shard_stats_lock:
+            stats = {table_name: dict(values) for table_name, values in self._shard_stats.items()}
+        for shard in self.shards:
+            values = stats[shard.table_name]
+            values["metadata"] = shard.metadata
+            values["search_time_avg"] = values["search_time_total"] / values["searches"] if values["searches"] else 0.0
+        return stats
+
+    def close(self):
+        """
+        Closes the pooled connections.
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.pool.close()
+
+    def _prepared_cursor(self, connection, sql_query):
+        """
+        Returns a cursor of the connection with the statement prepared, from the statement cache.
+        """
+        with self._statements_lock:
+            statements = self._statements.setdefault(id(connection), OrderedDict())
+        cursor = statements.get(sql_query)
+        if cursor is not None:
+            statements.move_to_end(sql_query)
+            return cursor
+        cursor = connection.cursor()
+        cursor.prepare(sql_query)
+        statements[sql_query] = cursor
+        if len(statements) > STATEMENT_CACHE_SIZE:
+            _, evicted = statements.popitem(last=False)
+            evicted.close()
+        return cursor
+
+    def _forget_statements(self, connection):
+        with self._statements_lock:
+            statements = self._statements.pop(id(connection), {})
+        for cursor in statements.values():
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+    def _execute_prepared(self, sql_query, parameters=()):
+        # A query failing on a lost connection is retried once on a fresh one
+        for attempt in range(2):
+            connection = self.pool.acquire()
+            lost = False
+            try:
+                cursor = self._prepared_cursor(connection, sql_query)
+                cursor.executeprepared(parameters)
+                return cursor.fetchall()
+            except dbapi.Error:
+                lost = not _is_connected(connection)
+                if not lost:
+                    # Drop the cursor in case the statement itself became invalid
+                    self._forget_statements(connection)
+                if not lost or attempt == 1:
+                    raise
+            finally:
+                self.pool.release(connection, broken=lost)
+
+    def _search_shard(self, shard, query_vector, metric, k, with_vectors, with_score):
+        """
+        Returns the top k rows of one shard, with their score as last column if `with_score`.
+        """
+        tic = time.perf_counter()
+        failed = True
+        try:
+            if not with_score and self.replica is not None and self.replica.table_name == shard.table_name \
+                    and self.replica.supports(metric):
+                try:
+                    rows = self.replica.search(query_vector, metric, k, with_vectors)
+                    failed = False
+                    return rows
+                except Exception as e:
+                    logger.warning(f"Error during vector search on the replica, querying HANA: {e}")
+
+            columns = f"{SEARCH_COLUMNS}, VECTOR_STR" if with_vectors else SEARCH_COLUMNS
+            sql_query = vector_search_sql(shard.table_name, metric, k, columns, with_score)
+            parameter = vector_search_parameter(query_vector)
+            rows = self._execute_prepared(sql_query, (parameter, parameter) if with_score else (parameter,))[:k]
+            failed = False
+            return rows
+        finally:
+            with self._shard_stats_lock:
+                stats = self._shard_stats[shard.table_name]
+                stats["searches"] += 1
+                stats["failures"] += failed
+                stats["search_time_total"] += time.perf_counter() - tic
+
+    @staticmethod
+    def _merge_shard_results(shards, results, metric, k):
+        # A failing shard only loses its own rows
+        rows = []
+        for shard, result in zip(shards, results):
+            if isinstance(result, BaseException):
+                logger.warning(f"Error during vector search of shard {shard.table_name}: {result}")
+            else:
+                rows.append(result)
+        if not rows:
+            raise results[0]
+        return merge_top_k(rows, metric, k)
+
+    # Perform a vector search on the tables using the specified metric and return the top k results
+    def run_vector_search(self, query_vector: str, metric="COSINE_SIMILARITY", k=4, with_vectors=False, filters=None):
         """
         Performs vector search on indexed documents.
+
+        With `with_vectors`, every row has the vector of the chunk as sixth column.
+        With several shards matching the `filters`, each is searched for its
+        top k one after the other; `arun_vector_search` searches them in parallel.
         """
         try:
-            cursor = self.con().cursor()
             if not query_vector:
                     raise ValueError("Failed to generate query embedding.")
-            
-            sort_order = "DESC" if metric != "L2DISTANCE" else "ASC"
-            sql_query = f"""
-                SELECT TOP {k} ID, PAGE_NUMBER, TEXT
-                FROM {self.HANA_DB_TABLE_NAME}
-                ORDER BY {metric}(VECTOR_STR, TO_REAL_VECTOR('{query_vector}')) {sort_order}
-                """
-            cursor.execute(sql_query)
-            hdf = cursor.fetchall()
-            print("*"*100)
-            print(hdf)
-            print("*"*100)
-            return hdf[:k]
+
+            shards = self.route(filters)
+            if len(shards) == 1:
+                hdf = self._search_shard(shards[0], query_vector, metric, k, with_vectors, with_score=False)
+            elif shards:
+                results = []
+                for shard in shards:
+                    try:
+                        results.append(self._search_shard(shard, query_vector, metric, k, with_vectors, with_score=True))
+                    except Exception as e:
+                        results.append(e)
+                hdf = self._merge_shard_results(shards, results, metric, k)
+            else:
+                logger.warning(f"No shard matches the filters {filters}")
+                hdf = []
+            instrumentation.log_sampled(logger, "Vector search results: %s", hdf)
+            return hdf
+        except Exception as e:
+            logger.warning(f"Error during vector search: {e}")
+            return []
+
+    async def arun_vector_search(self, query_vector: str, metric="COSINE_SIMILARITY", k=4, with_vectors=False, filters=None):
+        """
+        Performs vector search without blocking the event loop.
+
+        The shards matching the `filters` are searched in parallel, each on
+        a pooled connection, and their top k rows merged by score.
+        """
+        loop = asyncio.get_running_loop()
+        shards = self.route(filters)
+        if len(shards) < 2 or not query_vector:
+            # Run in the context of the request, for its sampled logging
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(
+                self.executor, context.run, self.run_vector_search, query_vector, metric, k, with_vectors, filters
+            )
+        results = await asyncio.gather(*(
+            loop.run_in_executor(self.executor, self._search_shard, shard, query_vector, metric, k, with_vectors, True)
+            for shard in shards
+        ), return_exceptions=True)
+        try:
+            hdf = self._merge_shard_results(shards, results, metric, k)
         except Exception as e:
-            print(f"Error during vector search: {e}")
+            logger.warning(f"Error during vector search: {e}")
             return []
-        
+        instrumentation.log_sampled(logger, "Vector search results: %s", hdf)
+        return hdf
@@ -0,0 +1,321 @@
+# Prometheus metrics, trace spans carrying the request ID, and sampled logging of the hot path
+import contextvars
+import json
+import logging
+import random
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+logger = logging.getLogger(__name__)
+
+REQUEST_ID_HEADER = "x-request-id"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+STAGE_DURATION = Histogram(
+    "rag_stage_duration_seconds", "Time spent running a stage of the pipeline",
+    ["stage"], buckets=LATENCY_BUCKETS
+)
+STAGE_WAIT = Histogram(
+    "rag_stage_wait_seconds", "Time spent waiting for the concurrency limit of a stage",
+    ["stage"], buckets=LATENCY_BUCKETS
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "rag_time_to_first_token_seconds", "Time from a streamed request to its first token",
+    buckets=LATENCY_BUCKETS
+)
+LLM_TOKENS = Histogram(
+    "rag_llm_tokens", "Prompt and completion tokens of the LLM calls",
+    ["kind"], buckets=TOKEN_BUCKETS
+)
+REQUEST_DURATION = Histogram(
+    "rag_http_request_duration_seconds", "Time to serve an HTTP request, until the end of its response",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS
+)
+
+
+class _Trace:
+    """
+    The spans of one request.
+    """
+
+    def __init__(self, request_id, sampled) -> None:
+        self.request_id = request_id
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.spans = []
+        self.attributes = {}
+
+
+_trace = contextvars.ContextVar("rag_trace", default=None)
+
+
+def request_id():
+    """
+    Returns the ID of the request being served, or None outside of a request.
+    """
+    trace = _trace.get()
+    return trace.request_id if trace else None
+
+
+def sampled():
+    """
+    Returns whether the request being served was sampled for logging.
+    """
+    trace = _trace.get()
+    return trace is not None and trace.sampled
+
+
+def log_sampled(log, message, *args):
+    """
+    Logs a message of the hot path: at DEBUG level, or at INFO level for the sampled requests.
+
+    The message is only formatted when it is logged, so `args` may be large.
+    """
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(message, *args)
+    elif sampled() and log.isEnabledFor(logging.INFO):
+        log.info(message, *args)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Records a span of the request being served, yielding its attributes to be completed.
+
+    Spans are logged with the trace of sampled requests, and also exported
+    to OpenTelemetry if its API is installed and a tracer provider is set up.
+    """
+    trace = _trace.get()
+    tic = time.perf_counter()
+    otel_span = otel_trace.get_tracer(__name__).start_as_current_span(name) if otel_trace else nullcontext()
+    with otel_span as current:
+        try:
+            yield attributes
+        finally:
+            duration = time.perf_counter() - tic
+            if current is not None:
+                if trace is not None:
+                    current.set_attribute("rag.request_id", trace.request_id)
+                for key, value in attributes.items():
+                    if isinstance(value, (str, bool, int, float)):
+                        current.set_attribute(f"rag.{key}", value)
+            if trace is not None:
+                trace.spans.append({"name": name, "start": tic - trace.started, "duration": duration, **attributes})
+
+
+def observe_stage(stage, wait_time, run_time):
+    """
+    Observes the wait and run times of a stage, the wait time being None for stages without a concurrency limit.
+    """
+    if wait_time is not None:
+        STAGE_WAIT.labels(stage).observe(wait_time)
+    STAGE_DURATION.labels(stage).observe(run_time)
+
+
+def observe_time_to_first_token(seconds):
+    TIME_TO_FIRST_TOKEN.observe(seconds)
+
+
+def record_llm_usage(usage):
+    """
+    Records the token usage of an LLM call, as reported by the orchestration service.
+    """
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    trace = _trace.get()
+    if prompt_tokens is not None:
+        LLM_TOKENS.labels("prompt").observe(prompt_tokens)
+        if trace is not None:
+            trace.attributes["prompt_tokens"] = trace.attributes.get("prompt_tokens", 0) + prompt_tokens
+    if completion_tokens is not None:
+        LLM_TOKENS.labels("completion").observe(completion_tokens)
+        if trace is not None:
+            trace.attributes["completion_tokens"] = trace.attributes.get("completion_tokens", 0) + completion_tokens
+
+
+def render_metrics():
+    """
+    Returns the metrics in the Prometheus text format, and its content type.
+    """
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+class ServicesCollector:
+    """
+    Exports the statistics of the connection pool, the caches, and the pipeline when Prometheus scrapes.
+    """
+
+    def __init__(self, services) -> None:
+        self.services = services
+
+    def describe(self):
+        # Nothing to check at registration, the metrics depend on the enabled features
+        return []
+
+    @staticmethod
+    def _counter(name, documentation, values, label=None):
+        metric = CounterMetricFamily(name, documentation, labels=[label] if label else None)
+        for key, value in values.items():
+            metric.add_metric([key] if label else [], value)
+        return metric
+
+    @staticmethod
+    def _gauge(name, documentation, values, label=None):
+        metric = GaugeMetricFamily(name, documentation, labels=[label] if label else None)
+        for key, value in values.items():
+            metric.add_metric([key] if label else [], value)
+        return metric
+
+    def collect(self):
+        services = self.services
+        yield self._gauge("rag_ready", "Whether the services are warmed up", {"": float(services.ready)})
+
+        pool = services.hana_db.pool_stats()
+        yield self._gauge("rag_hana_pool_connections", "Connections of the HANA pool",
+                          {"in_use": pool["in_use"], "idle": pool["idle"]}, "state")
+        yield self._gauge("rag_hana_pool_max_size", "Connections the HANA pool opens at most", {"": pool["max_size"]})
+        yield self._counter("rag_hana_pool_acquisitions", "Connections acquired from the HANA pool",
+                            {"immediate": pool["acquired"] - pool["waits"], "waited": pool["waits"]}, "result")
+        yield self._counter("rag_hana_pool_timeouts", "Acquisitions of the HANA pool which timed out",
+                            {"": pool["timeouts"]})
+        yield self._counter("rag_hana_pool_wait_seconds", "Time spent waiting for a HANA connection",
+                            {"": pool["wait_time_total"]})
+
+        shards = services.hana_db.shard_stats()
+        yield self._counter("rag_shard_searches", "Vector searches of every shard of the document tables",
+                            {table_name: stats["searches"] for table_name, stats in shards.items()}, "table")
+        yield self._counter("rag_shard_search_failures", "Failed vector searches of every shard",
+                            {table_name: stats["failures"] for table_name, stats in shards.items()}, "table")
+        yield self._counter("rag_shard_search_seconds", "Time spent searching every shard",
+                            {table_name: stats["search_time_total"] for table_name, stats in shards.items()}, "table")
+
+        pipeline = services.pipeline.stats()
+        yield self._gauge("rag_pipeline_in_flight", "Requests in the pipeline", {"": pipeline["in_flight"]})
+        yield self._gauge("rag_pipeline_stage_active", "Requests running a stage",
+                          {stage: value["active"] for stage, value in pipeline["stages"].items()}, "stage")
+        outcomes = {
+            "accepted": pipeline["requests"],
+            "rejected": pipeline["rejected"],
+            "failed": pipeline["failed"]
+        }
+        if pipeline["coalescing"] is not None:
+            outcomes["coalesced"] = pipeline["coalescing"]["coalesced"]
+            yield self._gauge("rag_coalescing_in_flight", "Executions shared by concurrent identical requests",
+                              {"": pipeline["coalescing"]["in_flight"]})
+        yield self._counter("rag_pipeline_requests", "Requests by outcome", outcomes, "outcome")
+
+        upstreams = services.upstream_stats()
+        yield self._counter("rag_upstream_calls", "Calls of the embedding model and the LLM",
+                            {name: stats["calls"] for name, stats in upstreams.items()}, "upstream")
+        yield self._counter("rag_upstream_failures", "Calls which failed, retries included",
+                            {name: stats["failed"] for name, stats in upstreams.items()}, "upstream")
+        yield self._counter("rag_upstream_rejected", "Calls failed fast by an open circuit breaker",
+                            {name: stats["rejected"] for name, stats in upstreams.items()}, "upstream")
+        yield self._counter("rag_upstream_deadlines_exceeded", "Calls which failed with a timeout, deadline or attempts exhausted",
+                            {name: stats["deadlines_exceeded"] for name, stats in upstreams.items()}, "upstream")
+        yield self._counter("rag_upstream_retries", "Attempts sent again after a retryable failure",
+                            {name: stats["retries"] for name, stats in upstreams.items()}, "upstream")
+        yield self._counter("rag_upstream_hedges", "Duplicate attempts sent after the hedging delay",
+                            {name: stats["hedges"] for name, stats in upstreams.items()}, "upstream")
+        yield self._counter("rag_upstream_hedge_wins", "Hedged attempts which answered first",
+                            {name: stats["hedge_wins"] for name, stats in upstreams.items()}, "upstream")
+        yield self._gauge("rag_upstream_circuit_open", "Whether the circuit breaker rejects calls (open or half-open)",
+                          {name: float(stats["circuit"]["state"] != "closed") for name, stats in upstreams.items()},
+                          "upstream")
+
+        embedding_cache = services.embedding.cache
+        if embedding_cache is not None:
+            stats = embedding_cache.stats()
+            yield self._counter("rag_embedding_cache_lookups", "Lookups of the query embedding cache", {
+                "hit": stats["hits"],
+                "shared_hit": stats["shared_hits"],
+                "miss": stats["misses"]
+            }, "result")
+            yield self._gauge("rag_embedding_cache_bytes", "Memory used by the query embedding cache",
+                              {"": stats["bytes"]})
+
+        answer_cache = services.pipeline.answer_cache
+        if answer_cache is not None:
+            stats = answer_cache.stats()
+            yield self._counter("rag_answer_cache_lookups", "Lookups of the semantic answer cache",
+                                {"hit": stats["hits"], "miss": stats["misses"]}, "result")
+            yield self._counter("rag_answer_cache_latency_saved_seconds", "Latency saved by answer cache hits",
+                                {"": stats["latency_saved"]})
+            yield self._gauge("rag_answer_cache_entries", "Answers in the semantic answer cache", {"": stats["size"]})
+
+        replica = services.hana_db.replica
+        if replica is not None:
+            stats = replica.stats()
+            yield self._gauge("rag_vector_replica_rows", "Rows of the vector replica", {"": stats["count"]})
+            yield self._counter("rag_vector_replica_searches", "Searches answered by the vector replica",
+                                {"": stats["searches"]})
+
+        context_packer = services.llm_service.context_packer
+        if context_packer is not None:
+            stats = context_packer.stats()
+            yield self._counter("rag_context_tokens", "Tokens of the retrieved candidates and of the packed contexts",
+                                {"candidates": stats["candidate_tokens"], "packed": stats["packed_tokens"]}, "kind")
+
+
+class RequestContextMiddleware:
+    """
+    ASGI middleware tracing every HTTP request.
+
+    The request ID is taken from the X-Request-ID header, or generated, and
+    returned in the same header. A `sample_rate` fraction of the requests
+    is sampled: their hot path debug logs are written at INFO level, and
+    their trace, with the duration of every span, is logged once they are
+    served. The duration of every request is observed by route, until the
+    end of the response, streamed ones included.
+    """
+
+    def __init__(self, app, sample_rate=0.01) -> None:
+        self.app = app
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        incoming = headers.get(REQUEST_ID_HEADER.encode())
+        trace = _Trace(incoming.decode("latin-1")[:128] if incoming else uuid.uuid4().hex,
+                       random.random() < self.sample_rate)
+        token = _trace.set(trace)
+        status = 500
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + \
+                    [(REQUEST_ID_HEADER.encode(), trace.request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            _trace.reset(token)
+            duration = time.perf_counter() - trace.started
+            route = scope.get("route")
+            REQUEST_DURATION.labels(scope["method"], getattr(route, "path", "unmatched"), str(status)).observe(duration)
+            if trace.sampled or logger.isEnabledFor(logging.DEBUG):
+                logger.log(logging.INFO if trace.sampled else logging.DEBUG, json.dumps({
+                    "request_id": trace.request_id,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status,
+                    "duration": duration,
+                    **trace.attributes,
+                    "spans": trace.spans
+                }, default=str))
@@ -1,9 +1,15 @@
+import asyncio
+from contextlib import AsyncExitStack, aclosing
 from functools import partial
+import logging
 import pathlib
 from dotenv import load_dotenv
 import yaml
 
+from app.src.services import instrumentation
+from app.src.services.context_packer import ContextPacker
 from app.src.services.hanadb import HanaDB
+from app.src.services.resilience import DeadlineExceededError, Upstream
 from ai_api_client_sdk.models.status import Status
 from gen_ai_hub.orchestration.models.config import OrchestrationConfig
 from gen_ai_hub.orchestration.models.llm import LLM
@@ -17,6 +23,8 @@ import os
 
 ORC_API_URL=os.environ.get("ORC_API_URL")
 
+logger = logging.getLogger(__name__)
+
 # Create a prompt template
 prompt_1 = """
 [INST]
@@ -40,31 +48,99 @@ Question:
 """
 
 class LLMService:
-    def __init__(self, hdb: HanaDB) -> None:
-        self.client = get_proxy_client()
-        self.orchestration_service = OrchestrationService(api_url=ORC_API_URL, proxy_client=self.client)
+    def __init__(self, hdb: HanaDB, context_packer: ContextPacker = None, proxy_client=None, orchestration_service=None,
+                 upstream: Upstream = None) -> None:
+        ## The clients of the Generative AI Hub SDK, unless replaced, e.g. by local stand-ins
+        self.client = proxy_client if proxy_client is not None else get_proxy_client()
+        self.orchestration_service = orchestration_service if orchestration_service is not None else \
+            OrchestrationService(api_url=ORC_API_URL, proxy_client=self.client)
         self.hdb = hdb
+        self.context_packer = context_packer
+        ## Optional deadlines, retries, hedging, and circuit breaking of the orchestration calls
+        self.upstream = upstream
+
+    ## Fetching the OAuth token and the deployments before the first request needs them
+    def warm_up(self):
+        self.client.get_ai_core_token()
+        self.client.get_deployments()
+
+    ## Querying Hana vectordb for the candidates of the context: the top k, or as many
+    ## as the context packer chooses from, in the shards matching the metadata filters
+    def search_candidates(self, query_vector: str, k = 4, filters = None):
+        if self.context_packer is None:
+            return self.hdb.run_vector_search(query_vector, 'COSINE_SIMILARITY', k, filters=filters)
+        return self.hdb.run_vector_search(query_vector, 'COSINE_SIMILARITY', self.context_packer.candidates,
+                                          with_vectors=self.context_packer.with_vectors, filters=filters)
+
+    async def asearch_candidates(self, query_vector: str, k = 4, filters = None):
+        if self.context_packer is None:
+            return await self.hdb.arun_vector_search(query_vector, 'COSINE_SIMILARITY', k, filters=filters)
+        return await self.hdb.arun_vector_search(query_vector, 'COSINE_SIMILARITY', self.context_packer.candidates,
+                                                 with_vectors=self.context_packer.with_vectors, filters=filters)
+
+    ## Packing the candidates into the token budget, when there is a context packer
+    def pack_documents(self, query_vector: str, candidates):
+        if self.context_packer is None:
+            return candidates
+        return self.context_packer.pack(query_vector, candidates)
+
+    ## Non-blocking variant of pack_documents, the packing runs on a worker thread
+    async def apack_documents(self, query_vector: str, candidates):
+        if self.context_packer is None:
+            return candidates
+        return await asyncio.to_thread(self.context_packer.pack, query_vector, candidates)
+
+    ## Querying Hana vectordb for the documents of the context
+    def search_documents(self, query_vector: str, k = 4):
+        return self.pack_documents(query_vector, self.search_candidates(query_vector, k))
+
+    async def asearch_documents(self, query_vector: str, k = 4):
+        return await self.apack_documents(query_vector, await self.asearch_candidates(query_vector, k))
+
+    def context_text(self, documents) -> str:
+        if self.context_packer is None:
+            return ' '.join([doc[2] for doc in documents])
+        return self.context_packer.context_text(documents)
 
     ## Querying Hana vectordb and building the context
     def get_context(self, query_vector: str, metric='COSINE_SIMILARITY', k = 4) -> str:
-        context = self.hdb.run_vector_search(query_vector, 'COSINE_SIMILARITY', k)
-        context_text = ' '.join([doc[2] for doc in context])
-        return context_text
+        return self.context_text(self.search_documents(query_vector, k))
 
-    ## Sending request to aicore LLM
-    def send_request(self, prompt, _print=True, _model='ibm--granite-13b-chat', **kwargs):
+    ## Non-blocking variant of get_context
+    async def aget_context(self, query_vector: str, metric='COSINE_SIMILARITY', k = 4) -> str:
+        return self.context_text(await self.asearch_documents(query_vector, k))
+
+    def _orchestration_request(self, prompt, _model, **kwargs):
         config = OrchestrationConfig(
             llm=LLM(name=_model),
             template=Template(messages=[UserMessage(prompt)])
         )
         template_values = [TemplateValue(name=key, value=value) for key, value in kwargs.items()]
-        answer = self.orchestration_service.run(config=config, template_values=template_values)
+        return config, template_values
+
+    def _result(self, answer, prompt, _print):
         result = answer.module_results.llm.choices[0].message.content
+        instrumentation.record_llm_usage(getattr(answer.orchestration_result, "usage", None))
         if _print:
-            formatted_prompt = answer.module_results.templating[0].content
-            print(f"<-- PROMPT --->\n{formatted_prompt if _print else prompt}\n<--- RESPONSE --->\n{result}")   
+            ## Prompts are large: only logged at DEBUG level, or for the sampled requests
+            instrumentation.log_sampled(logger, "<-- PROMPT --->\n%s\n<--- RESPONSE --->\n%s",
+                                        answer.module_results.templating[0].content, result)
         return result
 
+    ## Sending request to aicore LLM
+    def send_request(self, prompt, _print=True, _model='ibm--granite-13b-chat', **kwargs):
+        config, template_values = self._orchestration_request(prompt, _model, **kwargs)
+        run = lambda: self.orchestration_service.run(config=config, template_values=template_values)
+        answer = run() if self.upstream is None else self.upstream.call_sync(run)
+        return self._result(answer, prompt, _print)
+
+    ## Sending request to aicore LLM without blocking the event loop
+    async def asend_request(self, prompt, _print=True, _model='ibm--granite-13b-chat', **kwargs):
+        config, template_values = self._orchestration_request(prompt, _model, **kwargs)
+        arun = lambda: self.orchestration_service.arun(config=config, template_values=template_values)
+        answer = await (arun() if self.upstream is None else self.upstream.call(arun))
+        return self._result(answer, prompt, _print)
+
     def generate(self, question: str, query_vector: str):
         # Getting the context by querying hana vector db
         prompt_context = self.get_context(query_vector, k=1)
@@ -72,3 +148,55 @@ class LLMService:
         f_1 = partial(self.send_request, prompt=prompt_1)
         response = f_1(context=prompt_context, query=question)
         return response
+
+    ## Streaming the response of aicore LLM, yielding the text as it is generated
+    async def astream_request(self, prompt, _model='ibm--granite-13b-chat', **kwargs):
+        config, template_values = self._orchestration_request(prompt, _model, **kwargs)
+        ## The whole stream must end within the deadline of the upstream, if any
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.upstream.deadline if self.upstream is not None else None
+        usage = None
+        ## The stream client closes the HTTP stream on exit, also when the client goes away before its end
+        async with AsyncExitStack() as stack:
+            ## The request is sent when the stream is entered: opening it is retried,
+            ## the text already yielded cannot be taken back
+            async def open_stream():
+                stream = await self.orchestration_service.astream(config=config, template_values=template_values)
+                await stack.enter_async_context(stream)
+                return stream
+            chunks = await (open_stream() if self.upstream is None else self.upstream.call(open_stream, hedge=False))
+            while True:
+                ## Only the waits for the LLM are timed, not the consumer between the chunks
+                try:
+                    async with asyncio.timeout_at(deadline):
+                        chunk = await anext(chunks, None)
+                except TimeoutError as e:
+                    self.upstream.breaker.record_failure()
+                    raise DeadlineExceededError(f"The {self.upstream.name} stream did not end within its deadline "
+                                                f"of {self.upstream.deadline:.1f}s") from e
+                if chunk is None:
+                    break
+                for choice in chunk.orchestration_result.choices:
+                    if choice.delta.content:
+                        yield choice.delta.content
+                # The usage comes with the last chunk
+                usage = getattr(chunk.orchestration_result, "usage", None) or usage
+        instrumentation.record_llm_usage(usage)
+
+    async def astream(self, question: str, prompt_context: str):
+        ## Closed right away when the caller stops early, which closes the HTTP stream
+        async with aclosing(self.astream_request(prompt=prompt_1, context=prompt_context, query=question)) as texts:
+            async for text in texts:
+                yield text
+
+    async def agenerate(self, question: str, query_vector: str, prompt_context: str = None):
+        # Getting the context by querying hana vector db, unless the caller already did
+        if prompt_context is None:
+            prompt_context = await self.aget_context(query_vector, k=1)
+        # Sending the request to LLM
+        return await self.asend_request(prompt=prompt_1, context=prompt_context, query=question)
+
+    async def aclose(self):
+        if self.upstream is not None:
+            self.upstream.close()
+        await self.orchestration_service.aclose_http_connection()
@@ -0,0 +1,198 @@
+# Embeddings of recent queries, so repeated queries skip the embedding model
+import hashlib
+import logging
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Approximate bookkeeping cost of an entry besides its vector and key
+ENTRY_OVERHEAD = 200
+
+
+def normalise_query(text):
+    """
+    Normalises a query so that it only differs from a repeat by its meaning:
+    Unicode compatibility forms are folded, and case and whitespace are ignored.
+    """
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def cache_key(model, text):
+    return hashlib.sha256(f"{model}\0{normalise_query(text)}".encode()).hexdigest()
+
+
+class RedisEmbeddingBackend:
+    """
+    Shares the cached embeddings between replicas through Redis.
+
+    Vectors are stored as float32 bytes under `prefix` + key and expire
+    after `ttl` seconds. Requires the `redis` package.
+    """
+
+    def __init__(self, url, ttl=86400.0, prefix="rag:query-embedding:", timeout=0.2) -> None:
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("The shared embedding cache requires the redis package: pip install redis")
+        self.client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=max(1, int(self.ttl)))
+
+
+class QueryEmbeddingCache:
+    """
+    In-process LRU cache of query embeddings, with an optional shared backend.
+
+    Embeddings are keyed on the model and the normalised query text, and
+    stored as float32 arrays. Entries expire after `ttl` seconds, and the
+    least recently used ones are evicted once the cache takes more than
+    `max_bytes`. A `backend` with `get(key)` and `set(key, bytes)` methods,
+    such as `RedisEmbeddingBackend`, is consulted on a local miss and
+    updated on a store, so replicas share their hits. Errors of the backend
+    are logged and count as misses.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=86400.0, backend=None) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.backend = backend
+        # Key -> float32 vector and expiry time, least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "shared_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "backend_errors": 0
+        }
+
+    @staticmethod
+    def _entry_size(key, vector):
+        return vector.nbytes + len(key) + ENTRY_OVERHEAD
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            vector, expires = entry
+            if expires <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return vector
+
+    def _put_local(self, key, vector):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (vector, time.monotonic() + self.ttl)
+            self._size += self._entry_size(key, vector)
+            while self._size > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def _remove(self, key):
+        vector, _ = self._entries.pop(key)
+        self._size -= self._entry_size(key, vector)
+
+    def get(self, model, text, shared=True):
+        """
+        Returns the cached embedding of a query as a float32 array, or None on a miss.
+
+        With `shared` set to False only the in-process cache is consulted,
+        e.g. to look up the backend off the event loop with `get_shared`.
+        """
+        key = cache_key(model, text)
+        vector = self._get_local(key)
+        if vector is None and (shared or self.backend is None):
+            return self._get_shared(key)
+        return vector
+
+    def get_shared(self, model, text):
+        """
+        Returns the embedding of a query from the shared backend, or None on a miss.
+        """
+        return self._get_shared(cache_key(model, text))
+
+    def _get_shared(self, key):
+        data = None
+        if self.backend is not None:
+            try:
+                data = self.backend.get(key)
+            except Exception as e:
+                logger.warning(f"Failed to read the shared embedding cache: {e}")
+                with self._lock:
+                    self._stats["backend_errors"] += 1
+        if data is None:
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+        vector = np.frombuffer(data, dtype="<f4").astype(np.float32)
+        self._put_local(key, vector)
+        with self._lock:
+            self._stats["shared_hits"] += 1
+        return vector
+
+    def put(self, model, text, vector, shared=True):
+        """
+        Caches the embedding of a query, and returns it as a float32 array.
+        """
+        key = cache_key(model, text)
+        vector = np.asarray(vector, dtype=np.float32)
+        self._put_local(key, vector)
+        if shared:
+            self._put_shared(key, vector)
+        return vector
+
+    def put_shared(self, model, text, vector):
+        """
+        Stores the embedding of a query in the shared backend only.
+        """
+        self._put_shared(cache_key(model, text), np.asarray(vector, dtype=np.float32))
+
+    def _put_shared(self, key, vector):
+        if self.backend is None:
+            return
+        try:
+            self.backend.set(key, vector.astype("<f4").tobytes())
+        except Exception as e:
+            logger.warning(f"Failed to write the shared embedding cache: {e}")
+            with self._lock:
+                self._stats["backend_errors"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """
+        Returns the size and hit rate of the cache.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["hits"] + stats["shared_hits"] + stats["misses"]
+            stats.update({
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "shared": self.backend is not None,
+                "hit_rate": (stats["hits"] + stats["shared_hits"]) / lookups if lookups else 0.0
+            })
+        return stats
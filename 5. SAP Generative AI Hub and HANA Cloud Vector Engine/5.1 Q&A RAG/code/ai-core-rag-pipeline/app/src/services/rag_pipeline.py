@@ -0,0 +1,382 @@
+# Non-blocking embedding -> vector search -> generation pipeline
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager, nullcontext
+
+from app.src.services import instrumentation
+from app.src.services.query_embedding_cache import normalise_query
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineOverloadedError(Exception):
+    """
+    Raised when a request arrives while `max_in_flight` requests are already in the pipeline.
+    """
+
+
+def source_document(row):
+    """
+    Returns a row of the vector search as a source document of an answer.
+    """
+    _, page_number, text, title, url = row
+    return {
+        "page_content": text,
+        "metadata": {
+            "title": title,
+            "document_url": url,
+            "page_number": page_number
+        }
+    }
+
+
+class AsyncRagPipeline:
+    """
+    Answers queries without blocking the event loop.
+
+    The embedding and the generation are awaited on the async clients of the
+    Generative AI Hub SDK, and the vector search runs on the executor of
+    `HanaDB`. Every stage has its own concurrency limit, so a slow stage
+    queues its own requests instead of starving the others: the HANA limit
+    should not exceed the size of the connection pool, while the remote
+    model calls can be much more concurrent. Requests beyond `max_in_flight`
+    are rejected instead of queueing without bound.
+
+    With an `answer_cache`, a question similar enough to a cached one is
+    answered right after its embedding, skipping the vector search and the
+    generation. The index version is checked at most every
+    `version_check_interval` seconds to drop answers of re-indexed documents.
+
+    `stream` yields the answer as it is generated, which makes the time to
+    the first token the latency users notice.
+
+    `generate_batch` answers many queries at once: they are embedded
+    `embedding_batch_size` at a time, and at most `batch_concurrency` of
+    them are searched and generated at a time, within the stage limits.
+
+    Queries may carry metadata filters, which route their vector search to
+    the matching shards of `HanaDB`. Filtered queries bypass the answer
+    cache, whose answers may come from other shards.
+
+    With a `coalescer`, concurrent `generate` calls for the same normalised
+    query and filters share one execution of the pipeline, so a question asked by many
+    users at once is embedded, searched, and generated once. Coalesced
+    requests are not counted against `max_in_flight`.
+
+    Every stage, and the prompt build between the vector search and the
+    LLM call, is a trace span of the request and observed by the latency
+    histograms of `instrumentation`.
+    """
+
+    STAGES = ("embedding", "vector_search", "llm")
+
+    def __init__(self,
+                 services,
+                 embedding_concurrency=32,
+                 hana_concurrency=10,
+                 llm_concurrency=64,
+                 max_in_flight=512,
+                 k=1,
+                 answer_cache=None,
+                 version_check_interval=60.0,
+                 embedding_batch_size=256,
+                 batch_concurrency=16,
+                 batch_max_queries=5000,
+                 coalescer=None
+                 ) -> None:
+        self.services = services
+        self.limits = {
+            "embedding": embedding_concurrency,
+            "vector_search": hana_concurrency,
+            "llm": llm_concurrency
+        }
+        self.max_in_flight = max_in_flight
+        self.k = k
+        self.answer_cache = answer_cache
+        self.version_check_interval = version_check_interval
+        self._version_checked_at = None
+        self.embedding_batch_size = embedding_batch_size
+        self.batch_concurrency = batch_concurrency
+        self.batch_max_queries = batch_max_queries
+        self.coalescer = coalescer
+        # Semaphores are created lazily, to bind them to the loop serving the requests
+        self._semaphores = None
+        self._in_flight = 0
+        self._stats = {
+            "requests": 0,
+            "rejected": 0,
+            "failed": 0,
+            "streams": 0,
+            "batches": 0,
+            "batch_queries": 0,
+            "first_tokens": 0,
+            "time_to_first_token_total": 0.0,
+            "time_to_first_token_max": 0.0
+        }
+        self._active = dict.fromkeys(self.STAGES, 0)
+        self._wait_time_max = dict.fromkeys(self.STAGES, 0.0)
+
+    def _semaphore(self, stage):
+        if self._semaphores is None:
+            self._semaphores = {name: asyncio.Semaphore(limit) for name, limit in self.limits.items()}
+        return self._semaphores[stage]
+
+    @asynccontextmanager
+    async def _stage(self, stage, info):
+        """
+        Runs a block within the concurrency limit of a stage, if it has one, recording the wait and run times.
+        """
+        limited = stage in self.limits
+        tic = time.perf_counter()
+        async with self._semaphore(stage) if limited else nullcontext():
+            toc = time.perf_counter()
+            if limited:
+                info[f"{stage}_wait_time"] = toc - tic
+                self._wait_time_max[stage] = max(self._wait_time_max[stage], toc - tic)
+                self._active[stage] += 1
+            try:
+                with instrumentation.span(stage, **({"wait_time": toc - tic} if limited else {})):
+                    yield
+            finally:
+                if limited:
+                    self._active[stage] -= 1
+                info[f"{stage}_time"] = time.perf_counter() - toc
+                instrumentation.observe_stage(stage, toc - tic if limited else None, info[f"{stage}_time"])
+
+    async def _check_index_version(self):
+        now = time.monotonic()
+        if self._version_checked_at is not None and now - self._version_checked_at < self.version_check_interval:
+            return
+        # Set first, so concurrent requests do not check too
+        self._version_checked_at = now
+        hana_db = self.services.hana_db
+        try:
+            version = await asyncio.get_running_loop().run_in_executor(hana_db.executor, hana_db.index_version)
+        except Exception as e:
+            logger.warning(f"Failed to check the index version: {e}")
+            return
+        self.answer_cache.set_index_version(version)
+
+    def check_capacity(self):
+        """
+        Raises PipelineOverloadedError if a new request would be rejected.
+        """
+        if self._in_flight >= self.max_in_flight:
+            self._stats["rejected"] += 1
+            raise PipelineOverloadedError(f"{self._in_flight} requests in flight, try again later")
+
+    @asynccontextmanager
+    async def _request(self):
+        self.check_capacity()
+        self._in_flight += 1
+        self._stats["requests"] += 1
+        try:
+            yield
+        except Exception:
+            self._stats["failed"] += 1
+            raise
+        finally:
+            self._in_flight -= 1
+
+    async def _cached_answer(self, query_embedding, info, filters=None):
+        if self.answer_cache is None or filters:
+            return None
+        await self._check_index_version()
+        response = self.answer_cache.lookup(query_embedding)
+        info["answer_cache_hit"] = response is not None
+        return response
+
+    async def generate(self, query, filters=None):
+        """
+        Answers a query, from the documents of the shards matching the metadata `filters`.
+
+        Returns:
+            Tuple of the response and the timings of the stages.
+
+        Raises:
+            PipelineOverloadedError: if too many requests are in flight.
+        """
+        if self.coalescer is None:
+            return await self._generate(query, filters)
+        tic = time.perf_counter()
+        # The parameters of the retrieval are part of the key, so only requests with the same answer are coalesced
+        key = (normalise_query(query), self.k, tuple(sorted((filters or {}).items())))
+        with instrumentation.span("single_flight") as attributes:
+            (response, info), shared = await self.coalescer.do(key, lambda: self._generate(query, filters))
+            attributes["coalesced"] = shared
+        if shared:
+            # The timings are those of the shared execution, but the total is the time this request waited
+            info = dict(info, coalesced=True, total_time=time.perf_counter() - tic)
+        return response, info
+
+    async def _generate(self, query, filters=None):
+        info = {}
+        tic = time.perf_counter()
+        async with self._request():
+            async with self._stage("embedding", info):
+                query_embedding = await self.services.embedding.aget_embedding_gen_ai(query)
+            response = await self._answer(query, query_embedding, info, filters)
+        info["total_time"] = time.perf_counter() - tic
+        return response, info
+
+    async def _answer(self, query, query_embedding, info, filters=None):
+        response = await self._cached_answer(query_embedding, info, filters)
+        if response is not None:
+            return response
+        tic = time.perf_counter()
+        _, context = await self._retrieve(query_embedding, info, filters)
+        async with self._stage("llm", info):
+            response = await self.services.llm_service.agenerate(query, query_embedding, context)
+        # An answer without context, e.g. after a failed search, is not worth reusing
+        if self.answer_cache is not None and context and not filters:
+            self.answer_cache.store(query, query_embedding, response, time.perf_counter() - tic)
+        return response
+
+    async def _retrieve(self, query_embedding, info, filters=None):
+        """
+        Searches the documents of a query in the shards matching the filters, and builds its context.
+
+        Returns:
+            Tuple of the source documents and the context text.
+        """
+        llm_service = self.services.llm_service
+        async with self._stage("vector_search", info):
+            candidates = await llm_service.asearch_candidates(query_embedding, self.k, filters)
+        async with self._stage("prompt_build", info):
+            documents = await llm_service.apack_documents(query_embedding, candidates)
+            context = llm_service.context_text(documents)
+        return documents, context
+
+    async def generate_batch(self, queries, filters=None):
+        """
+        Answers many queries, yielding a result for every query as soon as it is answered.
+        The metadata `filters` apply to all of them.
+
+        Each result has the "index" and the "query" it answers, and either the
+        "response" with the "timings" of the stages, or an "error". Results
+        come in the order of completion, not the order of the queries.
+
+        Raises:
+            PipelineOverloadedError: if too many requests are in flight.
+            ValueError: if there are more than `batch_max_queries` queries.
+        """
+        if len(queries) > self.batch_max_queries:
+            raise ValueError(f"At most {self.batch_max_queries} queries can be sent in a batch, got {len(queries)}")
+        tic = time.perf_counter()
+        results = asyncio.Queue()
+        slots = asyncio.Semaphore(self.batch_concurrency)
+        tasks = []
+
+        # Every query gets exactly one result, even if its task is cancelled, so that the results
+        # below never wait for a query which is not being answered any more
+        async def answer(index, query, query_embedding, info):
+            result = {"index": index, "query": query, "error": "The query was not answered"}
+            try:
+                async with slots:
+                    response = await self._answer(query, query_embedding, info, filters)
+                info["total_time"] = time.perf_counter() - tic
+                result = {"index": index, "query": query, "response": response, "timings": info}
+            except Exception as e:
+                logger.warning(f"Failed to answer query {index} of the batch: {e}")
+                result["error"] = str(e)
+            finally:
+                results.put_nowait(result)
+
+        async def embed(start, batch):
+            info = {}
+            error = "The query was not answered"
+            started = 0
+            try:
+                async with self._stage("embedding", info):
+                    query_embeddings = await self.services.embedding.aget_embeddings_gen_ai(batch)
+                # The questions of a batch are answered as soon as the batch is embedded
+                for index, (query, query_embedding) in enumerate(zip(batch, query_embeddings), start):
+                    tasks.append(asyncio.create_task(answer(index, query, query_embedding, dict(info))))
+                    started += 1
+            except Exception as e:
+                logger.warning(f"Failed to embed queries {start} to {start + len(batch) - 1} of the batch: {e}")
+                error = str(e)
+            finally:
+                for index, query in enumerate(batch[started:], start + started):
+                    results.put_nowait({"index": index, "query": query, "error": error})
+
+        async with self._request():
+            self._stats["batches"] += 1
+            self._stats["batch_queries"] += len(queries)
+            for start in range(0, len(queries), self.embedding_batch_size):
+                tasks.append(asyncio.create_task(embed(start, queries[start:start + self.embedding_batch_size])))
+            try:
+                for _ in range(len(queries)):
+                    yield await results.get()
+            finally:
+                # Nothing is left to do on success, the rest is cancelled if the client went away
+                for task in tasks:
+                    task.cancel()
+
+    async def stream(self, query, filters=None):
+        """
+        Answers a query as a stream of events, each a tuple of a name and a payload:
+        "metadata" with the source documents once they are retrieved, a "token"
+        for every piece of the answer as the LLM generates it, and "done" with
+        the timings of the stages, including the time to the first token.
+
+        Raises:
+            PipelineOverloadedError: if too many requests are in flight.
+        """
+        info = {}
+        tic = time.perf_counter()
+        async with self._request():
+            self._stats["streams"] += 1
+            async with self._stage("embedding", info):
+                query_embedding = await self.services.embedding.aget_embedding_gen_ai(query)
+            response = await self._cached_answer(query_embedding, info, filters)
+            if response is not None:
+                yield "metadata", {"documents": [], "answer_cache_hit": True}
+                self._record_first_token(info, tic)
+                yield "token", {"text": response}
+            else:
+                toc = time.perf_counter()
+                rows, context = await self._retrieve(query_embedding, info, filters)
+                yield "metadata", {
+                    "documents": [source_document(row) for row in rows],
+                    "answer_cache_hit": False if self.answer_cache is not None else None
+                }
+                tokens = []
+                async with self._stage("llm", info):
+                    async for text in self.services.llm_service.astream(query, context):
+                        if not tokens:
+                            self._record_first_token(info, tic)
+                        tokens.append(text)
+                        yield "token", {"text": text}
+                if self.answer_cache is not None and context and not filters:
+                    self.answer_cache.store(query, query_embedding, "".join(tokens), time.perf_counter() - toc)
+        info["total_time"] = time.perf_counter() - tic
+        yield "done", info
+
+    def _record_first_token(self, info, tic):
+        time_to_first_token = time.perf_counter() - tic
+        info["time_to_first_token"] = time_to_first_token
+        instrumentation.observe_time_to_first_token(time_to_first_token)
+        self._stats["first_tokens"] += 1
+        self._stats["time_to_first_token_total"] += time_to_first_token
+        self._stats["time_to_first_token_max"] = max(self._stats["time_to_first_token_max"], time_to_first_token)
+
+    def stats(self):
+        """
+        Returns the requests in flight, and the activity and limit of every stage.
+        """
+        stats = dict(self._stats)
+        total = stats.pop("time_to_first_token_total")
+        stats["time_to_first_token_avg"] = total / stats["first_tokens"] if stats["first_tokens"] else 0.0
+        stats["in_flight"] = self._in_flight
+        stats["max_in_flight"] = self.max_in_flight
+        stats["coalescing"] = self.coalescer.stats() if self.coalescer is not None else None
+        stats["stages"] = {
+            stage: {
+                "active": self._active[stage],
+                "limit": self.limits[stage],
+                "wait_time_max": self._wait_time_max[stage]
+            } for stage in self.STAGES
+        }
+        return stats
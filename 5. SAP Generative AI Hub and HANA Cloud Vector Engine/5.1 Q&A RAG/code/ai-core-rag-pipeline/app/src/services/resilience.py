@@ -0,0 +1,406 @@
+# Deadlines, retries, hedged requests, and circuit breaking of the calls to the remote models
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# HTTP statuses of failures which may not happen again: timeouts, throttling, and unavailable upstreams
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+# Transport errors of the HTTP clients of the SDK (httpx, requests), recognised without importing them
+RETRYABLE_ERROR_NAMES = {"TransportError", "TimeoutException", "ConnectionError", "Timeout"}
+
+
+class UpstreamUnavailableError(Exception):
+    """
+    Raised without calling the upstream while its circuit breaker is open.
+    """
+
+
+class DeadlineExceededError(TimeoutError):
+    """
+    Raised when a call timed out for good: its deadline passed, or its last attempt timed out.
+    """
+
+
+def is_retryable(error):
+    """
+    Checks whether a failed call may succeed if sent again: timeouts, connection
+    errors, and HTTP errors of throttling or of an unavailable upstream.
+
+    The embedding and generation calls have no side effects, so sending them
+    again is safe; errors of the request itself, e.g. a content filter, are not retried.
+    """
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is None and getattr(error, "response", None) is not None:
+        status = getattr(error.response, "status_code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUSES
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+
+class CircuitBreaker:
+    """
+    Fails fast while an upstream is unhealthy.
+
+    The circuit opens after `failure_threshold` consecutive failed attempts,
+    and calls are then rejected without reaching the upstream. After
+    `reset_timeout` seconds, one attempt is let through as a probe: the
+    circuit closes if it succeeds, and opens again if it fails. Only
+    retryable failures count; an upstream answering with an error of the
+    request itself is healthy.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0) -> None:
+        if failure_threshold < 1:
+            raise ValueError(f"The failure threshold must be positive, got {failure_threshold}")
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self._opened = 0
+
+    def allow(self):
+        """
+        Returns whether an attempt may be sent, taking the probe of a half-open circuit.
+        """
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self.state != self.CLOSED:
+                logger.info("Circuit closed, the upstream answered the probe")
+            self.state = self.CLOSED
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failures >= self.failure_threshold):
+                logger.warning(f"Circuit opened after {self._failures} consecutive failures, "
+                               f"failing fast for {self.reset_timeout:g}s")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+                self._opened += 1
+
+    def record_cancelled(self):
+        """
+        Records an attempt abandoned before its outcome was known, freeing the probe it may have taken.
+        """
+        with self._lock:
+            self._probing = False
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "opened": self._opened, "consecutive_failures": self._failures}
+
+
+class LatencyTracker:
+    """
+    Keeps the latencies of the last `window` successful attempts, for the hedging delay.
+    """
+
+    def __init__(self, window=512) -> None:
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def percentile(self, percentile):
+        with self._lock:
+            latencies = np.fromiter(self._latencies, dtype=np.float64, count=len(self._latencies))
+        return float(np.percentile(latencies, percentile)) if len(latencies) else None
+
+
+class Upstream:
+    """
+    Calls a remote model with a deadline, retries, hedged requests, and a circuit breaker.
+
+    Every call must succeed within `deadline` seconds, retries and hedged
+    requests included, and every attempt within `attempt_timeout` seconds
+    if set, so a hung attempt is retried. Retryable failures are retried
+    up to `retries` times after a random delay of up to `backoff` seconds,
+    doubling up to `max_backoff` ("full jitter"), while the deadline allows.
+
+    With a `hedge_percentile`, an attempt still running after that
+    percentile of the recent latencies is duplicated, and the first
+    answer wins, the other being cancelled: a single slow replica then
+    no longer sets the tail latency, for about 100 - percentile % more
+    requests. Hedging starts once `hedge_min_samples` latencies are known,
+    and only while the circuit is closed.
+
+    Attempts are counted by a `CircuitBreaker`, whose open circuit rejects
+    calls with UpstreamUnavailableError without reaching the upstream.
+
+    `call` takes a function returning a new awaitable for every attempt.
+    `call_sync` runs blocking functions on a pool of `sync_workers` threads
+    to enforce the deadline; an attempt over its deadline cannot be
+    interrupted and keeps its thread until the upstream answers. It does
+    not hedge.
+    """
+
+    def __init__(self,
+                 name,
+                 deadline=60.0,
+                 attempt_timeout=None,
+                 retries=2,
+                 backoff=0.2,
+                 max_backoff=2.0,
+                 hedge_percentile=None,
+                 hedge_min_samples=20,
+                 failure_threshold=5,
+                 reset_timeout=30.0,
+                 sync_workers=8
+                 ) -> None:
+        if hedge_percentile is not None and not 0 < hedge_percentile < 100:
+            raise ValueError(f"The hedge percentile must be between 0 and 100, got {hedge_percentile}")
+        self.name = name
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.latencies = LatencyTracker()
+        self.sync_workers = sync_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(
+            ("calls", "succeeded", "failed", "rejected", "attempts", "retries", "timeouts",
+             "deadlines_exceeded", "hedges", "hedge_wins"), 0
+        )
+
+    def _count(self, **counts):
+        with self._lock:
+            for key, value in counts.items():
+                self._stats[key] += value
+
+    def hedge_delay(self):
+        """
+        Returns the seconds after which an attempt is hedged, or None if it is not.
+        """
+        if self.hedge_percentile is None or len(self.latencies) < self.hedge_min_samples:
+            return None
+        return self.latencies.percentile(self.hedge_percentile)
+
+    def _attempt_limit(self, deadline):
+        if self.attempt_timeout is None:
+            return deadline
+        return min(deadline, time.monotonic() + self.attempt_timeout)
+
+    def _retry_delay(self, error, retry, deadline):
+        """
+        Returns the delay before retrying a failed attempt, or None if the failure is final.
+        """
+        if retry > self.retries or not is_retryable(error):
+            return None
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (retry - 1)))
+        return delay if time.monotonic() + delay < deadline else None
+
+    def _reject(self):
+        self._count(calls=1, rejected=1, failed=1)
+        raise UpstreamUnavailableError(f"The {self.name} upstream is unavailable, its circuit breaker is open")
+
+    def _record_outcome(self, error, latency=None):
+        if error is None:
+            self.breaker.record_success()
+            self.latencies.add(latency)
+        elif is_retryable(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    async def _run(self, function):
+        tic = time.monotonic()
+        try:
+            result = await function()
+        except asyncio.CancelledError:
+            self.breaker.record_cancelled()
+            raise
+        except Exception as e:
+            self._record_outcome(e)
+            raise
+        self._record_outcome(None, time.monotonic() - tic)
+        return result
+
+    async def _attempt(self, function, limit, hedge):
+        """
+        Runs an attempt until `limit`, hedging it if it is slow, and returns the first answer.
+        """
+        started = time.monotonic()
+        first = asyncio.ensure_future(self._run(function))
+        tasks = {first}
+        hedge_at = None
+        if hedge:
+            delay = self.hedge_delay()
+            hedge_at = started + delay if delay is not None else None
+        error = None
+        try:
+            while tasks:
+                now = time.monotonic()
+                if now >= limit:
+                    break
+                wait_until = min(limit, hedge_at) if hedge_at is not None else limit
+                done, tasks = await asyncio.wait(tasks, timeout=wait_until - now, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self._count(hedge_wins=1)
+                        return task.result()
+                    error = task.exception()
+                if hedge_at is not None and time.monotonic() >= hedge_at:
+                    hedge_at = None
+                    if first in tasks and self.breaker.state == CircuitBreaker.CLOSED:
+                        self._count(hedges=1, attempts=1)
+                        tasks.add(asyncio.ensure_future(self._run(function)))
+            if error is not None and not tasks:
+                raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        # Abandoned at the limit: a timeout is a failure of the upstream
+        self.breaker.record_failure()
+        self._count(timeouts=1)
+        raise TimeoutError(f"The {self.name} upstream did not answer within {limit - started:.1f}s")
+
+    async def call(self, function, hedge=True):
+        """
+        Returns the result of the awaitable returned by `function()`, called for every attempt.
+
+        Streams should not be hedged (`hedge=False`): the losing stream would stay open.
+
+        Raises:
+            UpstreamUnavailableError: if the circuit breaker is open.
+            DeadlineExceededError: if no attempt succeeded within the deadline, or the last one timed out.
+        """
+        deadline = time.monotonic() + self.deadline
+        retry = 0
+        while True:
+            if not self.breaker.allow():
+                self._reject()
+            self._count(attempts=1)
+            try:
+                result = await self._attempt(function, self._attempt_limit(deadline), hedge)
+            except Exception as e:
+                retry += 1
+                delay = self._retry_delay(e, retry, deadline)
+                if delay is None:
+                    self._fail(e, deadline)
+                logger.info(f"Retrying the {self.name} call in {delay:.2f}s after: {e}")
+                self._count(retries=1)
+                await asyncio.sleep(delay)
+                continue
+            self._count(calls=1, succeeded=1)
+            return result
+
+    def call_sync(self, function):
+        """
+        Returns the result of the blocking `function()`, called for every attempt.
+
+        Raises:
+            UpstreamUnavailableError: if the circuit breaker is open.
+            DeadlineExceededError: if no attempt succeeded within the deadline, or the last one timed out.
+        """
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.sync_workers,
+                                                        thread_name_prefix=f"{self.name}-upstream")
+        deadline = time.monotonic() + self.deadline
+        retry = 0
+        while True:
+            if not self.breaker.allow():
+                self._reject()
+            self._count(attempts=1)
+            limit = self._attempt_limit(deadline)
+            tic = time.monotonic()
+            future = self._executor.submit(function)
+            try:
+                result = future.result(timeout=max(0.0, limit - tic))
+            except FutureTimeoutError:
+                future.cancel()
+                self.breaker.record_failure()
+                self._count(timeouts=1)
+                error = TimeoutError(f"The {self.name} upstream did not answer within {limit - tic:.1f}s")
+            except Exception as e:
+                self._record_outcome(e)
+                error = e
+            else:
+                self._record_outcome(None, time.monotonic() - tic)
+                self._count(calls=1, succeeded=1)
+                return result
+            retry += 1
+            delay = self._retry_delay(error, retry, deadline)
+            if delay is None:
+                self._fail(error, deadline)
+            logger.info(f"Retrying the {self.name} call in {delay:.2f}s after: {error}")
+            self._count(retries=1)
+            time.sleep(delay)
+
+    def _fail(self, error, deadline):
+        self._count(calls=1, failed=1)
+        if isinstance(error, TimeoutError):
+            # Every final timeout, whether the deadline passed or the attempts timing out ran out
+            self._count(deadlines_exceeded=1)
+            if time.monotonic() >= deadline - 1e-3:
+                raise DeadlineExceededError(f"The {self.name} call did not succeed within its deadline "
+                                            f"of {self.deadline:.1f}s") from error
+            raise DeadlineExceededError(f"The {self.name} call timed out: {error}") from error
+        raise error
+
+    def stats(self):
+        """
+        Returns the outcomes of the calls, the retries and hedged requests, and the state of the circuit breaker.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        delay = self.hedge_delay()
+        stats.update({
+            "deadline": self.deadline,
+            "max_retries": self.retries,
+            "hedge_percentile": self.hedge_percentile,
+            "hedge_delay": delay,
+            "latency_p50": self.latencies.percentile(50),
+            "latency_p99": self.latencies.percentile(99),
+            "circuit": self.breaker.stats()
+        })
+        return stats
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
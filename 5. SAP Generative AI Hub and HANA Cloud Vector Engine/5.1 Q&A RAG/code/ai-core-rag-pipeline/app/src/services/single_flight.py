@@ -0,0 +1,68 @@
+# Shares one execution between concurrent requests for the same thing
+import asyncio
+
+
+class _Call:
+    def __init__(self, task) -> None:
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one execution.
+
+    The first caller of a key starts the call as a task, and callers with
+    the same key arriving before it completes await that task instead of
+    starting their own: all of them receive its result, or its exception.
+    The key is forgotten as soon as the call completes, so results are
+    never reused afterwards, unlike a cache.
+
+    A cancelled caller, e.g. after a client disconnect, only stops waiting;
+    the call is cancelled once no caller is left waiting for it.
+    """
+
+    def __init__(self) -> None:
+        self._calls = {}
+        self._stats = {
+            "executions": 0,
+            "coalesced": 0
+        }
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def do(self, key, function):
+        """
+        Returns the result of `function()`, called once for the concurrent callers of `key`.
+
+        Returns:
+            Tuple of the result, and whether it was shared with an execution started by another caller.
+        """
+        call = self._calls.get(key)
+        shared = call is not None
+        if shared:
+            self._stats["coalesced"] += 1
+        else:
+            # The task runs in a copy of the context of the first caller, so its spans are traced with that request
+            call = _Call(asyncio.ensure_future(function()))
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self._calls[key] = call
+            self._stats["executions"] += 1
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task), shared
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                self._forget(key, call)
+                call.task.cancel()
+
+    def stats(self):
+        """
+        Returns how many calls were executed and how many shared an execution.
+        """
+        stats = dict(self._stats)
+        stats["in_flight"] = len(self._calls)
+        return stats
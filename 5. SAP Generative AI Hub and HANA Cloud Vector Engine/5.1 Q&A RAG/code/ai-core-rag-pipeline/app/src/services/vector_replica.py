@@ -0,0 +1,421 @@
+# In-process replica of the document vectors, searched with NumPy instead of HANA
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from app.src.services.hanadb import MAX_K, VECTOR_SEARCH_METRICS
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = "refresh.lock"
+# Rows fetched from HANA per round trip, and vectors copied per step when rewriting the matrix
+FETCH_BATCH_SIZE = 1000
+COLUMNS = "ID, PAGE_NUMBER, TEXT, TITLE, URL, VECTOR_STR"
+KEY_COLUMNS = "PAGE_NUMBER, TITLE, URL"
+
+
+def decode_vector(value):
+    """
+    Returns a REAL_VECTOR value fetched by hdbcli as a float32 array, from a list or the binary format.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        dimension = int(np.frombuffer(value, dtype="<u4", count=1)[0])
+        return np.frombuffer(value, dtype="<f4", count=dimension, offset=4).astype(np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+
+def row_fingerprint(chunk_hash, page_number, title, url):
+    """
+    Returns a 64-bit fingerprint of the content of a row, without its text and vector.
+
+    The CHUNK_HASH of the indexer stands for the text, and the vector is the
+    embedding of that text.
+    """
+    key = json.dumps([chunk_hash, page_number, title, url]).encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+def _text(value):
+    # LOB columns may be fetched as LOB objects
+    return value.read() if hasattr(value, "read") else value
+
+
+class _Snapshot:
+    """
+    The memory-mapped files of one generation of the replica.
+    """
+
+    def __init__(self, directory, manifest) -> None:
+        generation = manifest["generation"]
+        self.manifest = manifest
+        self.generation = generation
+        self.ids = np.load(os.path.join(directory, f"ids-{generation}.npy"), mmap_mode="r")
+        self.norms = np.load(os.path.join(directory, f"norms-{generation}.npy"))
+        self.fingerprints = np.load(os.path.join(directory, f"fingerprints-{generation}.npy"))
+        self.squared_norms = self.norms.astype(np.float64) ** 2
+        self.offsets = np.load(os.path.join(directory, f"offsets-{generation}.npy"), mmap_mode="r")
+        self.vectors = np.memmap(
+            os.path.join(directory, f"vectors-{generation}.f32"),
+            dtype=np.float32,
+            mode="r",
+            shape=(manifest["count"], manifest["dimension"])
+        ) if manifest["count"] else np.zeros((0, manifest["dimension"]), dtype=np.float32)
+        self.rows = np.memmap(os.path.join(directory, f"rows-{generation}.bin"), dtype=np.uint8, mode="r") \
+            if manifest["count"] else np.zeros(0, dtype=np.uint8)
+
+    def row(self, i):
+        page_number, text, title, url = json.loads(bytes(self.rows[self.offsets[i]:self.offsets[i + 1]]))
+        return int(self.ids[i]), page_number, text, title, url
+
+
+class _GenerationWriter:
+    """
+    Writes the files of a new generation row by row.
+    """
+
+    def __init__(self, directory, generation, normalize) -> None:
+        self.directory = directory
+        self.generation = generation
+        self.normalize = normalize
+        self.dimension = None
+        self.ids = []
+        self.norms = []
+        self.fingerprints = []
+        self.offsets = [0]
+        self._vectors = open(self._path(f"vectors-{generation}.f32"), "wb")
+        self._rows = open(self._path(f"rows-{generation}.bin"), "wb")
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def add(self, row_id, vector, norm, row_bytes, fingerprint):
+        if self.dimension is None:
+            self.dimension = len(vector)
+        elif len(vector) != self.dimension:
+            raise ValueError(f"Row {row_id} has a vector of dimension {len(vector)} instead of {self.dimension}")
+        self._vectors.write(np.asarray(vector, dtype=np.float32).tobytes())
+        self._rows.write(row_bytes)
+        self.ids.append(row_id)
+        self.norms.append(norm)
+        self.fingerprints.append(fingerprint)
+        self.offsets.append(self.offsets[-1] + len(row_bytes))
+
+    def add_row(self, row):
+        row_id, page_number, text, title, url, vector, chunk_hash = row
+        vector = decode_vector(vector)
+        norm = float(np.linalg.norm(vector))
+        if self.normalize:
+            vector = vector / norm if norm else vector
+            norm = 1.0 if norm else 0.0
+        row_bytes = json.dumps([page_number, _text(text), title, url]).encode()
+        self.add(int(row_id), vector, norm, row_bytes, row_fingerprint(chunk_hash, page_number, title, url))
+
+    def add_kept(self, snapshot, keep):
+        """
+        Copies the rows of a previous generation at the given indices.
+        """
+        if len(keep) and self.dimension is None:
+            self.dimension = snapshot.vectors.shape[1]
+        for start in range(0, len(keep), FETCH_BATCH_SIZE):
+            block = keep[start:start + FETCH_BATCH_SIZE]
+            self._vectors.write(np.ascontiguousarray(snapshot.vectors[block]).tobytes())
+            for i in block:
+                row_bytes = bytes(snapshot.rows[snapshot.offsets[i]:snapshot.offsets[i + 1]])
+                self._rows.write(row_bytes)
+                self.offsets.append(self.offsets[-1] + len(row_bytes))
+            self.ids.extend(snapshot.ids[block].tolist())
+            self.norms.extend(snapshot.norms[block].tolist())
+            self.fingerprints.extend(snapshot.fingerprints[block].tolist())
+
+    def close(self, dimension=None):
+        self._vectors.close()
+        self._rows.close()
+        generation = self.generation
+        np.save(self._path(f"ids-{generation}.npy"), np.asarray(self.ids, dtype=np.int64))
+        np.save(self._path(f"norms-{generation}.npy"), np.asarray(self.norms, dtype=np.float32))
+        np.save(self._path(f"fingerprints-{generation}.npy"), np.asarray(self.fingerprints, dtype=np.uint64))
+        np.save(self._path(f"offsets-{generation}.npy"), np.asarray(self.offsets, dtype=np.int64))
+        return {
+            "generation": generation,
+            "count": len(self.ids),
+            "dimension": self.dimension or dimension or 0,
+            "normalized": self.normalize
+        }
+
+
+class VectorReplica:
+    """
+    Answers top-k vector searches from a local copy of the document table.
+
+    The IDs, the rows, and the vectors of the table are exported into a
+    directory: the vectors as one float32 matrix, which is memory-mapped,
+    so the worker processes of a server share one copy in the page cache.
+    A search is a matrix-vector product followed by `argpartition`, and
+    ranks exactly as the full scan of HANA does. With `normalize`, the
+    vectors are stored normalised, which saves a division per row but only
+    supports COSINE_SIMILARITY.
+
+    `refresh` brings the replica up to date: rows added, removed, or
+    changed by an incremental indexing are applied to a new generation of
+    the files, and the whole table is exported again after a full indexing.
+    A row is kept if both its ID and a fingerprint of its content are
+    unchanged, as the indexer reuses the IDs of deleted rows. Only one
+    process refreshes at a time, the others load the new generation.
+    """
+
+    def __init__(self, directory, table_name, normalize=False) -> None:
+        self.directory = directory
+        self.table_name = table_name
+        self.normalize = normalize
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "searches": 0,
+            "search_time_total": 0.0,
+            "refreshes": 0,
+            "last_refresh": None
+        }
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def ready(self):
+        return self._snapshot is not None
+
+    def supports(self, metric):
+        """
+        Checks whether a search with this similarity function can be answered by the replica.
+        """
+        snapshot = self._snapshot
+        if snapshot is None or metric not in VECTOR_SEARCH_METRICS:
+            return False
+        return metric == "COSINE_SIMILARITY" or not snapshot.manifest["normalized"]
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.directory, MANIFEST_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        """
+        Maps the current generation of the files, if it is not mapped yet.
+
+        Returns:
+            Whether a generation is loaded.
+        """
+        manifest = self._read_manifest()
+        if manifest is None:
+            return self.ready
+        if self._snapshot is None or self._snapshot.generation != manifest["generation"]:
+            try:
+                snapshot = _Snapshot(self.directory, manifest)
+            except FileNotFoundError:
+                # Superseded while being read, the next load picks up the newer generation
+                logger.warning(f"Generation {manifest['generation']} of the vector replica is gone")
+                return self.ready
+            with self._lock:
+                self._snapshot = snapshot
+            logger.info(f"Loaded generation {manifest['generation']} of the vector replica ({manifest['count']} rows)")
+        return True
+
+    def top_k(self, query_vector, metric="COSINE_SIMILARITY", k=4):
+        """
+        Returns the indices in the replica and the scores of the k nearest rows, nearest first.
+        """
+        if metric not in VECTOR_SEARCH_METRICS:
+            raise ValueError(f"Unsupported metric {metric!r}, use one of {', '.join(VECTOR_SEARCH_METRICS)}")
+        if isinstance(k, bool) or not isinstance(k, int) or not 1 <= k <= MAX_K:
+            raise ValueError(f"k must be an integer between 1 and {MAX_K}, got {k!r}")
+        snapshot = self._snapshot
+        query = np.asarray(query_vector, dtype=np.float32)
+        if query.shape != (snapshot.vectors.shape[1],):
+            raise ValueError(f"The query vector has dimension {query.size}, the replica {snapshot.vectors.shape[1]}")
+        products = snapshot.vectors @ query
+        query_norm = np.linalg.norm(query)
+        if metric == "COSINE_SIMILARITY" and snapshot.manifest["normalized"]:
+            scores = products / query_norm if query_norm else np.zeros_like(products)
+            ranking = -scores
+        elif metric == "COSINE_SIMILARITY":
+            denominators = snapshot.norms * query_norm
+            scores = np.divide(products, denominators, out=np.zeros_like(products), where=denominators > 0)
+            ranking = -scores
+        else:
+            # |v - q|^2 = |v|^2 - 2 v.q + |q|^2 preselects the candidates, whose distances are then computed exactly
+            ranking = snapshot.squared_norms - 2 * products + float(query_norm) ** 2
+        k = min(k, len(ranking))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        if metric == "COSINE_SIMILARITY":
+            nearest = np.argpartition(ranking, k - 1)[:k]
+            nearest = nearest[np.argsort(ranking[nearest], kind="stable")]
+            return nearest, scores[nearest]
+        candidates = np.argpartition(ranking, min(len(ranking), 4 * k) - 1)[:4 * k]
+        distances = np.linalg.norm(snapshot.vectors[candidates] - query, axis=1)
+        order = np.argsort(distances, kind="stable")[:k]
+        return candidates[order], distances[order]
+
+    def search(self, query_vector, metric="COSINE_SIMILARITY", k=4, with_vectors=False):
+        """
+        Returns the k nearest rows as (ID, PAGE_NUMBER, TEXT, TITLE, URL), like `HanaDB.run_vector_search`,
+        followed by the vector if `with_vectors`.
+        """
+        tic = time.perf_counter()
+        snapshot = self._snapshot
+        nearest, _ = self.top_k(query_vector, metric, k)
+        rows = [snapshot.row(i) for i in nearest]
+        if with_vectors:
+            rows = [row + (np.array(snapshot.vectors[i]),) for row, i in zip(rows, nearest)]
+        with self._lock:
+            self._stats["searches"] += 1
+            self._stats["search_time_total"] += time.perf_counter() - tic
+        return rows
+
+    def build(self, rows, table_version=None):
+        """
+        Writes a new generation from (ID, PAGE_NUMBER, TEXT, TITLE, URL, VECTOR_STR, CHUNK_HASH) rows, and loads it.
+        """
+        manifest = self._read_manifest()
+        writer = _GenerationWriter(self.directory, (manifest["generation"] + 1) if manifest else 1, self.normalize)
+        try:
+            for row in rows:
+                writer.add_row(row)
+        finally:
+            new_manifest = writer.close()
+        self._publish(new_manifest, table_version)
+        return new_manifest
+
+    def _publish(self, manifest, table_version):
+        manifest["table_version"] = table_version
+        manifest["created_at"] = time.time()
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(path + ".tmp", path)
+        self.load()
+        # The previous generation is kept for processes loading it right now, older ones are
+        # removed: processes which still map them keep reading them until they reload
+        for name in glob.glob(os.path.join(self.directory, "*-*.*")):
+            generation = os.path.basename(name).split("-", 1)[1].split(".", 1)[0]
+            if generation.isdigit() and int(generation) < manifest["generation"] - 1:
+                os.remove(name)
+
+    def refresh(self, hana_db):
+        """
+        Brings the replica up to date with the document table.
+
+        Returns:
+            Dict with the mode of the refresh ("full", "incremental", "unchanged",
+            or "skipped" if another process is refreshing) and the rows added and removed.
+        """
+        tic = time.perf_counter()
+        with open(os.path.join(self.directory, LOCK_FILE), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.load()
+                return {"mode": "skipped"}
+            try:
+                # Another process may have refreshed since this one loaded
+                self.load()
+                result = self._refresh(hana_db)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        result["refresh_time"] = time.perf_counter() - tic
+        with self._lock:
+            self._stats["refreshes"] += 1
+            self._stats["last_refresh"] = result
+        logger.info(f"Refreshed the vector replica: {result}")
+        return result
+
+    def _refresh(self, hana_db):
+        # Only the creation time of the table tells a rebuilt table apart
+        version = hana_db.table_version(self.table_name)
+        table_version = str(version[0])
+        # Without a manifest table, the table was written by an indexer without incremental runs nor
+        # CHUNK_HASH column, and only changes by being rebuilt
+        hash_column = "CHUNK_HASH" if len(version) > 1 else "NULL"
+        snapshot = self._snapshot
+        with hana_db.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                if (snapshot is None or snapshot.manifest.get("table_version") != table_version
+                        or snapshot.manifest["normalized"] != self.normalize):
+                    return self._export(cursor, table_version, hash_column)
+                cursor.execute(f"SELECT ID, {hash_column}, {KEY_COLUMNS} FROM {self.table_name} ORDER BY ID")
+                table_rows = cursor.fetchall()
+                table_ids = np.asarray([row[0] for row in table_rows], dtype=np.int64)
+                fingerprints = np.asarray([row_fingerprint(*row[1:]) for row in table_rows], dtype=np.uint64)
+                # The IDs of a generation are sorted; a row is kept if its ID holds the same content
+                positions = np.minimum(np.searchsorted(snapshot.ids, table_ids), max(len(snapshot.ids) - 1, 0))
+                kept = np.zeros(len(table_ids), dtype=bool)
+                if len(snapshot.ids):
+                    kept = (snapshot.ids[positions] == table_ids) & (snapshot.fingerprints[positions] == fingerprints)
+                keep = positions[kept]
+                added_ids = table_ids[~kept]
+                removed = len(snapshot.ids) - len(keep)
+                if not len(added_ids) and not removed:
+                    return {"mode": "unchanged", "added": 0, "removed": 0, "count": len(snapshot.ids)}
+                writer = _GenerationWriter(self.directory, snapshot.generation + 1, self.normalize)
+                try:
+                    if len(added_ids):
+                        # Merges the added rows into the kept ones, in the order of their IDs
+                        kept_ids = snapshot.ids[keep]
+                        added = set(added_ids.tolist())
+                        start = 0
+                        cursor.execute(f"SELECT {COLUMNS}, {hash_column} FROM {self.table_name} "
+                                       f"WHERE ID >= ? ORDER BY ID", (int(added_ids[0]),))
+                        for row in self._fetch(cursor):
+                            if row[0] not in added:
+                                continue
+                            end = int(np.searchsorted(kept_ids, row[0]))
+                            writer.add_kept(snapshot, keep[start:end])
+                            writer.add_row(row)
+                            start = end
+                        keep = keep[start:]
+                    writer.add_kept(snapshot, keep)
+                finally:
+                    manifest = writer.close(snapshot.manifest["dimension"])
+                self._publish(manifest, table_version)
+                return {"mode": "incremental", "added": len(added_ids), "removed": removed,
+                        "count": manifest["count"]}
+            finally:
+                cursor.close()
+
+    def _export(self, cursor, table_version, hash_column):
+        cursor.execute(f"SELECT {COLUMNS}, {hash_column} FROM {self.table_name} ORDER BY ID")
+        manifest = self.build(self._fetch(cursor), table_version)
+        return {"mode": "full", "added": manifest["count"], "removed": 0, "count": manifest["count"]}
+
+    @staticmethod
+    def _fetch(cursor):
+        while True:
+            rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    def stats(self):
+        """
+        Returns the generation, size, and search times of the replica.
+        """
+        snapshot = self._snapshot
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({
+            "ready": snapshot is not None,
+            "generation": snapshot.generation if snapshot else None,
+            "count": snapshot.manifest["count"] if snapshot else 0,
+            "dimension": snapshot.manifest["dimension"] if snapshot else None,
+            "normalized": snapshot.manifest["normalized"] if snapshot else self.normalize,
+            "search_time_avg": stats["search_time_total"] / stats["searches"] if stats["searches"] else 0.0
+        })
+        return stats
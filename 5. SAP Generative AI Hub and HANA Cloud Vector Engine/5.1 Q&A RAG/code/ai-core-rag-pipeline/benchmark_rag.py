@@ -0,0 +1,341 @@
+"""
+Load test of the RAG API against local stand-ins.
+
+Starts the FastAPI app of `main.py` in a server process, with the stand-ins
+of `stand_ins.py` instead of AI Core and HANA: a deterministic embedding
+model, an in-memory vector store searched with NumPy, and an LLM streaming
+a canned answer, each with a configurable latency distribution. The app
+itself runs unchanged, with its pool, caches, and concurrency limits. The
+API is then driven by a rising number of concurrent clients, each sending
+requests back to back, and every level reports the throughput, the latency
+percentiles, the error rate, and the mean time of every stage of the
+pipeline, scraped from /metrics.
+
+    python3 benchmark_rag.py --concurrency 1 8 32 128 --duration 10
+    python3 benchmark_rag.py --endpoint stream --llm-token-latency 0.02
+    python3 benchmark_rag.py --llm-latency lognormal:0.8,0.5 --llm-error-rate 0.01
+    python3 benchmark_rag.py --env ANSWER_CACHE=true --distinct-queries 200 --json results.json
+    python3 benchmark_rag.py --documents 400 --shards 8
+
+Features are configured as for the server: from the environment, `.env`,
+and `--env NAME=VALUE`. Comparing the JSON output of two builds with the
+same arguments shows the effect of a change.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+
+import httpx
+import numpy as np
+from prometheus_client.parser import text_string_to_metric_families
+
+from stand_ins import (FakeEmbeddingModel, FakeOrchestrationService, FakeProxyClient, LatencyDistribution,
+                       LocalDatabase, LocalVectorStore, synthetic_chunks)
+
+TABLE_NAME = "BENCHMARK_DOCS"
+PERCENTILES = (50, 90, 95, 99)
+ENDPOINTS = {
+    "generate": "/v2/generate",
+    "stream": "/v2/generate/stream",
+    "batch": "/v2/generate_batch"
+}
+
+
+def benchmark_environment(args, replica_dir):
+    """
+    Returns the environment of the server: the stand-in table, no shared services, and the `--env` overrides.
+    """
+    environment = {
+        "HANA_DB_TABLE_NAME": TABLE_NAME,
+        "VECTOR_REPLICA_DIR": replica_dir,
+        "EMBEDDING_CACHE_REDIS_URL": "",
+        "RAG_LOG_SAMPLE_RATE": "0",
+        "LOG_LEVEL": "WARNING"
+    }
+    if args.shards > 1:
+        environment["HANA_DB_SHARDS"] = ",".join(f"{TABLE_NAME}_{i}:shard={i}" for i in range(args.shards))
+    for assignment in args.env:
+        name, _, value = assignment.partition("=")
+        environment[name] = value
+    return environment
+
+
+def synthetic_queries(rows, count, seed):
+    rng = random.Random(seed)
+    return [f"What does the document say about {' '.join(rng.choice(rows)[2].split()[:8])}?" for _ in range(count)]
+
+
+def serve(args, port, environment):
+    """
+    Runs the app with the local stand-ins, in the server process.
+    """
+    os.environ.update(environment)
+    import uvicorn
+    import main
+    from app.src.services.app_services import AppServices
+
+    embedding_model = FakeEmbeddingModel(dimension=args.dimension, latency=args.embedding_latency)
+    rows = synthetic_chunks(args.documents, args.pages, args.chunks_per_page, seed=args.seed)
+    vectors = np.stack([embedding_model.embed(row[2]) for row in rows])
+    if args.shards > 1:
+        # Consecutive documents go to the same shard, like a partitioning by time
+        store = LocalDatabase([
+            LocalVectorStore(f"{TABLE_NAME}_{i}", [rows[j] for j in part], vectors[part], latency=args.hana_latency)
+            for i, part in enumerate(np.array_split(np.arange(len(rows)), args.shards))
+        ])
+    else:
+        store = LocalVectorStore(TABLE_NAME, rows, vectors, latency=args.hana_latency)
+    orchestration_service = FakeOrchestrationService(
+        latency=args.llm_latency,
+        token_latency=args.llm_token_latency,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.llm_error_rate
+    )
+    main.app.state.services = AppServices.from_env(
+        hana_connect=store.connect,
+        embedding_client=embedding_model.client,
+        async_embedding_client=embedding_model.async_client,
+        proxy_client=FakeProxyClient(),
+        orchestration_service=orchestration_service
+    )
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_until_ready(client, server, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not server.is_alive():
+            sys.exit("The server process exited during startup")
+        try:
+            if (await client.get("/v2/ready")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    sys.exit(f"The server was not ready after {timeout:.0f}s")
+
+
+async def scrape_stages(client):
+    """
+    Returns the total and count of the stage durations and waits exported by /metrics.
+    """
+    stages = {}
+    text = (await client.get("/metrics")).text
+    for family in text_string_to_metric_families(text):
+        if family.name not in ("rag_stage_duration_seconds", "rag_stage_wait_seconds"):
+            continue
+        kind = "run" if family.name == "rag_stage_duration_seconds" else "wait"
+        for sample in family.samples:
+            if sample.name.endswith("_sum") or sample.name.endswith("_count"):
+                key = (sample.labels["stage"], kind, sample.name.rsplit("_", 1)[1])
+                stages[key] = sample.value
+    return stages
+
+
+def stage_means(before, after):
+    means = {}
+    for (stage, kind, field), value in after.items():
+        if field != "sum":
+            continue
+        count = after[(stage, kind, "count")] - before.get((stage, kind, "count"), 0)
+        total = value - before.get((stage, kind, "sum"), 0)
+        means.setdefault(stage, {})[f"{kind}_mean"] = total / count if count else None
+    return means
+
+
+async def send(client, args, queries, rng):
+    """
+    Sends one request, returning its status, its time to the first token if streamed, and its failed queries.
+    """
+    if args.endpoint == "batch":
+        response = await client.post(ENDPOINTS["batch"], json={"queries": rng.sample(queries, args.batch_size)})
+        errors = sum("error" in json.loads(line) for line in response.text.splitlines() if line)
+        return response.status_code, None, errors
+    body = {"query": rng.choice(queries)}
+    if args.endpoint == "generate":
+        response = await client.post(ENDPOINTS["generate"], json=body)
+        return response.status_code, None, 0
+    tic = time.perf_counter()
+    first_token = None
+    failed = 0
+    async with client.stream("POST", ENDPOINTS["stream"], json=body) as response:
+        async for line in response.aiter_lines():
+            if first_token is None and line == "event: token":
+                first_token = time.perf_counter() - tic
+            failed |= line == "event: error"
+    return response.status_code, first_token, failed
+
+
+async def run_level(client, args, queries, concurrency):
+    """
+    Runs `concurrency` clients for the warm-up and the duration of a level, and measures the requests after the warm-up.
+    """
+    queries_per_request = args.batch_size if args.endpoint == "batch" else 1
+    started = time.perf_counter()
+    measured_from = started + args.warmup
+    stopped_at = measured_from + args.duration
+    latencies, first_tokens, statuses, failures = [], [], {}, []
+
+    async def client_loop(number):
+        rng = random.Random(args.seed * 100003 + concurrency * 1009 + number)
+        while time.perf_counter() < stopped_at:
+            tic = time.perf_counter()
+            try:
+                status, first_token, errors = await send(client, args, queries, rng)
+            except httpx.HTTPError as e:
+                status, first_token, errors = type(e).__name__, None, 0
+            if tic < measured_from:
+                continue
+            latencies.append(time.perf_counter() - tic)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            # A batch answered with errors fails only for the queries in error
+            failures.append(errors if status == 200 else queries_per_request)
+            if first_token is not None:
+                first_tokens.append(first_token)
+
+    before = await scrape_stages(client)
+    await asyncio.gather(*(client_loop(number) for number in range(concurrency)))
+    elapsed = time.perf_counter() - measured_from
+    stages = stage_means(before, await scrape_stages(client))
+
+    requests = len(latencies)
+    result = {
+        "concurrency": concurrency,
+        "requests": requests,
+        "seconds": elapsed,
+        "throughput": requests / elapsed if elapsed else 0.0,
+        "queries_per_second": requests * queries_per_request / elapsed if elapsed else 0.0,
+        "error_rate": sum(failures) / (requests * queries_per_request) if requests else 0.0,
+        "statuses": statuses,
+        "latency": summarize(latencies),
+        "stages": stages
+    }
+    if args.endpoint == "stream":
+        result["time_to_first_token"] = summarize(first_tokens)
+    return result
+
+
+def summarize(values):
+    if not values:
+        return None
+    values = np.asarray(values)
+    summary = {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+    summary.update({"mean": float(values.mean()), "max": float(values.max())})
+    return summary
+
+
+def print_level(result, endpoint):
+    latency = result["latency"] or dict.fromkeys(("p50", "p90", "p99", "max"), float("nan"))
+    line = (f"{result['concurrency']:>6} {result['requests']:>8} {result['throughput']:>9.1f} "
+            f"{100 * result['error_rate']:>6.1f}% {1000 * latency['p50']:>9.0f} {1000 * latency['p90']:>9.0f} "
+            f"{1000 * latency['p99']:>9.0f} {1000 * latency['max']:>9.0f}")
+    if endpoint == "stream":
+        first_token = result["time_to_first_token"] or {"p50": float("nan"), "p99": float("nan")}
+        line += f" {1000 * first_token['p50']:>9.0f} {1000 * first_token['p99']:>9.0f}"
+    stages = [f"{stage} {1000 * (means.get('wait_mean') or 0):.0f}+{1000 * (means.get('run_mean') or 0):.0f}"
+              for stage, means in result["stages"].items() if means.get("run_mean") is not None]
+    print(line + "   " + ", ".join(stages))
+
+
+async def drive(args, port):
+    rows = synthetic_chunks(args.documents, args.pages, args.chunks_per_page, seed=args.seed)
+    queries = synthetic_queries(rows, args.distinct_queries, args.seed)
+    limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=args.timeout) as client:
+        await wait_until_ready(client, args.server, args.startup_timeout)
+        header = f"{'conc.':>6} {'requests':>8} {'req/sec':>9} {'errors':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+        if args.endpoint == "stream":
+            header += f" {'ttft p50':>9} {'ttft p99':>9}"
+        print(header + "   stage wait+run ms")
+        levels = []
+        for concurrency in args.concurrency:
+            result = await run_level(client, args, queries, concurrency)
+            print_level(result, args.endpoint)
+            levels.append(result)
+            if args.max_error_rate is not None and result["error_rate"] > args.max_error_rate:
+                print(f"Stopping: the error rate exceeds {100 * args.max_error_rate:.0f}%")
+                break
+        pipeline = (await client.get("/v2/status/pipeline")).json()
+    return levels, pipeline
+
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    load = arg_parser.add_argument_group("load")
+    load.add_argument("--endpoint", choices=list(ENDPOINTS), default="generate")
+    load.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64], help="concurrent clients of each level")
+    load.add_argument("--duration", type=float, default=10.0, help="measured seconds of each level")
+    load.add_argument("--warmup", type=float, default=2.0, help="seconds of each level before measuring")
+    load.add_argument("--distinct-queries", type=int, default=1000, help="distinct queries the clients choose from")
+    load.add_argument("--batch-size", type=int, default=32, help="queries per request of the batch endpoint")
+    load.add_argument("--timeout", type=float, default=60.0, help="seconds before a request fails")
+    load.add_argument("--max-error-rate", type=float, help="stop rising once a level has more errors than this")
+    corpus = arg_parser.add_argument_group("corpus")
+    corpus.add_argument("--documents", type=int, default=50)
+    corpus.add_argument("--pages", type=int, default=10, help="pages per document")
+    corpus.add_argument("--chunks-per-page", type=int, default=6)
+    corpus.add_argument("--dimension", type=int, default=1536, help="dimension of the fake embeddings")
+    corpus.add_argument("--shards", type=int, default=1, help="tables the chunks are split into, searched in parallel")
+    fakes = arg_parser.add_argument_group("fakes", "latencies are seconds, or distributions such as "
+                                                   "uniform:0.02,0.08, normal:0.05,0.01, lognormal:0.05,0.5, exponential:0.05")
+    fakes.add_argument("--embedding-latency", type=LatencyDistribution, default=LatencyDistribution("lognormal:0.03,0.3"))
+    fakes.add_argument("--hana-latency", type=LatencyDistribution, default=LatencyDistribution("lognormal:0.01,0.3"),
+                       help="latency of a vector search, on top of the NumPy search")
+    fakes.add_argument("--llm-latency", type=LatencyDistribution, default=LatencyDistribution("lognormal:0.5,0.3"),
+                       help="time to the first token")
+    fakes.add_argument("--llm-token-latency", type=float, default=0.005, help="seconds per generated token")
+    fakes.add_argument("--completion-tokens", type=int, default=64)
+    fakes.add_argument("--llm-error-rate", type=float, default=0.0, help="share of the LLM calls failing")
+    arg_parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                            help="environment variable of the server, e.g. ANSWER_CACHE=true")
+    arg_parser.add_argument("--startup-timeout", type=float, default=120.0)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--json", help="write the results to this file")
+    return arg_parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.endpoint == "batch" and args.batch_size > args.distinct_queries:
+        sys.exit("--batch-size cannot exceed --distinct-queries")
+    port = free_port()
+    with tempfile.TemporaryDirectory(prefix="benchmark-rag-") as replica_dir:
+        environment = benchmark_environment(args, replica_dir)
+        # A fresh interpreter, so the server imports the app as it is deployed
+        server = multiprocessing.get_context("spawn").Process(target=serve, args=(args, port, environment), daemon=True)
+        server.start()
+        args.server = server
+        try:
+            levels, pipeline = asyncio.run(drive(args, port))
+        finally:
+            server.terminate()
+            server.join(10)
+        del args.server
+
+    if args.json:
+        arguments = {name: value if isinstance(value, (int, float, str, list, type(None))) else str(value)
+                     for name, value in vars(args).items()}
+        with open(args.json, "w") as f:
+            json.dump({
+                "arguments": arguments,
+                "environment": environment,
+                "levels": levels,
+                "pipeline": pipeline
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Checks the deadlines, retries, hedged requests, and circuit breaker of the calls to the LLM.
+
+Offline, `LLMService` calls the fake orchestration service of
+`stand_ins.py`, with delays and failures injected into it, through an
+`Upstream` configured like AppServices does, and every scenario checks
+an expectation:
+
+- hedging: with a share of the calls stalling, hedging at a percentile
+  of the latencies cuts the p99 latency, for a few percent more calls
+- retries: with a share of the calls failing with 503, retried calls succeed
+- deadline: calls to a hung upstream fail on time, async and blocking ones
+- streams: streams failing when opened, like the SDK on the first
+  iteration, are retried, and a stream stalling between its chunks fails
+  on time; every stream is closed
+- circuit breaker: during an outage, the circuit opens and calls fail
+  fast without reaching the upstream, then a probe closes it once the
+  upstream recovered
+
+    python3 check_resilience.py
+    python3 check_resilience.py --calls 2000 --stall-share 0.02 --stall 5
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+import numpy as np
+
+from app.src.services.llmservice import LLMService, prompt_1
+from app.src.services.resilience import DeadlineExceededError, Upstream, UpstreamUnavailableError
+from stand_ins import FakeLLMError, FakeOrchestrationService, FakeProxyClient, LatencyDistribution
+
+
+class Report:
+    def __init__(self) -> None:
+        self.failures = []
+
+    def check(self, scenario, passed, detail):
+        print(f"  [{'ok' if passed else 'FAILED'}] {detail}")
+        if not passed:
+            self.failures.append(f"{scenario}: {detail}")
+
+
+def llm_service(orchestration_service, upstream):
+    return LLMService(None, proxy_client=FakeProxyClient(), orchestration_service=orchestration_service,
+                      upstream=upstream)
+
+
+async def ask(service):
+    return await service.asend_request(prompt=prompt_1, _print=False, context="Some context.", query="A question?")
+
+
+async def run_calls(service, calls, concurrency):
+    """
+    Sends `calls` requests with `concurrency` in flight, returning the latencies of the successful ones and the errors.
+    """
+    latencies, errors = [], []
+    remaining = iter(range(calls))
+
+    async def client():
+        for _ in remaining:
+            tic = time.perf_counter()
+            try:
+                await ask(service)
+                latencies.append(time.perf_counter() - tic)
+            except Exception as e:
+                errors.append(e)
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return np.asarray(latencies), errors
+
+
+async def check_hedging(args, report):
+    latency = LatencyDistribution(f"tail:{args.latency},{args.stall_share},{args.stall}")
+    print(f"Hedging ({args.calls} calls, latency {latency}):")
+    results = {}
+    for percentile in (None, args.hedge_percentile):
+        orchestration = FakeOrchestrationService(latency=latency, completion_tokens=8)
+        upstream = Upstream("llm", deadline=60, retries=0, hedge_percentile=percentile)
+        latencies, errors = await run_calls(llm_service(orchestration, upstream), args.calls, args.concurrency)
+        stats = upstream.stats()
+        p50, p99 = np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000
+        label = f"hedged at p{percentile:g}" if percentile else "not hedged"
+        print(f"  {label}: p50 {p50:.0f} ms, p99 {p99:.0f} ms, {stats['hedges']} hedges "
+              f"({stats['hedges'] / args.calls:.1%} more calls), {stats['hedge_wins']} won, {len(errors)} errors")
+        results[percentile] = p99
+    report.check("hedging", results[args.hedge_percentile] < results[None] / 2,
+                 f"hedging cuts the p99 latency from {results[None]:.0f} ms to {results[args.hedge_percentile]:.0f} ms")
+
+
+async def check_retries(args, report):
+    print(f"Retries ({args.calls} calls, error rate {args.error_rate:.0%}):")
+    success_rates = {}
+    for retries in (0, 2):
+        orchestration = FakeOrchestrationService(latency=LatencyDistribution(args.latency), completion_tokens=8,
+                                                 error_rate=args.error_rate)
+        upstream = Upstream("llm", deadline=60, retries=retries, backoff=0.01, failure_threshold=args.calls)
+        latencies, errors = await run_calls(llm_service(orchestration, upstream), args.calls, args.concurrency)
+        success_rates[retries] = len(latencies) / args.calls
+        print(f"  {retries} retries: {success_rates[retries]:.1%} succeeded, {upstream.stats()['retries']} retries")
+    expected = 1 - args.error_rate ** 3
+    report.check("retries", success_rates[2] >= expected - 0.02,
+                 f"retried calls succeed {success_rates[2]:.1%} of the time (expected {expected:.1%})")
+
+
+async def check_deadline(args, report):
+    print(f"Deadline ({args.deadline * 1000:.0f} ms, hung upstream):")
+    orchestration = FakeOrchestrationService(latency=LatencyDistribution(1.0), completion_tokens=8)
+    upstream = Upstream("llm", deadline=args.deadline, retries=2, failure_threshold=100)
+    service = llm_service(orchestration, upstream)
+    for variant in ("async", "blocking"):
+        tic = time.perf_counter()
+        try:
+            if variant == "async":
+                await ask(service)
+            else:
+                await asyncio.to_thread(service.send_request, prompt=prompt_1, _print=False, context="", query="")
+            error = None
+        except Exception as e:
+            error = e
+        elapsed = time.perf_counter() - tic
+        report.check("deadline", isinstance(error, DeadlineExceededError) and elapsed < args.deadline + 0.1,
+                     f"{variant} call failed with {type(error).__name__} after {elapsed * 1000:.0f} ms")
+    upstream.close()
+
+
+class RecordingOrchestrationService(FakeOrchestrationService):
+    """
+    Keeps the streams it returns, to check that they are closed.
+    """
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.streams = []
+
+    async def astream(self, config=None, template_values=None):
+        stream = await super().astream(config, template_values)
+        self.streams.append(stream)
+        return stream
+
+
+async def stream(service):
+    return "".join([text async for text in service.astream("A question?", "Some context.")])
+
+
+async def check_streams(args, report):
+    print(f"Streams ({args.calls // 4} streams, error rate {args.error_rate:.0%}):")
+    orchestration = RecordingOrchestrationService(latency=LatencyDistribution(args.latency), completion_tokens=8,
+                                                  error_rate=args.error_rate)
+    upstream = Upstream("llm", deadline=60, retries=2, backoff=0.01, failure_threshold=args.calls)
+    service = llm_service(orchestration, upstream)
+    results = await asyncio.gather(*(stream(service) for _ in range(args.calls // 4)), return_exceptions=True)
+    succeeded = sum(isinstance(result, str) for result in results) / len(results)
+    expected = 1 - args.error_rate ** 3
+    report.check("streams", succeeded >= expected - 0.03 and upstream.stats()["retries"] > 0,
+                 f"streams failing when opened are retried: {succeeded:.1%} succeed (expected {expected:.1%}), "
+                 f"{upstream.stats()['retries']} retries")
+    opened = [s for s in orchestration.streams if s.opened]
+    report.check("streams", all(s.closed for s in opened), f"{sum(s.closed for s in opened)}/{len(opened)} "
+                 f"opened streams closed")
+
+    orchestration = RecordingOrchestrationService(latency=LatencyDistribution(args.latency), completion_tokens=8,
+                                                  token_latency=1.0)
+    upstream = Upstream("llm", deadline=args.deadline, retries=2)
+    tic = time.perf_counter()
+    try:
+        await stream(llm_service(orchestration, upstream))
+        error = None
+    except Exception as e:
+        error = e
+    elapsed = time.perf_counter() - tic
+    report.check("streams", isinstance(error, DeadlineExceededError) and elapsed < args.deadline + 0.1,
+                 f"a stalled stream failed with {type(error).__name__} after {elapsed * 1000:.0f} ms")
+    report.check("streams", orchestration.streams[0].closed, "the stalled stream is closed")
+
+
+async def check_circuit_breaker(args, report):
+    print("Circuit breaker (outage, then recovery):")
+    orchestration = FakeOrchestrationService(latency=LatencyDistribution(args.latency), completion_tokens=8,
+                                             error_rate=1.0)
+    upstream = Upstream("llm", deadline=10, retries=0, failure_threshold=5, reset_timeout=args.reset_timeout)
+    service = llm_service(orchestration, upstream)
+    errors = []
+    for _ in range(20):
+        try:
+            await ask(service)
+        except Exception as e:
+            errors.append(e)
+    failed = sum(isinstance(error, FakeLLMError) for error in errors)
+    rejected = sum(isinstance(error, UpstreamUnavailableError) for error in errors)
+    report.check("circuit breaker", failed == 5 and rejected == 15 and orchestration.calls == 5,
+                 f"of 20 calls, {failed} reached the failing upstream and {rejected} failed fast")
+
+    tic = time.perf_counter()
+    try:
+        await ask(service)
+    except UpstreamUnavailableError:
+        pass
+    elapsed = time.perf_counter() - tic
+    report.check("circuit breaker", elapsed < 0.005, f"an open circuit fails in {elapsed * 1000:.2f} ms")
+
+    orchestration.error_rate = 0.0
+    await asyncio.sleep(args.reset_timeout)
+    calls = orchestration.calls
+    # Concurrent calls while half-open: the probe reaches the upstream, the others fail fast
+    await asyncio.gather(*(ask(service) for _ in range(5)), return_exceptions=True)
+    probes = orchestration.calls - calls
+    report.check("circuit breaker", probes == 1 and upstream.breaker.state == "closed",
+                 f"after {args.reset_timeout:.1f}s, {probes} probe reached the recovered upstream, "
+                 f"the circuit is {upstream.breaker.state}")
+    latencies, errors = await run_calls(service, 20, 4)
+    report.check("circuit breaker", not errors, f"{len(latencies)}/20 calls succeed after the recovery")
+
+
+async def check(args):
+    report = Report()
+    await check_hedging(args, report)
+    await check_retries(args, report)
+    await check_deadline(args, report)
+    await check_streams(args, report)
+    await check_circuit_breaker(args, report)
+    return report
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--calls", type=int, default=1000, help="calls per hedging and retry scenario")
+    arg_parser.add_argument("--concurrency", type=int, default=50, help="calls in flight at once")
+    arg_parser.add_argument("--latency", type=float, default=0.02, help="seconds of a normal call")
+    arg_parser.add_argument("--stall", type=float, default=0.5, help="seconds of a stalled call")
+    arg_parser.add_argument("--stall-share", type=float, default=0.03, help="share of the calls which stall")
+    arg_parser.add_argument("--hedge-percentile", type=float, default=90, help="latency percentile to hedge at")
+    arg_parser.add_argument("--error-rate", type=float, default=0.2, help="share of the calls failing with 503")
+    arg_parser.add_argument("--deadline", type=float, default=0.3, help="deadline of the hung calls")
+    arg_parser.add_argument("--reset-timeout", type=float, default=0.5, help="seconds the circuit stays open")
+    args = arg_parser.parse_args()
+
+    report = asyncio.run(check(args))
+    if report.failures:
+        print(f"{len(report.failures)} checks failed")
+    sys.exit(1 if report.failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+Checks that the in-process vector replica ranks exactly as HANA does.
+
+Offline, the replica is exported from an in-memory table of synthetic rows,
+refreshed incrementally after rows are removed and added, the added ones
+reusing the highest IDs freed, like the indexer does, and every top-k
+search is compared with an exact float64 scan implementing the similarity
+functions of HANA. After the refresh, every row of the replica must also
+hold the text and vector of the table row of its ID. With --replica-dir, an existing export (e.g. copied from
+a server) is checked against the same scan, using stored vectors as
+queries. With --hana, the replica is exported from the table configured in
+.env and compared with exact searches run by HANA. Rankings which only
+differ between rows of equal score count as ties, any other difference
+fails the check. Also reports the search latency of the replica.
+
+    python3 check_vector_replica.py --rows 50000 --dimension 1536
+    python3 check_vector_replica.py --metric L2DISTANCE --normalize
+    python3 check_vector_replica.py --replica-dir .cache/vector-replica
+    python3 check_vector_replica.py --hana --queries 50
+"""
+import argparse
+import contextlib
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from app.src.services.vector_replica import VectorReplica
+
+TABLE_NAME = "REPLICA_CHECK_DOCS"
+
+
+class InMemoryTable:
+    """
+    Stand-in for `HanaDB` serving the statements the replica sends from a list of rows.
+    """
+
+    def __init__(self, rows) -> None:
+        self.rows = list(rows)
+        self.created = time.time()
+
+    def table_version(self, table_name):
+        # Like a table of the indexer with its manifest table, and a CHUNK_HASH column
+        return (self.created, len(self.rows))
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, parameters=()):
+        rows = sorted(self.rows, key=lambda row: row[0])
+        if sql.startswith("SELECT ID, CHUNK_HASH, PAGE_NUMBER, TITLE, URL FROM"):
+            self._result = [(row[0], row[6], row[1], row[3], row[4]) for row in rows]
+        elif "WHERE ID >= ?" in sql:
+            self._result = [row for row in rows if row[0] >= parameters[0]]
+        else:
+            self._result = rows
+
+    def fetchall(self):
+        result, self._result = self._result, []
+        return result
+
+    def fetchmany(self, size):
+        result, self._result = self._result[:size], self._result[size:]
+        return result
+
+    def close(self):
+        pass
+
+
+def synthetic_rows(first_id, count, dimension, rng, run=1):
+    """
+    Returns (ID, PAGE_NUMBER, TEXT, TITLE, URL, VECTOR_STR, CHUNK_HASH) rows, written by the given indexing run.
+    """
+    # Clustered vectors, like embeddings of related chunks
+    centers = rng.standard_normal((max(1, count // 50), dimension))
+    vectors = centers[rng.integers(0, len(centers), count)] + 0.3 * rng.standard_normal((count, dimension))
+    rows = []
+    for i in range(count):
+        text = f"Text of chunk {first_id + i} of run {run}"
+        rows.append((first_id + i, str(i % 40 + 1), text, "Title", f"run-{run}-doc-{(first_id + i) // 40}.pdf",
+                     vectors[i].astype(np.float32).tolist(), hashlib.sha256(text.encode()).hexdigest()))
+    return rows
+
+
+def exact_top_k(vectors, ids, query, metric, k):
+    """
+    Returns the IDs and scores of the top k rows of an exact float64 scan.
+    """
+    vectors = np.asarray(vectors, dtype=np.float64)
+    query = np.asarray(query, dtype=np.float64)
+    if metric == "COSINE_SIMILARITY":
+        scores = vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query))
+        order = np.argsort(-scores, kind="stable")[:k]
+    else:
+        scores = np.linalg.norm(vectors - query, axis=1)
+        order = np.argsort(scores, kind="stable")[:k]
+    return [int(ids[i]) for i in order], scores[order]
+
+
+class ParityReport:
+    def __init__(self, tolerance) -> None:
+        self.tolerance = tolerance
+        self.identical = 0
+        self.ties = 0
+        self.mismatches = []
+
+    def compare(self, label, expected_ids, expected_scores, actual_ids, actual_scores):
+        if list(expected_ids) == list(actual_ids):
+            self.identical += 1
+        elif np.allclose(expected_scores, actual_scores, atol=self.tolerance, rtol=0):
+            self.ties += 1
+        else:
+            self.mismatches.append((label, list(expected_ids), list(actual_ids)))
+
+    def print(self, title):
+        total = self.identical + self.ties + len(self.mismatches)
+        print(f"{title}: {self.identical}/{total} identical, {self.ties} differing only between tied rows, "
+              f"{len(self.mismatches)} mismatches")
+        for label, expected, actual in self.mismatches[:5]:
+            print(f"  {label}: expected {expected}, got {actual}")
+
+
+def replica_top_k(replica, query, metric, k):
+    snapshot = replica._snapshot
+    nearest, scores = replica.top_k(query, metric, k)
+    return [int(snapshot.ids[i]) for i in nearest], scores
+
+
+def check_against_scan(replica, vectors, ids, queries, metric, k, report, label):
+    vectors = np.asarray(vectors, dtype=np.float64)
+    for q, query in enumerate(queries):
+        expected_ids, expected_scores = exact_top_k(vectors, ids, query, metric, k)
+        actual_ids, actual_scores = replica_top_k(replica, query, metric, k)
+        report.compare(f"{label} query {q}", expected_ids, expected_scores, actual_ids, actual_scores)
+
+
+def check_contents(replica, rows, report):
+    """
+    Checks that the replica holds the rows of the table, with their text and vector.
+    """
+    snapshot = replica._snapshot
+    if [int(row_id) for row_id in snapshot.ids] != [row[0] for row in rows]:
+        report.mismatches.append(("row IDs", len(rows), len(snapshot.ids)))
+        return
+    for i, row in enumerate(rows):
+        vector = np.asarray(row[5], dtype=np.float32)
+        if snapshot.manifest["normalized"]:
+            vector = vector / np.linalg.norm(vector)
+        if snapshot.row(i) != row[:5] or not np.allclose(snapshot.vectors[i], vector, atol=1e-6):
+            report.mismatches.append((f"contents of row {row[0]}", row[2], snapshot.row(i)[2]))
+
+
+def print_latency(replica, queries, metric, k):
+    times = []
+    for query in queries:
+        tic = time.perf_counter()
+        replica.search(query, metric, k)
+        times.append(time.perf_counter() - tic)
+    times = np.asarray(times) * 1000
+    print(f"Replica search latency ({replica.stats()['count']} rows): "
+          f"p50 {np.percentile(times, 50):.2f} ms, p99 {np.percentile(times, 99):.2f} ms")
+
+
+def check_offline(args, directory):
+    rng = np.random.default_rng(args.seed)
+    table = InMemoryTable(synthetic_rows(1, args.rows, args.dimension, rng))
+    replica = VectorReplica(directory, TABLE_NAME, normalize=args.normalize)
+    print(f"Export: {replica.refresh(table)}")
+    queries = [np.asarray(row[5]) + 0.1 * rng.standard_normal(args.dimension) for row in table.rows[:args.queries]]
+    report = ParityReport(args.tolerance)
+    check_against_scan(replica, [row[5] for row in table.rows], [row[0] for row in table.rows],
+                       queries, args.metric, args.k, report, "export")
+
+    # Remove a tenth of the rows, the document of the highest IDs among them, and add as many, like an
+    # incremental indexing run: the indexer allocates the IDs from MAX(ID) + 1, reusing the freed ones
+    ids = [row[0] for row in table.rows]
+    removed = set(ids[-(args.rows // 20):])
+    removed |= set(rng.choice(ids[:-(args.rows // 20)], size=args.rows // 10 - len(removed), replace=False).tolist())
+    table.rows = [row for row in table.rows if row[0] not in removed]
+    added = synthetic_rows(max(row[0] for row in table.rows) + 1, args.rows // 10, args.dimension, rng, run=2)
+    table.rows += added
+    reused = len(removed & {row[0] for row in added})
+    print(f"Refresh ({reused} IDs reused): {replica.refresh(table)}")
+    queries += [np.asarray(row[5]) + 0.1 * rng.standard_normal(args.dimension) for row in added[:args.queries]]
+    check_against_scan(replica, [row[5] for row in table.rows], [row[0] for row in table.rows],
+                       queries, args.metric, args.k, report, "refresh")
+    check_contents(replica, sorted(table.rows), report)
+    report.print(f"Parity with an exact scan ({args.metric}, k={args.k})")
+    print_latency(replica, queries, args.metric, args.k)
+    return report
+
+
+def check_export(args):
+    replica = VectorReplica(args.replica_dir, TABLE_NAME)
+    if not replica.load():
+        sys.exit(f"No replica found in {args.replica_dir}")
+    snapshot = replica._snapshot
+    if snapshot.manifest["normalized"] and args.metric != "COSINE_SIMILARITY":
+        sys.exit("A normalized replica only supports COSINE_SIMILARITY")
+    rng = np.random.default_rng(args.seed)
+    queries = [np.asarray(snapshot.vectors[i]) for i in rng.choice(len(snapshot.ids), size=min(args.queries, len(snapshot.ids)), replace=False)]
+    report = ParityReport(args.tolerance)
+    check_against_scan(replica, snapshot.vectors, snapshot.ids, queries, args.metric, args.k, report, "export")
+    report.print(f"Parity with an exact scan ({args.metric}, k={args.k})")
+    print_latency(replica, queries, args.metric, args.k)
+    return report
+
+
+def check_hana(args, directory):
+    from dotenv import load_dotenv
+    from app.src.services.hanadb import HanaDB, vector_search_parameter
+    from app.src.services.vector_replica import decode_vector
+    load_dotenv()
+    table_name = os.environ.get("HANA_DB_TABLE_NAME")
+    hana_db = HanaDB(os.environ.get("HANA_DB_HOST"), os.environ.get("HANA_DB_USER"),
+                     os.environ.get("HANA_DB_PASSWORD"), table_name)
+    try:
+        replica = VectorReplica(directory, table_name, normalize=args.normalize)
+        print(f"Export: {replica.refresh(hana_db)}")
+        order = "DESC" if args.metric == "COSINE_SIMILARITY" else "ASC"
+        report = ParityReport(args.tolerance)
+        with hana_db.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(f"SELECT TOP {int(args.queries)} VECTOR_STR FROM {table_name} ORDER BY RAND()")
+            queries = [decode_vector(row[0]) for row in cursor.fetchall()]
+            for q, query in enumerate(queries):
+                cursor.execute(
+                    f"SELECT TOP {int(args.k)} ID, {args.metric}(VECTOR_STR, TO_REAL_VECTOR(?)) AS SCORE "
+                    f"FROM {table_name} ORDER BY SCORE {order} WITH HINT(NO_VECTOR_INDEX)",
+                    (vector_search_parameter(query.tolist()),)
+                )
+                rows = cursor.fetchall()
+                actual_ids, actual_scores = replica_top_k(replica, query, args.metric, args.k)
+                report.compare(f"query {q}", [row[0] for row in rows], np.asarray([row[1] for row in rows]),
+                               actual_ids, actual_scores)
+            cursor.close()
+        report.print(f"Parity with HANA ({args.metric}, k={args.k})")
+        print_latency(replica, queries, args.metric, args.k)
+        return report
+    finally:
+        hana_db.close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--rows", type=int, default=20000, help="rows of the synthetic table")
+    arg_parser.add_argument("--dimension", type=int, default=1536, help="dimension of the synthetic vectors")
+    arg_parser.add_argument("--queries", type=int, default=100, help="queries to compare")
+    arg_parser.add_argument("--k", type=int, default=4, help="results per query")
+    arg_parser.add_argument("--metric", default="COSINE_SIMILARITY", choices=["COSINE_SIMILARITY", "L2DISTANCE"])
+    arg_parser.add_argument("--normalize", action="store_true", help="store the vectors normalized")
+    arg_parser.add_argument("--tolerance", type=float, default=1e-5, help="score difference counted as a tie")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--replica-dir", help="check an existing export instead of a synthetic table")
+    arg_parser.add_argument("--hana", action="store_true", help="compare with exact searches run by HANA")
+    args = arg_parser.parse_args()
+    if args.normalize and args.metric != "COSINE_SIMILARITY":
+        arg_parser.error("--normalize only supports COSINE_SIMILARITY")
+
+    if args.replica_dir:
+        report = check_export(args)
+    else:
+        directory = tempfile.mkdtemp(prefix="vector-replica-")
+        try:
+            report = check_hana(args, directory) if args.hana else check_offline(args, directory)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    sys.exit(1 if report.mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,50 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 import uvicorn
+import asyncio
 import logging
+import threading
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from app.route.rag import routes as rag_api
+from app.src.services.app_services import AppServices
+from app.src.services.instrumentation import REGISTRY, RequestContextMiddleware, ServicesCollector
 from fastapi.middleware.cors import CORSMiddleware
 import os
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger('main')
-
 load_dotenv()
 
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger('main')
+
 server_url = os.environ.get("SERVER_URL", default="http://localhost:3001")
 
+# Create the clients once for the app lifetime, and warm them up in the background,
+# so the server answers liveness probes while /v2/ready reports 503 until warm-up is done
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Services set before startup are used as they are, e.g. the local stand-ins of benchmark_rag.py
+    services = getattr(app.state, "services", None) or AppServices.from_env()
+    app.state.services = services
+    collector = ServicesCollector(services)
+    REGISTRY.register(collector)
+    stopped = threading.Event()
+    warm_up = asyncio.create_task(asyncio.to_thread(services.warm_up_until_ready, stopped=stopped))
+    background = [warm_up]
+    refresh_interval = float(os.environ.get("VECTOR_REPLICA_REFRESH_INTERVAL", 300))
+    if services.hana_db.replica is not None and refresh_interval > 0:
+        background.append(asyncio.create_task(
+            asyncio.to_thread(services.refresh_replica_periodically, refresh_interval, stopped)
+        ))
+    try:
+        yield
+    finally:
+        stopped.set()
+        REGISTRY.unregister(collector)
+        await asyncio.gather(*background)
+        await services.aclose()
+        services.close()
+
 app = FastAPI(
     title="SAP Rag pipeline",
     description="SAP Rag pipeline",
@@ -23,6 +54,7 @@ app = FastAPI(
             "url": server_url
         }
     ],
+    lifespan=lifespan,
 )
 
 # Register the routes
@@ -37,8 +69,12 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
 
+# Outermost, so the request ID and the trace cover the whole request
+app.add_middleware(RequestContextMiddleware, sample_rate=float(os.environ.get("RAG_LOG_SAMPLE_RATE", 0.01)))
+
 # Entry point
 if __name__ == '__main__':
     uvicorn.run("main:app", host='0.0.0.0', port=3001, reload=True)
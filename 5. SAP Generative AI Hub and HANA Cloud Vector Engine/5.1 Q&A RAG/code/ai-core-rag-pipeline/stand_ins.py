@@ -0,0 +1,434 @@
+"""
+Local stand-ins for the services used by the RAG pipeline.
+
+They let the FastAPI app run offline, e.g. in `benchmark_rag.py`:
+
+- `LatencyDistribution`: the latency of a fake service, constant or random.
+- `FakeEmbeddingModel`: deterministic embeddings, with a sync client for the
+  warm-up and an async one for the requests.
+- `LocalVectorStore`: an in-memory HANA table answering the vector searches,
+  the index version, and the replica export with NumPy, and `LocalDatabase`
+  holding several of them as shards.
+- `FakeOrchestrationService` and `FakeProxyClient`: an LLM generating or
+  streaming a canned answer with the token usage of the prompt.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import types
+
+import numpy as np
+
+from app.src.services.hanadb import encode_real_vector
+from app.src.services.vector_replica import decode_vector
+
+VECTOR_SEARCH_PATTERN = re.compile(
+    r"SELECT TOP (\d+) (.+?) FROM (\S+) ORDER BY (\w+)\(VECTOR_STR, TO_REAL_VECTOR\(\?\)\) (ASC|DESC)"
+)
+SCORE_COLUMN_PATTERN = re.compile(r", (\w+)\(VECTOR_STR, TO_REAL_VECTOR\(\?\)\) AS SCORE$")
+TABLE_PATTERN = re.compile(r"FROM (\S+)")
+TEMPLATE_VALUE_PATTERN = re.compile(r"\{\{\?(\w+)\}\}")
+ANSWER = ("The SAP HANA Cloud Vector Engine stores embeddings in REAL_VECTOR columns and finds the nearest "
+          "ones with similarity functions such as COSINE_SIMILARITY or L2DISTANCE, optionally with an HNSW index.")
+
+
+class LatencyDistribution:
+    """
+    Latency of a fake service in seconds, parsed from a specification:
+
+    - `0.05`: constant
+    - `uniform:0.02,0.08`: uniform between two bounds
+    - `normal:0.05,0.01`: normal with a mean and a standard deviation
+    - `lognormal:0.05,0.5`: log-normal with a median and the sigma of the log, a long tail
+    - `exponential:0.05`: exponential with a mean
+    - `tail:0.05,0.02,2.0`: constant, but a share of the samples takes longer, like requests hitting a stalled replica
+
+    Negative samples count as 0.
+    """
+
+    KINDS = {"uniform": 2, "normal": 2, "lognormal": 2, "exponential": 1, "tail": 3}
+
+    def __init__(self, spec="0") -> None:
+        self.spec = str(spec)
+        kind, _, parameters = self.spec.partition(":")
+        try:
+            if not parameters:
+                self.kind, self.parameters = "constant", (float(kind),)
+            else:
+                self.kind, self.parameters = kind, tuple(float(value) for value in parameters.split(","))
+                if self.KINDS.get(kind) != len(self.parameters):
+                    raise ValueError
+        except ValueError:
+            raise ValueError(f"Invalid latency {spec!r}, use a number of seconds or one of "
+                             f"{', '.join(f'{kind}:...' for kind in self.KINDS)}")
+        self._random = random.Random()
+
+    def sample(self):
+        if self.kind == "constant":
+            value = self.parameters[0]
+        elif self.kind == "uniform":
+            value = self._random.uniform(*self.parameters)
+        elif self.kind == "normal":
+            value = self._random.gauss(*self.parameters)
+        elif self.kind == "lognormal":
+            median, sigma = self.parameters
+            value = median * self._random.lognormvariate(0.0, sigma)
+        elif self.kind == "tail":
+            latency, share, slow_latency = self.parameters
+            value = slow_latency if self._random.random() < share else latency
+        else:
+            value = self._random.expovariate(1.0 / self.parameters[0]) if self.parameters[0] else 0.0
+        return max(0.0, value)
+
+    def __repr__(self) -> str:
+        return self.spec
+
+
+class FakeEmbeddingModel:
+    """
+    Deterministic embedding model with a configurable latency per request.
+
+    Embeddings are unit vectors seeded by the sha256 of the text, so equal
+    texts get equal vectors. `client` stands in for the `embeddings` proxy
+    of the SDK and `async_client` for its `AsyncOpenAI` client.
+    """
+
+    def __init__(self, dimension=1536, latency=None, per_item_latency=0.0) -> None:
+        self.dimension = dimension
+        self.latency = latency or LatencyDistribution()
+        self.per_item_latency = per_item_latency
+        self.requests = 0
+        self.items = 0
+        self._lock = threading.Lock()
+        self.client = types.SimpleNamespace(create=self.create)
+        self.async_client = types.SimpleNamespace(
+            embeddings=types.SimpleNamespace(create=self.acreate),
+            close=self.aclose
+        )
+
+    def embed(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dimension).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def _response(self, inputs):
+        texts = [inputs] if isinstance(inputs, str) else list(inputs)
+        with self._lock:
+            self.requests += 1
+            self.items += len(texts)
+        return types.SimpleNamespace(data=[
+            types.SimpleNamespace(index=i, embedding=self.embed(text).tolist()) for i, text in enumerate(texts)
+        ])
+
+    def _delay(self, inputs):
+        return self.latency.sample() + self.per_item_latency * (1 if isinstance(inputs, str) else len(inputs))
+
+    def create(self, model_name=None, input=None):
+        time.sleep(self._delay(input))
+        return self._response(input)
+
+    async def acreate(self, model_name=None, input=None):
+        await asyncio.sleep(self._delay(input))
+        return self._response(input)
+
+    async def aclose(self):
+        pass
+
+
+def synthetic_chunks(documents, pages, chunks_per_page, chunk_words=200, overlap_words=100, seed=0):
+    """
+    Returns chunks of synthetic documents as (ID, PAGE_NUMBER, TEXT, TITLE, URL) rows.
+
+    Consecutive chunks of a page overlap by `overlap_words` words, like the chunks of the indexer.
+    """
+    rng = random.Random(seed)
+    vocabulary = [f"term{i}" for i in range(5000)]
+    step = chunk_words - overlap_words
+    rows = []
+    for document in range(documents):
+        for page in range(1, pages + 1):
+            words = rng.choices(vocabulary, k=step * (chunks_per_page - 1) + chunk_words)
+            for chunk in range(chunks_per_page):
+                text = " ".join(words[chunk * step:chunk * step + chunk_words])
+                rows.append((len(rows) + 1, str(page), text, f"Document {document}", f"doc-{document:05d}.pdf"))
+    return rows
+
+
+class LocalVectorStore:
+    """
+    In-memory stand-in of the HANA document table.
+
+    `connect` returns DB-API connections understanding the statements of
+    `HanaDB` and `VectorReplica`: top-k vector searches, the creation time
+    of the table, and the exports of the replica. Vector searches are exact,
+    computed with NumPy, and take `latency` seconds more, like a round trip.
+    """
+
+    def __init__(self, table_name, rows, vectors, latency=None) -> None:
+        self.table_name = table_name.upper()
+        self.rows = list(rows)
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        self.unit_vectors = self.vectors / np.linalg.norm(self.vectors, axis=1, keepdims=True)
+        self.squared_norms = np.einsum("ij,ij->i", self.vectors, self.vectors)
+        self.latency = latency or LatencyDistribution()
+        self.created = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.searches = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        with self._lock:
+            self.connections += 1
+        return LocalConnection(self)
+
+    def search(self, query_vector, metric, k):
+        """
+        Returns the indices of the k nearest rows, nearest first, and their similarity or distance.
+        """
+        query = decode_vector(query_vector) if not isinstance(query_vector, str) else \
+            np.asarray(json.loads(query_vector), dtype=np.float32)
+        if metric == "COSINE_SIMILARITY":
+            ranking = -(self.unit_vectors @ (query / np.linalg.norm(query)))
+        else:
+            ranking = self.squared_norms - 2 * (self.vectors @ query)
+        k = min(k, len(ranking))
+        nearest = np.argpartition(ranking, k - 1)[:k]
+        nearest = nearest[np.argsort(ranking[nearest], kind="stable")]
+        with self._lock:
+            self.searches += 1
+        if metric == "COSINE_SIMILARITY":
+            return nearest, -ranking[nearest]
+        return nearest, np.sqrt(np.maximum(ranking[nearest] + float(query @ query), 0))
+
+    def row(self, i, columns):
+        values = dict(zip(("ID", "PAGE_NUMBER", "TEXT", "TITLE", "URL"), self.rows[i]))
+        values["VECTOR_STR"] = encode_real_vector(self.vectors[i].tolist())
+        # Like a table of an indexer without CHUNK_HASH column, which the replica selects as NULL
+        values["NULL"] = None
+        return tuple(values[column.strip()] for column in columns.split(","))
+
+    def execute(self, sql, parameters):
+        match = VECTOR_SEARCH_PATTERN.match(sql)
+        if match:
+            time.sleep(self.latency.sample())
+            k, columns, _, metric, _ = match.groups()
+            score = SCORE_COLUMN_PATTERN.search(columns)
+            if score:
+                columns = columns[:score.start()]
+            nearest, scores = self.search(parameters[0], metric, int(k))
+            return [self.row(i, columns) + ((float(value),) if score else ())
+                    for i, value in zip(nearest, scores)]
+        if "FROM SYS.TABLES" in sql:
+            return [(self.table_name, self.created)] if self.table_name in parameters else []
+        match = re.match(r"SELECT (.+?) FROM (\S+)(?: WHERE ID >= \?)?(?: ORDER BY ID)?$", sql)
+        if match:
+            # Exports of the vector replica
+            first_id = parameters[0] if parameters else 0
+            return [self.row(i, match.group(1)) for i, row in enumerate(self.rows) if row[0] >= first_id]
+        raise ValueError(f"The local vector store does not understand {sql!r}")
+
+
+class LocalDatabase:
+    """
+    Several `LocalVectorStore` tables behind one connection, like the shards of a HANA schema.
+    """
+
+    def __init__(self, stores) -> None:
+        self.stores = {store.table_name: store for store in stores}
+
+    def connect(self):
+        return LocalConnection(self)
+
+    def execute(self, sql, parameters):
+        if "FROM SYS.TABLES" in sql:
+            return [row for store in self.stores.values() for row in store.execute(sql, parameters)]
+        table_name = TABLE_PATTERN.search(sql).group(1).upper()
+        if table_name not in self.stores:
+            raise ValueError(f"Table {table_name} does not exist")
+        return self.stores[table_name].execute(sql, parameters)
+
+
+class LocalConnection:
+    def __init__(self, store) -> None:
+        self.store = store
+        self.connected = True
+
+    def cursor(self):
+        return LocalCursor(self.store)
+
+    def isconnected(self):
+        return self.connected
+
+    def close(self):
+        self.connected = False
+
+
+class LocalCursor:
+    def __init__(self, store) -> None:
+        self.store = store
+        self.sql = None
+        self._result = []
+
+    def prepare(self, sql):
+        self.sql = sql
+
+    def executeprepared(self, parameters=()):
+        self._result = self.store.execute(self.sql, parameters)
+
+    def execute(self, sql, parameters=()):
+        self._result = self.store.execute(sql, parameters)
+
+    def fetchall(self):
+        result, self._result = self._result, []
+        return result
+
+    def fetchmany(self, size):
+        result, self._result = self._result[:size], self._result[size:]
+        return result
+
+    def close(self):
+        pass
+
+
+class FakeProxyClient:
+    """
+    Stands in for the proxy client of the SDK during the warm-up.
+    """
+
+    def get_ai_core_token(self):
+        return "local"
+
+    def get_deployments(self):
+        return []
+
+
+class FakeLLMError(Exception):
+    # Like the 503 of an overloaded deployment, which the resilience layer retries
+    status_code = 503
+
+
+class FakeOrchestrationService:
+    """
+    Orchestration service answering every prompt with a canned answer.
+
+    A response takes `latency` seconds, the time to the first token, plus
+    `token_latency` seconds for every one of its `completion_tokens` words;
+    a stream yields the words as they are generated. A share `error_rate`
+    of the calls fails. The usage counts the words of the rendered prompt.
+    """
+
+    def __init__(self, latency=None, token_latency=0.0, completion_tokens=64, error_rate=0.0) -> None:
+        self.latency = latency or LatencyDistribution()
+        self.token_latency = token_latency
+        self.words = (ANSWER.split() * (completion_tokens // len(ANSWER.split()) + 1))[:completion_tokens]
+        self.error_rate = error_rate
+        self.calls = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def _start(self):
+        with self._lock:
+            self.calls += 1
+            failed = self._random.random() < self.error_rate
+            self.failures += failed
+        if failed:
+            raise FakeLLMError("The fake LLM failed, as configured by its error rate")
+
+    @staticmethod
+    def _prompt(config, template_values):
+        values = {value.name: str(value.value) for value in template_values or []}
+        template = config.template.messages[0].content
+        return TEMPLATE_VALUE_PATTERN.sub(lambda match: values.get(match.group(1), ""), template)
+
+    def _usage(self, prompt, completion_tokens):
+        return types.SimpleNamespace(prompt_tokens=len(prompt.split()), completion_tokens=completion_tokens,
+                                     total_tokens=len(prompt.split()) + completion_tokens)
+
+    def _response(self, config, template_values):
+        prompt = self._prompt(config, template_values)
+        message = types.SimpleNamespace(content=" ".join(self.words))
+        return types.SimpleNamespace(
+            module_results=types.SimpleNamespace(
+                llm=types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)]),
+                templating=[types.SimpleNamespace(content=prompt)]
+            ),
+            orchestration_result=types.SimpleNamespace(usage=self._usage(prompt, len(self.words)))
+        )
+
+    def run(self, config=None, template_values=None):
+        self._start()
+        time.sleep(self.latency.sample() + self.token_latency * len(self.words))
+        return self._response(config, template_values)
+
+    async def arun(self, config=None, template_values=None):
+        self._start()
+        await asyncio.sleep(self.latency.sample() + self.token_latency * len(self.words))
+        return self._response(config, template_values)
+
+    async def astream(self, config=None, template_values=None):
+        # Like the SDK, nothing is sent before the stream is entered or iterated
+        return FakeStream(self.words, self.token_latency, self._usage(self._prompt(config, template_values), len(self.words)),
+                          opening=self._open_stream)
+
+    async def _open_stream(self):
+        self._start()
+        await asyncio.sleep(self.latency.sample())
+
+    async def aclose_http_connection(self):
+        pass
+
+
+class FakeStream:
+    """
+    Stream of orchestration chunks, one per word, the last one with the usage.
+
+    Like the stream client of the SDK, it is an async context manager,
+    opened when entered or on the first iteration, and closed on exit.
+    Opening awaits `opening`, where the fake service fails or takes its
+    latency, as the SDK sends the request and checks its status there.
+    """
+
+    def __init__(self, words, token_latency, usage, opening=None) -> None:
+        self.words = words
+        self.token_latency = token_latency
+        self.usage = usage
+        self.opening = opening
+        self._chunks_iterator = None
+        self.opened = False
+        self.closed = False
+
+    async def __aenter__(self):
+        if self._chunks_iterator is None:
+            if self.opening is not None:
+                await self.opening()
+            self._chunks_iterator = self._chunks()
+            self.opened = True
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._chunks_iterator is None:
+            await self.__aenter__()
+        return await self._chunks_iterator.__anext__()
+
+    async def _chunks(self):
+        for i, word in enumerate(self.words):
+            if self.token_latency:
+                await asyncio.sleep(self.token_latency)
+            last = i == len(self.words) - 1
+            yield types.SimpleNamespace(orchestration_result=types.SimpleNamespace(
+                choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=word if i == 0 else " " + word))],
+                usage=self.usage if last else None
+            ))
+
+    async def __aexit__(self, *exc_info):
+        self.closed = True
+        if self._chunks_iterator is not None:
+            await self._chunks_iterator.aclose()
@@ -1,23 +1,35 @@
+import argparse
 import mimetypes
 import os
-import hashlib
+import signal
+import sys
 import json
 import warnings
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
 from tqdm import tqdm
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 import boto3
 from botocore.exceptions import ClientError
 import tika
 from tika import parser
-import re
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from hdbcli import dbapi
-
-# Initialize Tika
-
-tika.initVM()
+from ai_core_sdk.ai_core_v2_client import AICoreV2Client
+from gen_ai_hub.proxy.native.openai import embeddings
+from checkpoint import IndexingCheckpoint
+from chunking import ParallelSplitter
+from embedding_cache import EmbeddingCache
+from embedding_engine import BatchEmbedder
+from hana_loader import HanaBulkLoader, vector_parameter, vector_placeholder
+from vector_index import (
+    DEFAULT_BUILD_CONFIGURATION, DEFAULT_SEARCH_CONFIGURATION, ensure_vector_index, measure_recall, vector_search_sql
+)
+from manifest import (
+    chunk_hash, create_tables, delete_chunks, delete_document, drop_tables, load_chunk_hashes,
+    load_manifest, manifest_table_name, next_row_id, plan_changes, table_exists, upsert_manifest_entry
+)
 
 # Suppress warnings
 warnings.filterwarnings("ignore")
@@ -54,116 +66,144 @@ parameters = {
     "bucket": AWS_CONFIG["BUCKET"],
     "path_prefix": AWS_CONFIG["DOC_PATH_PREFIX"],
     "ingestion_chunk_size": 256,
-    "ingestion_chunk_overlap": 128
+    "ingestion_chunk_overlap": 128,
+    "parse_workers": int(os.environ.get("PARSE_WORKERS", 8)),
+    "parse_queue_depth": int(os.environ.get("PARSE_QUEUE_DEPTH", 16)),
+    "chunking_processes": int(os.environ.get("CHUNKING_PROCESSES") or 0) or os.cpu_count(),
+    "embedding_model": os.environ.get("EMBEDDING_MODEL", "text-embedding-ada-002"),
+    "embedding_batch_size": int(os.environ.get("EMBEDDING_BATCH_SIZE", 16)),
+    "embedding_batch_tokens": int(os.environ.get("EMBEDDING_BATCH_TOKENS", 8000)),
+    "embedding_concurrency": int(os.environ.get("EMBEDDING_CONCURRENCY", 4)),
+    "embedding_cache_path": os.environ.get("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite"),
+    "embedding_cache_max_mb": int(os.environ.get("EMBEDDING_CACHE_MAX_MB", 1024)),
+    "checkpoint_dir": os.environ.get("CHECKPOINT_DIR", ".cache/checkpoint"),
+    "hana_load_batch_size": int(os.environ.get("HANA_LOAD_BATCH_SIZE", 1000)),
+    "hana_binary_vectors": os.environ.get("HANA_BINARY_VECTORS", "true").lower() == "true",
+    "vector_index": os.environ.get("VECTOR_INDEX", "false").lower() == "true",
+    "vector_index_metric": os.environ.get("VECTOR_INDEX_METRIC", "COSINE_SIMILARITY"),
+    "vector_index_build_config": json.loads(os.environ.get("VECTOR_INDEX_BUILD_CONFIG") or "null") or DEFAULT_BUILD_CONFIGURATION,
+    "vector_index_search_config": json.loads(os.environ.get("VECTOR_INDEX_SEARCH_CONFIG") or "null") or DEFAULT_SEARCH_CONFIGURATION,
+    "vector_index_recall_queries": int(os.environ.get("VECTOR_INDEX_RECALL_QUERIES", 20)),
+    "vector_index_recall_k": int(os.environ.get("VECTOR_INDEX_RECALL_K", 4)),
+    "vector_index_min_recall": float(os.environ.get("VECTOR_INDEX_MIN_RECALL", 0.9))
 }
 
-from ai_core_sdk.ai_core_v2_client import AICoreV2Client
-from gen_ai_hub.proxy.native.openai import embeddings
-# Create an AI API client instance
-try:
-    ai_core_client = AICoreV2Client(
-        base_url=AICORE_CONFIG["BASE_URL"],
-        auth_url=AICORE_CONFIG["AUTH_URL"],
-        client_id=AICORE_CONFIG["CLIENT_ID"],
-        client_secret=AICORE_CONFIG["CLIENT_SECRET"]
-    )
-
-    # Get the number of GitHub repositories connected to SAP AI Core
-    response = ai_core_client.repositories.query()
-    print(f"Connected GitHub repositories: {response.count}")
-except Exception as e:
-    print(f"Error initializing AI Core client: {e}")
-    exit(1)
-
-def parse_pdfs_from_s3_buffer(bucket_name, prefix=""):
+def check_ai_core_connection():
     """
-    Parses PDF files from S3 bucket using Tika.
-    
-    Args:
-        bucket_name (str): S3 bucket name.
-        prefix (str): S3 prefix filter.
+    Checks that the AI Core instance hosting the embedding model is reachable.
 
     Returns:
-        List of tuples with file key, content, and metadata.
+        True if the AI Core API could be queried.
     """
+    # Create an AI API client instance
     try:
-        s3 = boto3.client('s3')
-        paginator = s3.get_paginator('list_objects_v2')
-        page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
-        all_pdf_data = []
-
-        for page in page_iterator:
-            if 'Contents' in page:
-                for obj in page['Contents']:
-                    if obj['Key'].endswith(".pdf"):
-                        try:
-                            response = s3.get_object(Bucket=bucket_name, Key=obj['Key'])
-                            file_content = response['Body'].read()
-                            xml_data = parser.from_buffer(file_content, xmlContent=True)
-                            all_pdf_data.append((obj['Key'], xml_data['content'], xml_data['metadata']))
-                        except Exception as e:
-                            print(f"Error processing {obj['Key']}: {e}")
-
-        return all_pdf_data
+        ai_core_client = AICoreV2Client(
+            base_url=AICORE_CONFIG["BASE_URL"],
+            auth_url=AICORE_CONFIG["AUTH_URL"],
+            client_id=AICORE_CONFIG["CLIENT_ID"],
+            client_secret=AICORE_CONFIG["CLIENT_SECRET"]
+        )
+
+        # Get the number of GitHub repositories connected to SAP AI Core
+        response = ai_core_client.repositories.query()
+        print(f"Connected GitHub repositories: {response.count}")
+        return True
     except Exception as e:
-        print(f"An error occurred: {e}")
-        return []
+        print(f"Error initializing AI Core client: {e}")
+        return False
 
-def pre_process_text(text_data):
-    """
-    Cleans text by removing HTML tags and entities.
+def list_pdf_objects(s3, bucket_name, prefix=""):
     """
-    return re.sub(r"<[^>]*>|&\w+;", "", text_data)
+    Lists the PDF objects stored under a prefix of an S3 bucket.
 
-def extract_pdf_metadata_page(file_content, metadata, file_name):
+    Args:
+        s3: boto3 S3 client.
+        bucket_name (str): S3 bucket name.
+        prefix (str): S3 prefix filter.
+
+    Yields:
+        S3 object summaries (dicts with Key, ETag, Size, ...) of PDF files.
     """
-    Extracts metadata and content of a PDF file.
+    paginator = s3.get_paginator('list_objects_v2')
+    page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+    for page in page_iterator:
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith(".pdf"):
+                yield obj
+
+def parse_pdf_buffer(file_content):
     """
-    soup = BeautifulSoup(file_content, "html.parser")
-    pages = soup.find_all("div", class_="page")
-    total_pages = len(pages)
-
-    metadata_fields = {
-        "total_pages": metadata.get('meta:page-count', total_pages),
-        "title": metadata.get('pdf:docinfo:title', ""),
-        "keywords": metadata.get('pdf:docinfo:keywords', ""),
-        "create_date": metadata.get('xmp:CreateDate', ""),
-        "modify_date": metadata.get('xmp:ModifyDate', "")
-    }
+    Parses a PDF with Tika.
 
-    doc_list = []
-    for page_num, page in enumerate(pages, start=1):
-        page_content = pre_process_text(str(page))
-        doc = {
-            "file_name": file_name,
-            "total_pages": metadata_fields["total_pages"],
-            "keywords": metadata_fields["keywords"],
-            "create_date": metadata_fields["create_date"],
-            "modify_date": metadata_fields["modify_date"],
-            "page_content": page_content,
-            "page_number": page_num,
-            "content_length": len(page_content)
-        }
-        doc_list.append(doc)
+    Returns:
+        Tuple of XHTML content and metadata.
+    """
+    xml_data = parser.from_buffer(file_content, xmlContent=True)
+    return xml_data['content'], xml_data['metadata']
+
+def fetch_and_parse_pdf(s3, bucket_name, key, parse_buffer=parse_pdf_buffer, checkpoint=None, etag=None):
+    """
+    Downloads a single PDF from S3 and parses it with Tika.
 
-    return doc_list
+    With a checkpoint, the output of a previous attempt of the same version
+    of the document is reused, and a new one is checkpointed.
 
-def preprocess_documents(documents):
+    Returns:
+        Tuple of file key, XHTML content, and metadata.
     """
-    Prepares documents by separating content and metadata.
+    if checkpoint:
+        parsed = checkpoint.load_parsed(key, etag)
+        if parsed:
+            return key, *parsed
+    response = s3.get_object(Bucket=bucket_name, Key=key)
+    file_content = response['Body'].read()
+    content, metadata = parse_buffer(file_content)
+    if checkpoint:
+        checkpoint.save_parsed(key, etag, content, metadata)
+        checkpoint.advance(documents_parsed=1)
+    return key, content, metadata
+
+def parse_pdf_objects(s3, bucket_name, objects, max_workers=8, queue_depth=16, parse_buffer=parse_pdf_buffer,
+                      checkpoint=None):
     """
-    content = []
-    metadata = []
+    Downloads and parses PDF objects with a pool of worker threads.
 
-    for doc in documents:
-        metadata.append({
-            "title": doc.get("file_name", ""),
-            "document_url": doc.get("file_name", ""),
-            "page_number": doc.get("page_number", "")
-        })
-        content.append(f"Document Content: {doc.get('page_content', '')}")
+    At most `queue_depth` documents are in flight (being fetched, parsed, or
+    waiting to be consumed) at any time, so memory stays bounded regardless
+    of the size of the bucket. Documents are yielded in listing order.
 
-    return content, metadata
+    Args:
+        s3: boto3 S3 client.
+        bucket_name (str): S3 bucket name.
+        objects: Iterable of S3 object summaries to process.
+        max_workers (int): Number of concurrent download/parse workers.
+        queue_depth (int): Maximum number of documents in flight.
+        parse_buffer: Function parsing PDF bytes into content and metadata.
+        checkpoint (IndexingCheckpoint): Optional checkpoint of parsed documents.
+
+    Yields:
+        Tuples of file key, content, and metadata.
+    """
+    queue_depth = max(queue_depth, max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pdf-parse") as executor:
+        pending = deque()
+        objects = iter(objects)
+        while True:
+            while len(pending) < queue_depth:
+                obj = next(objects, None)
+                if obj is None:
+                    break
+                future = executor.submit(
+                    fetch_and_parse_pdf, s3, bucket_name, obj['Key'], parse_buffer, checkpoint, obj.get('ETag')
+                )
+                pending.append((obj['Key'], future))
+            if not pending:
+                return
+            key, future = pending.popleft()
+            try:
+                yield future.result()
+            except Exception as e:
+                print(f"Error processing {key}: {e}")
 
 def get_embedding(input_text, model="text-embedding-ada-002"):
     """
@@ -185,110 +225,357 @@ def run_vector_search(query, cursor, table_name, metric="COSINE_SIMILARITY", k=4
         if not query_vector:
             raise ValueError("Failed to generate query embedding.")
 
-        sort_order = "DESC" if metric != "L2DISTANCE" else "ASC"
-        sql_query = f"""
-        SELECT TOP {k} ID, PAGE_NUMBER, TEXT
-        FROM {table_name}
-        ORDER BY {metric}(VECTOR_STR, TO_REAL_VECTOR('{query_vector}')) {sort_order}
-        """
-        cursor.execute(sql_query)
+        sql_query = vector_search_sql(table_name, metric, k, columns="ID, PAGE_NUMBER, TEXT")
+        cursor.execute(sql_query, (vector_parameter(query_vector, parameters["hana_binary_vectors"]),))
         return cursor.fetchall()
     except Exception as e:
         print(f"Error during vector search: {e}")
         return []
 
-if __name__ == "__main__":
-    # Load PDF data
-    all_pdf_data = parse_pdfs_from_s3_buffer(parameters["bucket"], parameters["path_prefix"])
-
-    # Process PDFs
-    doc_list = []
-    if all_pdf_data:
-        for file_key, content, metadata in all_pdf_data:
-            docs = extract_pdf_metadata_page(content, metadata, file_key)
-            doc_list.extend(docs)
-
-    # Preprocess documents
-    content, metadata = preprocess_documents(doc_list)
-
-    # Split documents
-    text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-        chunk_size=parameters["ingestion_chunk_size"],
-        chunk_overlap=parameters["ingestion_chunk_overlap"]
+def connect_hana():
+    """
+    Opens an encrypted connection to the HANA Cloud instance.
+    """
+    return dbapi.connect(
+        address=HANA_DB_CONFIG["HOST"],
+        port=443,
+        user=HANA_DB_CONFIG["USER"],
+        password=HANA_DB_CONFIG["PASSWORD"],
+        encrypt=True
     )
-    split_docs = text_splitter.create_documents(content, metadatas=metadata)
 
-    # Generate unique IDs and filter duplicates
-    id_list = [hashlib.sha256(doc.page_content.encode()).hexdigest() for doc in split_docs]
-    unique_docs = len(set(id_list))
-    print(f"{len(id_list) - unique_docs} duplicate documents found.")
-    print(f"{unique_docs} out of {len(split_docs)} unique documents will be indexed.")
+def plan_documents(split_stream, cursor, table_name, etags, stats):
+    """
+    Diffs the chunks of split documents against the indexed ones.
+
+    Yields:
+        One plan per document with its S3 key, ETag, chunks by sha256, and
+        the chunk hashes already indexed for it.
+    """
+    for file_key, split_docs in split_stream:
+        chunks = {}
+        for doc in split_docs:
+            chunks.setdefault(chunk_hash(doc.page_content), doc)
+        stats["chunks"] += len(split_docs)
+        stats["duplicates"] += len(split_docs) - len(chunks)
+        yield {
+            "key": file_key,
+            "etag": etags[file_key],
+            "chunks": chunks,
+            "indexed": load_chunk_hashes(cursor, table_name, file_key),
+            "complete": True
+        }
 
-    # Connect to HANA DB
+def chunk_records(plans):
+    """
+    Flattens document plans into records of the chunks to insert.
+
+    Yields:
+        Tuples of plan, chunk hash, and chunk, followed by (plan, None, None)
+        once all chunks of a document have been yielded.
+    """
+    for plan in plans:
+        for h, doc in plan["chunks"].items():
+            if h not in plan["indexed"]:
+                yield plan, h, doc
+        yield plan, None, None
+
+def embed_chunks(records, embedder, cache=None, window=1024):
+    """
+    Attaches embeddings to a stream of chunk records.
+
+    Records are processed in windows: chunks are deduplicated by sha256
+    within a window, looked up in the optional cache, and only misses are
+    sent to the embedding model. New embeddings are added to the cache as
+    their batches complete, so duplicates in later windows are cache hits
+    and a resumed run does not embed them again.
+
+    Yields:
+        Tuples of record and embedding (or None), in input order.
+    """
+    records = iter(records)
+    while True:
+        batch = list(islice(records, window))
+        if not batch:
+            return
+        pending = {h: doc for _, h, doc in batch if h is not None}
+        vectors = cache.get_many(embedder.model, pending) if cache else {}
+        to_embed = [(h, doc) for h, doc in pending.items() if h not in vectors]
+        fresh = []
+        for (h, _), embed in embedder.embed_items(to_embed, text_of=lambda chunk: chunk[1].page_content):
+            if embed is not None:
+                vectors[h] = embed
+                fresh.append((h, embed))
+            if cache and len(fresh) >= embedder.max_batch_items:
+                cache.put_many(embedder.model, fresh)
+                fresh = []
+        if cache and fresh:
+            cache.put_many(embedder.model, fresh)
+        for record in batch:
+            yield record, vectors.get(record[1])
+
+def index_documents(connection, table_name, embedder, splitter, cache=None,
+                    s3=None, connect=connect_hana, parse_buffer=parse_pdf_buffer, checkpoint=None):
+    """
+    Brings the document table in line with the PDFs in the S3 bucket.
+
+    Only new or changed documents (by ETag) are parsed. Within a changed
+    document only chunks whose sha256 is not indexed yet are embedded and
+    inserted, and rows of chunks which disappeared from it are deleted.
+    Rows of documents removed from the bucket are deleted. The manifest
+    entry of a document is committed with the last of its rows, so the
+    table stays searchable and consistent during the run.
+
+    Chunks are deduplicated by sha256 before embedding, and embeddings found
+    in the optional `cache` are reused instead of calling the model again.
+    Parsing, embedding, and loading are streamed, so memory stays bounded
+    by the queue and batch sizes rather than by the size of the corpus.
+
+    The optional `checkpoint` keeps the parsed documents which are not
+    loaded yet and the progress of the run, so it can be resumed.
+
+    The S3 client, the HANA connection factory of the loader, and the PDF
+    parser can be replaced, e.g. by the local stand-ins of the benchmark.
+
+    Returns:
+        Dict of document, chunk, and row counts of the run.
+    """
+    cursor = connection.cursor()
+    s3 = s3 or boto3.client('s3')
+    objects = list(list_pdf_objects(s3, parameters["bucket"], parameters["path_prefix"]))
+    manifest = load_manifest(cursor, table_name)
+    changed, removed = plan_changes(objects, manifest)
+    print(f"{len(changed)} new or changed, {len(removed)} removed, "
+          f"{len(objects) - len(changed)} unchanged documents.")
+
+    binary = parameters["hana_binary_vectors"]
+    sql_insert = (f"INSERT INTO {table_name} (ID, TITLE, PAGE_NUMBER, URL, TEXT, VECTOR_STR, CHUNK_HASH) "
+                  f"VALUES (?,?,?,?,?,{vector_placeholder(binary)},?)")
+    loader = HanaBulkLoader(connect, sql_insert, batch_size=parameters["hana_load_batch_size"])
+    for key in removed:
+        loader.defer(lambda cur, key=key: delete_document(cur, table_name, key))
+
+    def finish_document(plan):
+        def statement(cur):
+            delete_chunks(cur, table_name, plan["key"], plan["indexed"] - set(plan["chunks"]))
+            # Documents with failed chunks are retried on the next run
+            complete = plan["complete"] and not any(row[3] == plan["key"] for row in loader.failed_rows)
+            upsert_manifest_entry(cur, table_name, plan["key"], plan["etag"] if complete else None, len(plan["chunks"]))
+        return statement
+
+    def document_loaded(plan):
+        # Only once the manifest entry is committed, so a resumed run does not skip the document
+        def callback():
+            checkpoint.discard_parsed(plan["key"], plan["etag"])
+            checkpoint.advance(documents_loaded=1)
+        return callback
+
+    etags = {obj['Key']: obj['ETag'] for obj in changed}
+    pdf_stream = parse_pdf_objects(
+        s3,
+        parameters["bucket"],
+        changed,
+        max_workers=parameters["parse_workers"],
+        queue_depth=parameters["parse_queue_depth"],
+        parse_buffer=parse_buffer,
+        checkpoint=checkpoint
+    )
+    stats = {"chunks": 0, "duplicates": 0}
+    plans = plan_documents(splitter.split(pdf_stream), cursor, table_name, etags, stats)
+
+    print("Generating embedding....")
+    row_id = next_row_id(cursor, table_name)
+    rows_loaded = 0
     try:
-        connection = dbapi.connect(
-            address=HANA_DB_CONFIG["HOST"],
-            port=443,
-            user=HANA_DB_CONFIG["USER"],
-            password=HANA_DB_CONFIG["PASSWORD"],
-            encrypt=True
+        for (plan, h, doc), embed in tqdm(embed_chunks(chunk_records(plans), embedder, cache), desc="Indexing", unit="chunk"):
+            if doc is None:
+                loader.defer(finish_document(plan), on_commit=document_loaded(plan) if checkpoint else None)
+                continue
+            if embed is None:
+                plan["complete"] = False  # Skip documents with failed embeddings
+                continue
+            loader.add([
+                row_id,
+                doc.metadata.get('title', ''),
+                doc.metadata.get('page_number', ''),
+                doc.metadata.get('document_url', ''),
+                doc.page_content,
+                vector_parameter(embed, binary),
+                h
+            ])
+            row_id += 1
+            if checkpoint:
+                checkpoint.advance(chunks_embedded=1, rows_loaded=loader.loaded - rows_loaded)
+                rows_loaded = loader.loaded
+    finally:
+        loader.close()
+        if checkpoint:
+            checkpoint.advance(rows_loaded=loader.loaded - rows_loaded)
+            checkpoint.save()
+
+    print(splitter.report())
+    print(f"{stats['duplicates']} duplicate documents found out of {stats['chunks']}.")
+    if cache:
+        print(cache.report())
+    print(embedder.report())
+    print(loader.report())
+    print(f"{loader.loaded} documents inserted into the table.")
+    return {
+        "documents": len(changed),
+        "removed": len(removed),
+        "chunks": stats["chunks"],
+        "duplicates": stats["duplicates"],
+        "rows_loaded": loader.loaded,
+        "rows_failed": len(loader.failed_rows),
+        "load_seconds": loader.elapsed,
+        "load_bytes": loader.bytes
+    }
+
+def check_vector_index_recall(cursor, table_name):
+    """
+    Compares the approximate search of the vector index with the exact search.
+
+    Returns:
+        The recall@k measured on a sample of queries, or None if not measured.
+    """
+    if parameters["vector_index_recall_queries"] <= 0:
+        return None
+    recall = measure_recall(
+        cursor,
+        table_name,
+        parameters["vector_index_metric"],
+        k=parameters["vector_index_recall_k"],
+        queries=parameters["vector_index_recall_queries"],
+        binary=parameters["hana_binary_vectors"]
+    )
+    if recall is None:
+        print("No vectors to measure the recall of the vector index on")
+        return None
+    print(f"Vector index recall@{parameters['vector_index_recall_k']}: {recall:.3f} "
+          f"over {parameters['vector_index_recall_queries']} sampled queries")
+    if recall < parameters["vector_index_min_recall"]:
+        print(f"Warning: recall below {parameters['vector_index_min_recall']}, "
+              f"consider raising efSearch in VECTOR_INDEX_SEARCH_CONFIG or M/efConstruction in VECTOR_INDEX_BUILD_CONFIG")
+    return recall
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description="Index PDF documents from S3 into SAP HANA Cloud Vector Engine")
+    arg_parser.add_argument(
+        "--mode",
+        choices=["full", "incremental"],
+        default=os.environ.get("INDEXING_MODE", "full"),
+        help="full drops and rebuilds the table, incremental only indexes changes since the last run"
+    )
+    arg_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="resume the last run from its checkpoint after a crash or preemption, in place of --mode"
+    )
+    arg_parser.add_argument(
+        "--table",
+        help="table to index into instead of HANA_DB_TABLE_NAME, e.g. one shard of HANA_DB_SHARDS of the RAG pipeline"
+    )
+    arg_parser.add_argument(
+        "--prefix",
+        help="S3 prefix of the documents to index instead of AWS_DOC_PATH_PREFIX, e.g. the documents of one shard"
+    )
+    return arg_parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not check_ai_core_connection():
+        exit(1)
+
+    # Unwind on preemption, so that the rows embedded so far are committed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    # Hana db table name, the shards of a sharded index being loaded independently, one run per table
+    table_name = args.table or HANA_DB_CONFIG["TABLE_NAME"]
+    if args.prefix is not None:
+        parameters["path_prefix"] = args.prefix
+    if args.table and parameters["checkpoint_dir"]:
+        # Runs of several shards may run at once, each with its own checkpoint
+        parameters["checkpoint_dir"] = os.path.join(parameters["checkpoint_dir"], args.table)
+    settings = {
+        "ingestion_chunk_size": parameters["ingestion_chunk_size"],
+        "ingestion_chunk_overlap": parameters["ingestion_chunk_overlap"],
+        "embedding_model": parameters["embedding_model"]
+    }
+    checkpoint = IndexingCheckpoint(parameters["checkpoint_dir"]) if parameters["checkpoint_dir"] else None
+    if args.resume:
+        state = checkpoint.load() if checkpoint else None
+        if not state or state["status"] == "complete":
+            print("No interrupted indexing run to resume")
+            exit(0)
+        mismatches = checkpoint.mismatches(table_name, settings)
+        if mismatches:
+            print(f"Cannot resume, the settings changed since the interrupted run: {', '.join(mismatches)}")
+            exit(1)
+        print(f"Resuming. {checkpoint.report()}")
+
+    # Initialize Tika
+    tika.initVM()
+
+    splitter = ParallelSplitter(
+        parameters["ingestion_chunk_size"],
+        parameters["ingestion_chunk_overlap"],
+        processes=parameters["chunking_processes"]
+    )
+    embedder = BatchEmbedder(
+        model=parameters["embedding_model"],
+        max_batch_items=parameters["embedding_batch_size"],
+        max_batch_tokens=parameters["embedding_batch_tokens"],
+        max_concurrency=parameters["embedding_concurrency"]
+    )
+    cache = None
+    if parameters["embedding_cache_path"]:
+        cache = EmbeddingCache(
+            parameters["embedding_cache_path"],
+            max_bytes=parameters["embedding_cache_max_mb"] * 1024 * 1024
         )
+
+    # Connect to HANA DB
+    try:
+        connection = connect_hana()
         cursor = connection.cursor()
 
-        # Hana db table name
-        table_name = HANA_DB_CONFIG["TABLE_NAME"]
         print(f"Checking if table {table_name} is exist")
-        query = """
-        SELECT COUNT(*)
-        FROM M_TABLES
-        WHERE TABLE_NAME = ?
-        """
-        cursor.execute(query, (table_name.upper()))
-        result = cursor.fetchone()
-        is_exist = result[0]
-        if is_exist > 0:
-            print(f"table is already existed, deleting the table {table_name}")
-            cursor.execute(f"DROP TABLE {table_name}")
-
-        print(f"creating table {table_name}")
-        cursor.execute(f"""
-            CREATE COLUMN TABLE {table_name} (
-                ID BIGINT, 
-                TITLE NVARCHAR(100), 
-                PAGE_NUMBER NVARCHAR(5), 
-                URL NVARCHAR(100), 
-                TEXT NCLOB, 
-                VECTOR_STR REAL_VECTOR
+        if args.resume:
+            # The rows and manifest entries committed before the interruption are kept
+            checkpoint.resume()
+            if not table_exists(cursor, manifest_table_name(table_name)):
+                drop_tables(cursor, table_name)
+                create_tables(cursor, table_name)
+        else:
+            if args.mode == "incremental" and not table_exists(cursor, manifest_table_name(table_name)):
+                print(f"No manifest found for table {table_name}, running a full indexing instead")
+                args.mode = "full"
+            if checkpoint:
+                checkpoint.start(args.mode, table_name, settings)
+
+            if args.mode == "full":
+                drop_tables(cursor, table_name)
+                print(f"creating table {table_name}")
+                create_tables(cursor, table_name)
+
+        index_documents(connection, table_name, embedder, splitter, cache, checkpoint=checkpoint)
+        if checkpoint:
+            checkpoint.complete()
+
+        if parameters["vector_index"]:
+            # Built after the load of a full run, maintained by HANA afterwards
+            ensure_vector_index(
+                cursor,
+                table_name,
+                parameters["vector_index_metric"],
+                parameters["vector_index_build_config"],
+                parameters["vector_index_search_config"]
             )
-        """)
-
-        # Insert documents
-        sql_insert = f"INSERT INTO {table_name} (ID, TITLE, PAGE_NUMBER, URL, TEXT, VECTOR_STR) VALUES (?,?,?,?,?,TO_REAL_VECTOR(?))"
-        # Prepare documents for indexing
-        print("Generating embedding....")
-        document_to_index = []
-        for idx, doc in enumerate(split_docs):
-            try:
-                embed = get_embedding(doc.page_content)
-                if embed is None:
-                    continue  # Skip documents with failed embeddings
-                document_to_index.append([
-                    idx + 1,
-                    doc.metadata.get('title', ''),
-                    doc.metadata.get('page_number', ''),
-                    doc.metadata.get('document_url', ''),
-                    doc.page_content,
-                    str(embed)
-                ])
-            except Exception as e:
-                print(f"Error processing document {idx + 1}: {e}")
-        
-        cursor.executemany(sql_insert, document_to_index)
-        print(f"{len(document_to_index)} documents inserted into the table.")
+            check_vector_index_recall(cursor, table_name)
 
         # Test vector search
         question = "Overview of the Granite Pre-Training Dataset?"
-        results = run_vector_search(question, cursor, table_name)
+        results = run_vector_search(question, cursor, table_name, metric=parameters["vector_index_metric"])
         print("#" * 100)
         print(f"Search results: {results}")
         print("#" * 100)
@@ -298,3 +585,5 @@ if __name__ == "__main__":
     finally:
         if 'connection' in locals():
             connection.close()
+        if cache:
+            cache.close()
@@ -0,0 +1,266 @@
+"""
+End-to-end benchmark of the indexing pipeline against local stand-ins.
+
+Runs `index_documents` of `app.py` on a synthetic corpus (or on a directory
+of documents) without S3, Tika, AI Core, or HANA: documents are read from a
+local directory or an S3 emulator, embeddings come from a deterministic fake
+model with configurable latency, and rows go to an in-memory HANA which
+records the statements it receives. Reports throughput per stage, wall time,
+and peak memory.
+
+    python3 benchmark_indexing.py --documents 200 --pages 20
+    python3 benchmark_indexing.py --embedding-latency 0.2 --embedding-concurrency 8
+    python3 benchmark_indexing.py --source ./pdfs --tika
+    python3 benchmark_indexing.py --s3-endpoint http://localhost:9000 --bucket docs --rerun
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import app
+from chunking import ParallelSplitter
+from embedding_cache import EmbeddingCache
+from embedding_engine import BatchEmbedder
+from manifest import create_tables
+from stand_ins import FakeEmbeddingProvider, FakeHanaDatabase, LocalS3Client, passthrough_parse, write_synthetic_corpus
+
+TABLE_NAME = "BENCHMARK_DOCS"
+
+
+class TimedParser:
+    """
+    Wraps a PDF parser to measure the time spent in it by all parse threads.
+    """
+
+    def __init__(self, parse_buffer) -> None:
+        self.parse_buffer = parse_buffer
+        self.documents = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, file_content):
+        tic = time.perf_counter()
+        result = self.parse_buffer(file_content)
+        elapsed = time.perf_counter() - tic
+        with self._lock:
+            self.documents += 1
+            self.bytes += len(file_content)
+            self.elapsed += elapsed
+        return result
+
+
+def peak_memory_mb(who):
+    """
+    Returns the peak resident set size of this process or of its children.
+    """
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def rate(count, seconds):
+    return count / seconds if seconds else 0.0
+
+
+def upload_corpus(s3, bucket, root, prefix):
+    for name in sorted(os.listdir(root)):
+        s3.upload_file(os.path.join(root, name), bucket, prefix + name)
+
+
+def run_indexing(args, s3, database, parse_buffer, cache):
+    """
+    Runs one indexing pass and collects the metrics of every stage.
+    """
+    splitter = ParallelSplitter(
+        app.parameters["ingestion_chunk_size"],
+        app.parameters["ingestion_chunk_overlap"],
+        processes=app.parameters["chunking_processes"]
+    )
+    provider = FakeEmbeddingProvider(
+        dimension=args.dimension,
+        latency=args.embedding_latency,
+        per_item_latency=args.embedding_item_latency,
+        jitter=args.embedding_jitter,
+        throttle_every=args.throttle_every
+    )
+    embedder = BatchEmbedder(
+        model=app.parameters["embedding_model"],
+        max_batch_items=app.parameters["embedding_batch_size"],
+        max_batch_tokens=app.parameters["embedding_batch_tokens"],
+        max_concurrency=app.parameters["embedding_concurrency"],
+        create_fn=provider
+    )
+    parser = TimedParser(parse_buffer)
+    connection = database.connect()
+    statements, commits = database.statements.copy(), database.commits
+    cache_hits = cache.hits if cache else 0
+
+    tic = time.perf_counter()
+    summary = app.index_documents(
+        connection, TABLE_NAME, embedder, splitter, cache,
+        s3=s3, connect=database.connect, parse_buffer=parser
+    )
+    wall = time.perf_counter() - tic
+    connection.close()
+
+    split_chunks = sum(splitter.worker_chunks.values())
+    split_seconds = sum(splitter.worker_time.values())
+    return {
+        "wall_seconds": wall,
+        **summary,
+        "parse": {
+            "documents": parser.documents,
+            "mb": parser.bytes / 1024 / 1024,
+            "busy_seconds": parser.elapsed,
+            "docs_per_sec": rate(parser.documents, wall)
+        },
+        "chunking": {
+            "chunks": split_chunks,
+            "busy_seconds": split_seconds,
+            "chunks_per_sec": rate(split_chunks, wall),
+            "chunks_per_worker_sec": rate(split_chunks, split_seconds)
+        },
+        "embedding": {
+            "chunks": embedder.embedded,
+            "failed": embedder.failed,
+            "requests": embedder.requests,
+            "throttled": provider.throttled,
+            "cache_hits": cache.hits - cache_hits if cache else 0,
+            "chunks_per_sec": embedder.chunks_per_sec
+        },
+        "loading": {
+            "rows": summary["rows_loaded"],
+            "statements": dict(database.statements - statements),
+            "commits": database.commits - commits,
+            "rows_per_sec": rate(summary["rows_loaded"], summary["load_seconds"]),
+            "mb_per_sec": rate(summary["load_bytes"] / 1024 / 1024, summary["load_seconds"])
+        },
+        "end_to_end_chunks_per_sec": rate(summary["chunks"], wall)
+    }
+
+
+def print_run(name, metrics):
+    parse, chunking = metrics["parse"], metrics["chunking"]
+    embedding, loading = metrics["embedding"], metrics["loading"]
+    print(f"\n{name}: {metrics['documents']} documents, {metrics['chunks']} chunks "
+          f"({metrics['duplicates']} duplicates) in {metrics['wall_seconds']:.2f}s")
+    print(f"  {'parse':<10} {parse['documents']:>8} docs  {parse['docs_per_sec']:>10.1f} docs/sec    "
+          f"{parse['mb']:.1f} MB, {parse['busy_seconds']:.2f}s busy")
+    print(f"  {'chunking':<10} {chunking['chunks']:>8} chunks {chunking['chunks_per_sec']:>9.1f} chunks/sec  "
+          f"{chunking['chunks_per_worker_sec']:.1f} chunks/sec per worker")
+    print(f"  {'embedding':<10} {embedding['chunks']:>8} chunks {embedding['chunks_per_sec']:>9.1f} chunks/sec  "
+          f"{embedding['requests']} requests ({embedding['throttled']} throttled), {embedding['cache_hits']} cache hits, {embedding['failed']} failed")
+    print(f"  {'loading':<10} {loading['rows']:>8} rows  {loading['rows_per_sec']:>10.1f} rows/sec    "
+          f"{loading['mb_per_sec']:.2f} MB/sec, {loading['commits']} commits")
+    print(f"  {'total':<10} {metrics['end_to_end_chunks_per_sec']:>25.1f} chunks/sec")
+
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    corpus = arg_parser.add_argument_group("corpus")
+    corpus.add_argument("--documents", type=int, default=50, help="synthetic documents to generate")
+    corpus.add_argument("--pages", type=int, default=20, help="pages per synthetic document")
+    corpus.add_argument("--paragraphs", type=int, default=12, help="paragraphs per synthetic page")
+    corpus.add_argument("--copies", type=float, default=0.1, help="share of synthetic documents which are copies")
+    corpus.add_argument("--source", help="directory of documents to index instead of a synthetic corpus")
+    corpus.add_argument("--tika", action="store_true", help="parse the documents with Tika instead of as XHTML")
+    corpus.add_argument("--s3-endpoint", help="S3 emulator (e.g. MinIO) to read the documents from")
+    corpus.add_argument("--bucket", default="benchmark", help="bucket of the S3 emulator")
+    corpus.add_argument("--prefix", default="benchmark/", help="prefix the corpus is uploaded to")
+    corpus.add_argument("--no-upload", action="store_true", help="index the bucket as is")
+    stages = arg_parser.add_argument_group("stages")
+    stages.add_argument("--parse-workers", type=int, default=app.parameters["parse_workers"])
+    stages.add_argument("--chunking-processes", type=int, default=app.parameters["chunking_processes"])
+    stages.add_argument("--embedding-batch-size", type=int, default=app.parameters["embedding_batch_size"])
+    stages.add_argument("--embedding-concurrency", type=int, default=app.parameters["embedding_concurrency"])
+    stages.add_argument("--hana-load-batch-size", type=int, default=app.parameters["hana_load_batch_size"])
+    stages.add_argument("--text-vectors", action="store_true", help="bind vectors as text instead of binary")
+    stages.add_argument("--cache", action="store_true", help="use an embedding cache in a temporary directory")
+    fakes = arg_parser.add_argument_group("fakes")
+    fakes.add_argument("--dimension", type=int, default=1536, help="dimension of the fake embeddings")
+    fakes.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per embedding request")
+    fakes.add_argument("--embedding-item-latency", type=float, default=0.0, help="seconds per embedded text")
+    fakes.add_argument("--embedding-jitter", type=float, default=0.0, help="maximum random extra seconds per request")
+    fakes.add_argument("--throttle-every", type=int, default=0, help="answer every n-th embedding request with a 429")
+    fakes.add_argument("--hana-batch-latency", type=float, default=0.01, help="seconds per HANA batch statement")
+    fakes.add_argument("--hana-row-latency", type=float, default=0.0, help="seconds per inserted row")
+    arg_parser.add_argument("--rerun", action="store_true", help="index again without changes, like an incremental run")
+    arg_parser.add_argument("--json", help="write the metrics to this file")
+    return arg_parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    app.parameters.update({
+        "parse_workers": args.parse_workers,
+        "chunking_processes": args.chunking_processes,
+        "embedding_batch_size": args.embedding_batch_size,
+        "embedding_concurrency": args.embedding_concurrency,
+        "hana_load_batch_size": args.hana_load_batch_size,
+        "hana_binary_vectors": not args.text_vectors
+    })
+
+    workdir = tempfile.mkdtemp(prefix="benchmark-indexing-")
+    cache = None
+    try:
+        root = args.source
+        corpus_mb = 0.0
+        if not root:
+            root = os.path.join(workdir, "corpus")
+            corpus_mb = write_synthetic_corpus(root, args.documents, args.pages, args.paragraphs, args.copies) / 1024 / 1024
+            print(f"Generated {args.documents} documents of {args.pages} pages ({corpus_mb:.1f} MB)")
+
+        if args.s3_endpoint:
+            import boto3
+            s3 = boto3.client("s3", endpoint_url=args.s3_endpoint)
+            app.parameters.update({"bucket": args.bucket, "path_prefix": args.prefix})
+            if not args.no_upload:
+                upload_corpus(s3, args.bucket, root, args.prefix)
+        else:
+            s3 = LocalS3Client(root)
+            app.parameters.update({"bucket": args.bucket, "path_prefix": ""})
+
+        if args.tika:
+            app.tika.initVM()
+            parse_buffer = app.parse_pdf_buffer
+        else:
+            parse_buffer = passthrough_parse
+        if args.cache:
+            cache = EmbeddingCache(os.path.join(workdir, "embeddings.sqlite"))
+
+        database = FakeHanaDatabase(batch_latency=args.hana_batch_latency, row_latency=args.hana_row_latency)
+        connection = database.connect()
+        create_tables(connection.cursor(), TABLE_NAME)
+        connection.close()
+
+        runs = {"full": run_indexing(args, s3, database, parse_buffer, cache)}
+        if args.rerun:
+            runs["rerun"] = run_indexing(args, s3, database, parse_buffer, cache)
+
+        for name, metrics in runs.items():
+            print_run(name, metrics)
+        memory = {
+            "peak_rss_mb": peak_memory_mb(resource.RUSAGE_SELF),
+            "peak_rss_children_mb": peak_memory_mb(resource.RUSAGE_CHILDREN)
+        }
+        print(f"\nPeak memory: {memory['peak_rss_mb']:.0f} MB, "
+              f"largest worker process {memory['peak_rss_children_mb']:.0f} MB")
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"arguments": vars(args), "corpus_mb": corpus_mb, "runs": runs, "memory": memory}, f, indent=2)
+    finally:
+        if cache:
+            cache.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
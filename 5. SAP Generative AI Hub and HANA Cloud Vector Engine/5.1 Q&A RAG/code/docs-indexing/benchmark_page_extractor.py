@@ -0,0 +1,112 @@
+"""
+Micro-benchmark of the streaming page extractor against the BeautifulSoup one.
+
+Runs both extractors on synthetic Tika XHTML documents (or on XHTML files
+given on the command line), checks that they return identical pages, and
+reports the time taken by each of them.
+
+    python3 benchmark_page_extractor.py --pages 500 --repeat 3
+    python3 benchmark_page_extractor.py manual1.xhtml manual2.xhtml
+"""
+import argparse
+import random
+import time
+
+from bs4 import BeautifulSoup
+
+from page_extractor import extract_pdf_metadata_page, pre_process_text
+
+WORDS = ["SAP", "HANA", "Cloud", "vector", "engine", "embedding", "granite", "model", "table",
+         "index", "query", "the", "of", "and", "to", "data", "café", "€"]
+ENTITIES = ["&amp;", "&lt;tag&gt;", "&quot;", "&#8211;"]
+
+
+def extract_pdf_metadata_page_bs4(file_content, metadata, file_name):
+    """
+    Reference implementation building a full BeautifulSoup tree.
+    """
+    soup = BeautifulSoup(file_content, "html.parser")
+    pages = soup.find_all("div", class_="page")
+    total_pages = len(pages)
+
+    metadata_fields = {
+        "total_pages": metadata.get('meta:page-count', total_pages),
+        "title": metadata.get('pdf:docinfo:title', ""),
+        "keywords": metadata.get('pdf:docinfo:keywords', ""),
+        "create_date": metadata.get('xmp:CreateDate', ""),
+        "modify_date": metadata.get('xmp:ModifyDate', "")
+    }
+
+    doc_list = []
+    for page_num, page in enumerate(pages, start=1):
+        page_content = pre_process_text(str(page))
+        doc = {
+            "file_name": file_name,
+            "total_pages": metadata_fields["total_pages"],
+            "keywords": metadata_fields["keywords"],
+            "create_date": metadata_fields["create_date"],
+            "modify_date": metadata_fields["modify_date"],
+            "page_content": page_content,
+            "page_number": page_num,
+            "content_length": len(page_content)
+        }
+        doc_list.append(doc)
+
+    return doc_list
+
+
+def synthetic_xhtml(pages, paragraphs=12, words=60, seed=0):
+    """
+    Generates an XHTML document shaped like the output of Tika for a PDF.
+    """
+    rng = random.Random(seed)
+    body = []
+    for _ in range(pages):
+        body.append('<div class="page"><p/>\n')
+        for _ in range(paragraphs):
+            text = " ".join(rng.choice(ENTITIES if rng.random() < 0.02 else WORDS) for _ in range(words))
+            body.append(f"<p>{text}\n</p>\n")
+        body.append('<div class="annotation"><a href="https://example.com/?a=1&amp;b=2">link</a></div>\n')
+        body.append("</div>\n")
+    return ('<?xml version="1.0" encoding="UTF-8"?><html xmlns="http://www.w3.org/1999/xhtml">'
+            '<head><meta name="pdf:PDFVersion" content="1.7"/><title>sample</title></head>'
+            f'<body>{"".join(body)}</body></html>')
+
+
+def timed(function, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - tic
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("files", nargs="*", help="Tika XHTML files to use instead of synthetic documents")
+    arg_parser.add_argument("--pages", type=int, nargs="+", default=[10, 100, 500], help="pages of the synthetic documents")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="runs per extractor, the best one is reported")
+    args = arg_parser.parse_args()
+
+    if args.files:
+        samples = []
+        for path in args.files:
+            with open(path, encoding="utf-8") as f:
+                samples.append((path, f.read()))
+    else:
+        samples = [(f"synthetic-{pages}-pages", synthetic_xhtml(pages)) for pages in args.pages]
+
+    print(f"{'document':<30} {'MB':>8} {'pages':>6} {'bs4 (s)':>9} {'stream (s)':>11} {'speedup':>8}")
+    for name, content in samples:
+        expected, bs4_time = timed(extract_pdf_metadata_page_bs4, content, {}, name, repeat=args.repeat)
+        actual, stream_time = timed(extract_pdf_metadata_page, content, {}, name, repeat=args.repeat)
+        if actual != expected:
+            raise SystemExit(f"Output of the streaming extractor differs for {name}")
+        print(f"{name:<30} {len(content) / 1024 / 1024:>8.2f} {len(actual):>6} {bs4_time:>9.3f} "
+              f"{stream_time:>11.3f} {bs4_time / stream_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Checks the SQL sent by the vector index management of `vector_index.py`.
+
+Offline, `ensure_vector_index`, `drop_vector_indexes`, and `measure_recall`
+run against the recording `FakeHanaDatabase` of `stand_ins.py`, and the
+statements they send are compared with the expected ones:
+
+- a missing index is created online with the configured similarity
+  function and build and search configurations
+- an index of the same configuration is kept, one of another configuration
+  or similarity function is dropped before the new one is created
+- an unsupported similarity function fails before any index is dropped
+- the recall measurement runs every sampled query as an exact search,
+  forced with WITH HINT(NO_VECTOR_INDEX), and as an approximate one
+
+    python3 check_vector_index.py
+"""
+import argparse
+import sys
+
+import numpy as np
+
+from hana_loader import vector_parameter, vector_placeholder
+from manifest import create_tables
+from stand_ins import FakeHanaDatabase
+from vector_index import (
+    DEFAULT_BUILD_CONFIGURATION, DEFAULT_SEARCH_CONFIGURATION, drop_vector_indexes, ensure_vector_index,
+    measure_recall, vector_index_name
+)
+
+TABLE_NAME = "INDEX_CHECK_DOCS"
+
+LIST_INDEXES = ("SELECT INDEX_NAME FROM SYS.INDEXES WHERE SCHEMA_NAME = CURRENT_SCHEMA AND TABLE_NAME = ? "
+                "AND INDEX_NAME LIKE ? ESCAPE '\\'")
+LIST_PARAMETERS = (TABLE_NAME, "INDEX\\_CHECK\\_DOCS\\_HNSW\\_%")
+
+
+class Report:
+    def __init__(self) -> None:
+        self.failures = []
+
+    def check(self, scenario, passed, detail):
+        print(f"  [{'ok' if passed else 'FAILED'}] {detail}")
+        if not passed:
+            self.failures.append(f"{scenario}: {detail}")
+
+    def check_statements(self, scenario, database, expected):
+        actual = database.executed
+        database.executed = []
+        passed = actual == expected
+        self.check(scenario, passed, f"{len(actual)} statements sent, as expected" if passed else
+                   f"expected {expected}, sent {actual}")
+
+
+def create_index_sql(index_name, metric, build_configuration, search_configuration):
+    return (f"CREATE HNSW VECTOR INDEX {index_name} ON {TABLE_NAME} (VECTOR_STR) SIMILARITY FUNCTION {metric} "
+            f"BUILD CONFIGURATION '{build_configuration}' SEARCH CONFIGURATION '{search_configuration}' ONLINE")
+
+
+def check_index_management(report):
+    database = FakeHanaDatabase(record=True)
+    cursor = database.connect().cursor()
+    default_name = vector_index_name(TABLE_NAME, "COSINE_SIMILARITY", DEFAULT_BUILD_CONFIGURATION,
+                                     DEFAULT_SEARCH_CONFIGURATION)
+
+    print("Missing index:")
+    result = ensure_vector_index(cursor, TABLE_NAME, "COSINE_SIMILARITY")
+    report.check("missing index", result == (default_name, True), f"returned {result}")
+    report.check_statements("missing index", database, [
+        (LIST_INDEXES, LIST_PARAMETERS),
+        (create_index_sql(default_name, "COSINE_SIMILARITY", '{"M": 64, "efConstruction": 128}',
+                          '{"efSearch": 400}'), ())
+    ])
+
+    print("Index of the same configuration:")
+    result = ensure_vector_index(cursor, TABLE_NAME, "COSINE_SIMILARITY", dict(DEFAULT_BUILD_CONFIGURATION),
+                                 dict(DEFAULT_SEARCH_CONFIGURATION))
+    report.check("same configuration", result == (default_name, False), f"returned {result}")
+    report.check_statements("same configuration", database, [(LIST_INDEXES, LIST_PARAMETERS)])
+
+    print("Index of another configuration:")
+    name = vector_index_name(TABLE_NAME, "COSINE_SIMILARITY", {"M": 32, "efConstruction": 64}, {"efSearch": 800})
+    result = ensure_vector_index(cursor, TABLE_NAME, "COSINE_SIMILARITY", {"M": 32, "efConstruction": 64},
+                                 {"efSearch": 800})
+    report.check("other configuration", result == (name, True) and name != default_name, f"returned {result}")
+    report.check_statements("other configuration", database, [
+        (LIST_INDEXES, LIST_PARAMETERS),
+        (f"DROP INDEX {default_name}", ()),
+        (create_index_sql(name, "COSINE_SIMILARITY", '{"M": 32, "efConstruction": 64}', '{"efSearch": 800}'), ())
+    ])
+
+    print("Index of another similarity function:")
+    l2_name = vector_index_name(TABLE_NAME, "L2DISTANCE", DEFAULT_BUILD_CONFIGURATION, DEFAULT_SEARCH_CONFIGURATION)
+    result = ensure_vector_index(cursor, TABLE_NAME, "L2DISTANCE")
+    report.check("other metric", result == (l2_name, True), f"returned {result}")
+    report.check_statements("other metric", database, [
+        (LIST_INDEXES, LIST_PARAMETERS),
+        (f"DROP INDEX {name}", ()),
+        (create_index_sql(l2_name, "L2DISTANCE", '{"M": 64, "efConstruction": 128}', '{"efSearch": 400}'), ())
+    ])
+
+    print("Unsupported similarity function:")
+    try:
+        ensure_vector_index(cursor, TABLE_NAME, "DOT_PRODUCT")
+        error = None
+    except ValueError as e:
+        error = e
+    report.check("unsupported metric", error is not None, f"raised {type(error).__name__}")
+    report.check_statements("unsupported metric", database, [])
+
+    print("Dropping the indexes:")
+    drop_vector_indexes(cursor, TABLE_NAME)
+    report.check_statements("drop", database, [(LIST_INDEXES, LIST_PARAMETERS), (f"DROP INDEX {l2_name}", ())])
+    report.check("drop", not database.indexes, f"{len(database.indexes)} indexes left")
+
+
+def check_recall(args, report):
+    print(f"Recall measurement ({args.rows} rows, {args.queries} queries, k={args.k}):")
+    database = FakeHanaDatabase(record=True)
+    connection = database.connect()
+    cursor = connection.cursor()
+    create_tables(cursor, TABLE_NAME)
+    rng = np.random.default_rng(args.seed)
+    vectors = rng.standard_normal((args.rows, args.dimension))
+    cursor.executemany(
+        f"INSERT INTO {TABLE_NAME} (ID, TITLE, PAGE_NUMBER, URL, TEXT, VECTOR_STR, CHUNK_HASH) "
+        f"VALUES (?,?,?,?,?,{vector_placeholder()},?)",
+        [[i + 1, "Title", 1, f"doc-{i // 10}.pdf", f"Chunk {i}", vector_parameter(vector.tolist()), f"hash-{i}"]
+         for i, vector in enumerate(vectors)]
+    )
+    database.executed = []
+
+    recall = measure_recall(cursor, TABLE_NAME, "COSINE_SIMILARITY", k=args.k, queries=args.queries)
+    report.check("recall", recall == 1.0, f"recall@{args.k} of the exact fake: {recall}")
+    exact_sql = (f"SELECT TOP {args.k} ID FROM {TABLE_NAME} "
+                 f"ORDER BY COSINE_SIMILARITY(VECTOR_STR, TO_REAL_VECTOR(?)) DESC WITH HINT(NO_VECTOR_INDEX)")
+    approximate_sql = (f"SELECT TOP {args.k} ID FROM {TABLE_NAME} "
+                       f"ORDER BY COSINE_SIMILARITY(VECTOR_STR, TO_REAL_VECTOR(?)) DESC")
+    statements = [statement for statement, _ in database.executed]
+    expected = [f"SELECT TOP {args.queries} VECTOR_STR FROM {TABLE_NAME} ORDER BY RAND()"] + \
+        [exact_sql, approximate_sql] * args.queries
+    report.check("recall", statements == expected,
+                 f"{statements.count(exact_sql)} exact searches with WITH HINT(NO_VECTOR_INDEX) and "
+                 f"{statements.count(approximate_sql)} approximate searches sent")
+    report.check("recall", all(isinstance(parameters[0], bytes) for _, parameters in database.executed[1:]),
+                 "the query vectors are bound as parameters in the binary format")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--rows", type=int, default=500, help="rows of the synthetic table")
+    arg_parser.add_argument("--dimension", type=int, default=64, help="dimension of the synthetic vectors")
+    arg_parser.add_argument("--queries", type=int, default=10, help="sampled queries of the recall measurement")
+    arg_parser.add_argument("--k", type=int, default=4, help="results per query")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+
+    report = Report()
+    check_index_management(report)
+    check_recall(args, report)
+    if report.failures:
+        print(f"{len(report.failures)} checks failed")
+    sys.exit(1 if report.failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+
+STATE_FILE = "state.json"
+PARSED_DIR = "parsed"
+
+
+class IndexingCheckpoint:
+    """
+    Progress of an indexing run, persisted in a local directory.
+
+    The rows and manifest entries committed to HANA remain the record of
+    which chunks and documents are loaded, and the embedding cache keeps the
+    embeddings of chunks which are not loaded yet. The checkpoint adds what
+    neither of them knows: the state of the run, so that an interrupted full
+    rebuild is resumed instead of started over, and the Tika output of
+    documents which are parsed but not loaded yet, so that a resumed run
+    does not parse them again.
+    """
+
+    def __init__(self, directory, save_interval=5.0) -> None:
+        self.directory = directory
+        self.parsed_dir = os.path.join(directory, PARSED_DIR)
+        self.save_interval = save_interval
+        self.state = None
+        self._saved_at = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(self.parsed_dir, exist_ok=True)
+
+    def load(self):
+        """
+        Loads the state of the last run.
+
+        Returns:
+            Dict with the mode, table, settings, status, and progress of the
+            last run, or None if there is no checkpoint.
+        """
+        try:
+            with open(os.path.join(self.directory, STATE_FILE)) as f:
+                self.state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.state = None
+        return self.state
+
+    def start(self, mode, table_name, settings):
+        """
+        Starts the checkpoint of a new run, discarding the one of the last run.
+        """
+        self._clear_parsed()
+        now = _now()
+        self.state = {
+            "mode": mode,
+            "table": table_name,
+            "settings": settings,
+            "status": "running",
+            "started_at": now,
+            "updated_at": now,
+            "resumed": 0,
+            "progress": {
+                "documents_parsed": 0,
+                "documents_loaded": 0,
+                "chunks_embedded": 0,
+                "rows_loaded": 0
+            }
+        }
+        self.save()
+
+    def resume(self):
+        """
+        Continues the run of the loaded checkpoint.
+        """
+        self.state["status"] = "running"
+        self.state["resumed"] += 1
+        self.save()
+
+    def mismatches(self, table_name, settings):
+        """
+        Lists the settings which differ from the ones of the checkpointed run.
+
+        Resuming with other chunking settings or another embedding model would
+        mix incompatible rows in one table.
+        """
+        recorded = dict(self.state["settings"], table=self.state["table"])
+        current = dict(settings, table=table_name)
+        return [
+            f"{name}: {recorded.get(name)!r} != {value!r}"
+            for name, value in current.items() if recorded.get(name) != value
+        ]
+
+    def advance(self, **counts):
+        """
+        Adds to the progress counters, saving the state at most every `save_interval` seconds.
+        """
+        with self._lock:
+            progress = self.state["progress"]
+            for name, count in counts.items():
+                progress[name] = progress.get(name, 0) + count
+            if time.monotonic() - self._saved_at >= self.save_interval:
+                self._save()
+
+    def complete(self):
+        self.state["status"] = "complete"
+        self._clear_parsed()
+        self.save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self.state["updated_at"] = _now()
+        path = os.path.join(self.directory, STATE_FILE)
+        # Write and rename, so a crash never leaves a truncated state file
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(path + ".tmp", path)
+        self._saved_at = time.monotonic()
+
+    def _parsed_path(self, key, etag):
+        name = hashlib.sha256(f"{key}\0{etag}".encode()).hexdigest()
+        return os.path.join(self.parsed_dir, name + ".json.gz")
+
+    def load_parsed(self, key, etag):
+        """
+        Returns the checkpointed content and metadata of a parsed document, or None.
+        """
+        try:
+            with gzip.open(self._parsed_path(key, etag), "rt", encoding="utf-8") as f:
+                parsed = json.load(f)
+            return parsed["content"], parsed["metadata"]
+        except (OSError, EOFError, ValueError, KeyError):
+            return None
+
+    def save_parsed(self, key, etag, content, metadata):
+        path = self._parsed_path(key, etag)
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8", compresslevel=1) as f:
+            json.dump({"key": key, "content": content, "metadata": metadata}, f)
+        os.replace(path + ".tmp", path)
+
+    def discard_parsed(self, key, etag):
+        try:
+            os.remove(self._parsed_path(key, etag))
+        except FileNotFoundError:
+            pass
+
+    def _clear_parsed(self):
+        shutil.rmtree(self.parsed_dir, ignore_errors=True)
+        os.makedirs(self.parsed_dir, exist_ok=True)
+
+    def report(self):
+        progress = self.state["progress"]
+        return (f"Checkpoint of {self.state['mode']} run started at {self.state['started_at']}: "
+                f"{progress['documents_parsed']} documents parsed, {progress['documents_loaded']} loaded, "
+                f"{progress['chunks_embedded']} chunks embedded, {progress['rows_loaded']} rows loaded")
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
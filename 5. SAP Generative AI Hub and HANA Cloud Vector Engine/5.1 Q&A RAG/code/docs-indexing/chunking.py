@@ -0,0 +1,122 @@
+import os
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from page_extractor import extract_pdf_metadata_page
+
+# Text splitter of the current worker process, built once by `init_worker`
+_text_splitter = None
+
+
+def preprocess_documents(documents):
+    """
+    Prepares documents by separating content and metadata.
+    """
+    content = []
+    metadata = []
+
+    for doc in documents:
+        metadata.append({
+            "title": doc.get("file_name", ""),
+            "document_url": doc.get("file_name", ""),
+            "page_number": doc.get("page_number", "")
+        })
+        content.append(f"Document Content: {doc.get('page_content', '')}")
+
+    return content, metadata
+
+
+def split_document(text_splitter, file_key, content, metadata):
+    """
+    Extracts the pages of a parsed PDF and splits them into chunks.
+    """
+    pages = extract_pdf_metadata_page(content, metadata, file_key)
+    page_content, page_metadata = preprocess_documents(pages)
+    return text_splitter.create_documents(page_content, metadatas=page_metadata)
+
+
+def init_worker(chunk_size, chunk_overlap):
+    global _text_splitter
+    _text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap
+    )
+
+
+def split_in_worker(file_key, content, metadata):
+    """
+    Splits one document in a worker process.
+
+    Returns:
+        Tuple of file key, chunks, worker PID, and seconds spent.
+    """
+    tic = time.perf_counter()
+    chunks = split_document(_text_splitter, file_key, content, metadata)
+    return file_key, chunks, os.getpid(), time.perf_counter() - tic
+
+
+class ParallelSplitter:
+    """
+    Extracts pages and splits documents into chunks in a process pool.
+
+    Work is sharded by document. At most `queue_depth` documents are in
+    flight, and results are yielded in input order, so the chunk stream is
+    deterministic regardless of the number of processes.
+    """
+
+    def __init__(self, chunk_size, chunk_overlap, processes=None, queue_depth=None) -> None:
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.processes = processes or os.cpu_count() or 1
+        self.queue_depth = max(queue_depth or self.processes * 2, self.processes)
+        self.worker_chunks = defaultdict(int)
+        self.worker_time = defaultdict(float)
+
+    def split(self, pdf_stream):
+        """
+        Splits a stream of parsed documents.
+
+        Args:
+            pdf_stream: Iterable of tuples of file key, content, and metadata.
+
+        Yields:
+            Tuples of file key and its chunks, in input order.
+        """
+        executor = ProcessPoolExecutor(
+            max_workers=self.processes,
+            initializer=init_worker,
+            initargs=(self.chunk_size, self.chunk_overlap)
+        )
+        with executor:
+            # Start the workers before the stream starts its download threads
+            executor.submit(os.getpid).result()
+            pending = deque()
+            pdf_stream = iter(pdf_stream)
+            while True:
+                while len(pending) < self.queue_depth:
+                    document = next(pdf_stream, None)
+                    if document is None:
+                        break
+                    pending.append((document[0], executor.submit(split_in_worker, *document)))
+                if not pending:
+                    return
+                key, future = pending.popleft()
+                try:
+                    file_key, chunks, pid, elapsed = future.result()
+                except Exception as e:
+                    print(f"Error splitting {key}: {e}")
+                    continue
+                self.worker_chunks[pid] += len(chunks)
+                self.worker_time[pid] += elapsed
+                yield file_key, chunks
+
+    def report(self):
+        lines = [f"Chunking with {self.processes} processes:"]
+        for pid in sorted(self.worker_chunks):
+            elapsed = self.worker_time[pid]
+            rate = self.worker_chunks[pid] / elapsed if elapsed else 0.0
+            lines.append(f"  worker {pid}: {self.worker_chunks[pid]} chunks in {elapsed:.1f}s, {rate:.1f} chunks/sec")
+        return "\n".join(lines)
@@ -0,0 +1,142 @@
+import os
+import sqlite3
+import time
+from array import array
+
+# SQLite limits the number of bound parameters of a single statement
+LOOKUP_BATCH_SIZE = 500
+
+
+def encode_vector(vector):
+    """
+    Encodes an embedding as a float32 blob.
+    """
+    return array('f', vector).tobytes()
+
+
+def decode_vector(blob):
+    """
+    Decodes a float32 blob into an embedding.
+    """
+    vector = array('f')
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed cache of chunk embeddings.
+
+    Embeddings are stored in a local SQLite database keyed by model name and
+    chunk sha256, as float32 blobs. When the cache grows beyond `max_bytes`,
+    the least recently used embeddings are evicted.
+    """
+
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.con = sqlite3.connect(path)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                chunk_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, chunk_hash)
+            )
+        """)
+        self.con.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.size = self.con.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, model, hashes):
+        """
+        Looks up the embeddings of the given chunk hashes.
+
+        Returns:
+            Dict mapping chunk hash to embedding for every cached hash.
+        """
+        hashes = list(hashes)
+        found = {}
+        for start in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+            batch = hashes[start:start + LOOKUP_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.con.execute(
+                f"SELECT chunk_hash, vector FROM embeddings WHERE model = ? AND chunk_hash IN ({placeholders})",
+                [model, *batch]
+            )
+            found.update((h, decode_vector(blob)) for h, blob in rows)
+        now = time.time()
+        self.con.executemany(
+            "UPDATE embeddings SET last_used = ? WHERE model = ? AND chunk_hash = ?",
+            [(now, model, h) for h in found]
+        )
+        self.con.commit()
+        self.hits += len(found)
+        self.misses += len(hashes) - len(found)
+        return found
+
+    def put_many(self, model, items):
+        """
+        Stores embeddings given as (chunk hash, embedding) pairs, replacing those already cached.
+        """
+        now = time.time()
+        blobs = {h: encode_vector(vector) for h, vector in items}
+        hashes = list(blobs)
+        # The replaced embeddings no longer count towards the size
+        replaced = 0
+        for start in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+            batch = hashes[start:start + LOOKUP_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            replaced += self.con.execute(
+                f"SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings "
+                f"WHERE model = ? AND chunk_hash IN ({placeholders})",
+                [model, *batch]
+            ).fetchone()[0]
+        self.con.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, chunk_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+            [(model, h, blob, now) for h, blob in blobs.items()]
+        )
+        self.con.commit()
+        self.size += sum(len(blob) for blob in blobs.values()) - replaced
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Evicts least recently used embeddings until the cache is 10% below its size limit.
+        """
+        target = self.max_bytes * 0.9
+        while self.size > target:
+            rows = self.con.execute(
+                "SELECT model, chunk_hash, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT ?",
+                (LOOKUP_BATCH_SIZE,)
+            ).fetchall()
+            if not rows:
+                self.size = 0
+                break
+            evicted = []
+            for model, h, size in rows:
+                evicted.append((model, h))
+                self.size -= size
+                if self.size <= target:
+                    break
+            self.con.executemany("DELETE FROM embeddings WHERE model = ? AND chunk_hash = ?", evicted)
+        self.con.commit()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def report(self):
+        return (f"Embedding cache: {self.hits} hits, {self.misses} misses "
+                f"({self.hit_rate:.1%} hit rate), {self.size / 1024 / 1024:.1f} MB in {self.path}")
+
+    def close(self):
+        self.con.close()
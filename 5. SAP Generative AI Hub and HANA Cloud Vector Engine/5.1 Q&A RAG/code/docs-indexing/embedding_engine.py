@@ -0,0 +1,230 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import tiktoken
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def _status_code(error):
+    """
+    Returns the HTTP status code attached to an embedding client error, if any.
+    """
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def _is_retryable(error):
+    """
+    Returns whether an embedding client error may succeed if sent again: throttling,
+    server errors, and errors without a status, e.g. connection errors.
+    """
+    status = _status_code(error)
+    return status is None or status in RETRYABLE_STATUS_CODES
+
+
+def _retry_after(error):
+    """
+    Returns the server requested back-off in seconds, if any.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def default_create_fn(model, texts):
+    """
+    Embeds a list of texts with the SAP Generative AI Hub embedding proxy.
+    """
+    from gen_ai_hub.proxy.native.openai import embeddings
+
+    response = embeddings.create(model_name=model, input=texts)
+    data = sorted(response.data, key=lambda item: item.index)
+    return [item.embedding for item in data]
+
+
+class AdaptiveBackoff:
+    """
+    Back-off state shared by all embedding workers.
+
+    Every 429/5xx answer doubles the delay applied before the next request of
+    any worker (honouring Retry-After), and every success halves it again, so
+    the engine settles just below the rate the service accepts.
+    """
+
+    def __init__(self, base_delay=0.5, max_delay=60.0) -> None:
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self._not_before = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            sleep_for = self._not_before - time.monotonic()
+        if sleep_for > 0:
+            time.sleep(sleep_for)
+
+    def on_success(self):
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay > self.base_delay else 0.0
+
+    def on_throttle(self, retry_after=None):
+        with self._lock:
+            self.delay = min(self.max_delay, max(self.base_delay, self.delay * 2))
+            delay = max(self.delay, retry_after or 0.0)
+            delay = random.uniform(delay / 2, delay)
+            self._not_before = max(self._not_before, time.monotonic() + delay)
+
+
+class BatchEmbedder:
+    """
+    Embeds chunks in batched, concurrent requests to the embedding model.
+
+    Chunks are packed into requests of at most `max_batch_items` texts and
+    `max_batch_tokens` tokens. Up to `max_concurrency` requests run at the
+    same time, and results are returned in the order of the input chunks.
+    Chunks which cannot be embedded are returned as None.
+    """
+
+    def __init__(self,
+                 model="text-embedding-ada-002",
+                 max_batch_items=16,
+                 max_batch_tokens=8000,
+                 max_concurrency=4,
+                 max_retries=6,
+                 create_fn=None,
+                 encoding_name="cl100k_base"
+                 ) -> None:
+        self.model = model
+        self.max_batch_items = max_batch_items
+        self.max_batch_tokens = max_batch_tokens
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.create_fn = create_fn or default_create_fn
+        self.encoding = tiktoken.get_encoding(encoding_name)
+        self.backoff = AdaptiveBackoff()
+        self.embedded = 0
+        self.failed = 0
+        self.requests = 0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def batches(self, items, text_of=None):
+        """
+        Packs items into batches capped by the item and token limits.
+
+        Yields:
+            Lists of items to send in a single request.
+        """
+        batch, batch_tokens = [], 0
+        for item in items:
+            text = text_of(item) if text_of else item
+            tokens = len(self.encoding.encode(text, disallowed_special=()))
+            if batch and (len(batch) >= self.max_batch_items or batch_tokens + tokens > self.max_batch_tokens):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(item)
+            batch_tokens += tokens
+        if batch:
+            yield batch
+
+    def _request(self, texts):
+        for attempt in range(self.max_retries + 1):
+            self.backoff.wait()
+            with self._lock:
+                self.requests += 1
+            try:
+                vectors = self.create_fn(self.model, texts)
+                if len(vectors) != len(texts):
+                    raise ValueError(f"expected {len(texts)} embeddings, got {len(vectors)}")
+                self.backoff.on_success()
+                return vectors
+            except Exception as e:
+                if not _is_retryable(e) or attempt == self.max_retries:
+                    raise
+                self.backoff.on_throttle(_retry_after(e))
+
+    def _embed_batch(self, texts):
+        try:
+            return self._request(texts)
+        except Exception as e:
+            if len(texts) == 1 or _is_retryable(e):
+                # Retries are exhausted: re-sending every item alone would only add load to a throttled service
+                print(f"Error generating embedding of {len(texts)} chunks: {e}")
+                return [None] * len(texts)
+            # Retry item by item so that one bad chunk does not fail the whole batch
+            return [self._embed_batch([text])[0] for text in texts]
+
+    def embed_items(self, items, text_of=None):
+        """
+        Embeds an iterable of items lazily.
+
+        At most `max_concurrency * 2` batches are in flight, so the input can
+        be a generator over a corpus of any size.
+
+        Args:
+            items: Iterable of texts, or of records holding a text.
+            text_of: Function returning the text of a record.
+
+        Yields:
+            Tuples of item and its embedding (or None), in input order.
+        """
+        tic = time.perf_counter()
+        max_pending = self.max_concurrency * 2
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="embedding") as executor:
+                pending = deque()
+                batches = self.batches(items, text_of)
+                while True:
+                    while len(pending) < max_pending:
+                        batch = next(batches, None)
+                        if batch is None:
+                            break
+                        texts = [text_of(item) for item in batch] if text_of else batch
+                        pending.append((batch, executor.submit(self._embed_batch, texts)))
+                    if not pending:
+                        return
+                    batch, future = pending.popleft()
+                    for item, vector in zip(batch, future.result()):
+                        if vector is None:
+                            self.failed += 1
+                        else:
+                            self.embedded += 1
+                        yield item, vector
+        finally:
+            self.elapsed += time.perf_counter() - tic
+
+    def embed_stream(self, texts):
+        """
+        Embeds an iterable of texts lazily.
+
+        Yields:
+            One embedding (or None) per input text, in input order.
+        """
+        for _, vector in self.embed_items(texts):
+            yield vector
+
+    def embed(self, texts):
+        """
+        Embeds a list of texts.
+
+        Returns:
+            List of embeddings (or None) aligned with the input texts.
+        """
+        return list(self.embed_stream(texts))
+
+    @property
+    def chunks_per_sec(self):
+        return self.embedded / self.elapsed if self.elapsed else 0.0
+
+    def report(self):
+        return (f"{self.embedded} chunks embedded ({self.failed} failed) in {self.elapsed:.1f}s "
+                f"using {self.requests} requests: {self.chunks_per_sec:.1f} chunks/sec")
@@ -0,0 +1,225 @@
+import struct
+import time
+from array import array
+
+
+def encode_real_vector(vector):
+    """
+    Encodes an embedding in the binary REAL_VECTOR format of SAP HANA.
+
+    The format is the dimension as a 4-byte little-endian integer followed
+    by the values as little-endian float32, which hdbcli binds as is.
+    """
+    values = array('f', vector)
+    if struct.pack('=I', 1) != struct.pack('<I', 1):
+        values.byteswap()
+    return struct.pack('<I', len(values)) + values.tobytes()
+
+
+def decode_real_vector(data):
+    """
+    Decodes an embedding from the binary REAL_VECTOR format of SAP HANA.
+    """
+    (dimension,) = struct.unpack_from('<I', data)
+    values = array('f')
+    values.frombytes(bytes(data[4:4 + 4 * dimension]))
+    if struct.pack('=I', 1) != struct.pack('<I', 1):
+        values.byteswap()
+    return values.tolist()
+
+
+def vector_parameter(vector, binary=True):
+    """
+    Returns the bind parameter of an embedding for the chosen encoding.
+    """
+    return encode_real_vector(vector) if binary else str(vector)
+
+
+def vector_placeholder(binary=True):
+    """
+    Returns the SQL placeholder matching `vector_parameter`.
+    """
+    return "?" if binary else "TO_REAL_VECTOR(?)"
+
+
+def _row_size(row):
+    size = 0
+    for value in row:
+        if isinstance(value, (bytes, bytearray)):
+            size += len(value)
+        elif isinstance(value, str):
+            size += len(value.encode())
+        else:
+            size += 8
+    return size
+
+
+class HanaBulkLoader:
+    """
+    Loads rows into a HANA table in batches from a stream.
+
+    Rows are buffered until `batch_size` is reached, then inserted with one
+    `executemany` and committed. Statements registered with `defer` run in
+    the same transaction as the rows added before them, which keeps
+    bookkeeping such as manifest entries consistent with the loaded rows.
+    Their `on_commit` callbacks run only once that transaction is
+    committed, for side effects outside the database such as checkpoints.
+
+    A failed batch is rolled back and retried, reconnecting when the
+    connection was lost. A batch which keeps failing is split in halves to
+    isolate the bad rows, which are skipped and kept in `failed_rows`. Its
+    deferred statements then run after its rows, each on its own once they
+    fail together, so a failing statement is never blamed on a row.
+    """
+
+    def __init__(self,
+                 connect,
+                 sql_insert,
+                 batch_size=1000,
+                 max_retries=3,
+                 retry_delay=1.0
+                 ) -> None:
+        self.connect = connect
+        self.sql_insert = sql_insert
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.connection = connect()
+        self.connection.setautocommit(False)
+        self.rows = []
+        self.deferred = []
+        self.failed_rows = []
+        self.loaded = 0
+        self.bytes = 0
+        self.batches = 0
+        self.elapsed = 0.0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def defer(self, statement, on_commit=None):
+        """
+        Registers a callable taking a cursor, run when the current batch is committed,
+        and an optional callable without arguments, run once the statement is committed.
+        """
+        self.deferred.append((statement, on_commit))
+
+    def load(self, rows):
+        """
+        Loads a stream of rows and flushes the last batch.
+        """
+        for row in rows:
+            self.add(row)
+        self.flush()
+
+    def flush(self):
+        if not self.rows and not self.deferred:
+            return
+        rows, deferred = self.rows, self.deferred
+        self.rows, self.deferred = [], []
+        tic = time.perf_counter()
+        try:
+            self._load_batch(rows, deferred)
+        finally:
+            self.elapsed += time.perf_counter() - tic
+
+    def _load_batch(self, rows, deferred):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._execute(rows, deferred)
+                self.loaded += len(rows)
+                self.bytes += sum(_row_size(row) for row in rows)
+                self.batches += 1
+                return
+            except Exception as e:
+                error = e
+                # Only a lost connection is worth retrying the same batch
+                if not self._recover() or attempt == self.max_retries:
+                    break
+                time.sleep(self.retry_delay * 2 ** attempt)
+        if deferred:
+            # Load the rows without the deferred statements, which may be the ones failing
+            if rows:
+                self._load_batch(rows, [])
+            self._load_deferred(deferred)
+            return
+        if len(rows) <= 1:
+            print(f"Error inserting row: {error}")
+            self.failed_rows.extend(rows)
+            return
+        # The batch keeps failing: isolate the bad rows
+        middle = len(rows) // 2
+        self._load_batch(rows[:middle], [])
+        self._load_batch(rows[middle:], [])
+
+    def _load_deferred(self, deferred):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._execute([], deferred)
+                return
+            except Exception as e:
+                error = e
+                if not self._recover() or attempt == self.max_retries:
+                    break
+                time.sleep(self.retry_delay * 2 ** attempt)
+        if len(deferred) > 1:
+            # Isolate the failing statements, the others still run
+            for statement in deferred:
+                self._load_deferred([statement])
+            return
+        print(f"Error running deferred statement: {error}")
+
+    def _execute(self, rows, deferred):
+        cursor = self.connection.cursor()
+        try:
+            if rows:
+                cursor.executemany(self.sql_insert, rows)
+            for statement, _ in deferred:
+                statement(cursor)
+            self.connection.commit()
+        finally:
+            cursor.close()
+        # Committed: a failing callback must not retry the batch
+        for _, on_commit in deferred:
+            if on_commit:
+                try:
+                    on_commit()
+                except Exception as e:
+                    print(f"Error running the callback of a deferred statement: {e}")
+
+    def _recover(self):
+        """
+        Rolls back the failed transaction, reconnecting if the connection was lost.
+
+        Returns:
+            True if the connection was lost.
+        """
+        try:
+            if self.connection.isconnected():
+                self.connection.rollback()
+                return False
+        except Exception:
+            pass
+        print("Connection to HANA lost, reconnecting")
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+        try:
+            self.connection = self.connect()
+            self.connection.setautocommit(False)
+        except Exception as e:
+            print(f"Error reconnecting to HANA: {e}")
+        return True
+
+    def report(self):
+        rate = self.loaded / self.elapsed if self.elapsed else 0.0
+        throughput = self.bytes / 1024 / 1024 / self.elapsed if self.elapsed else 0.0
+        return (f"{self.loaded} rows loaded in {self.batches} batches ({len(self.failed_rows)} failed) "
+                f"in {self.elapsed:.1f}s: {rate:.1f} rows/sec, {throughput:.2f} MB/sec")
+
+    def close(self):
+        self.flush()
+        self.connection.close()
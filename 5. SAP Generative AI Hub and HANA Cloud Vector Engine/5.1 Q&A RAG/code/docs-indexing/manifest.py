@@ -0,0 +1,139 @@
+import hashlib
+
+
+def chunk_hash(text):
+    """
+    Returns the sha256 hex digest identifying a chunk of text.
+    """
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def manifest_table_name(table_name):
+    """
+    Returns the name of the manifest table kept next to a document table.
+    """
+    return f"{table_name}_MANIFEST"
+
+
+def table_exists(cursor, table_name):
+    """
+    Checks whether a table exists in the current schema.
+    """
+    cursor.execute("SELECT COUNT(*) FROM M_TABLES WHERE TABLE_NAME = ?", (table_name.upper(),))
+    return cursor.fetchone()[0] > 0
+
+
+def create_tables(cursor, table_name):
+    """
+    Creates the document table and its manifest table.
+
+    Each document row carries the sha256 of its chunk, so that a changed
+    document can be diffed against the chunks already indexed for it.
+    The manifest table records the S3 ETag of every indexed document.
+    """
+    cursor.execute(f"""
+        CREATE COLUMN TABLE {table_name} (
+            ID BIGINT,
+            TITLE NVARCHAR(1024),
+            PAGE_NUMBER NVARCHAR(5),
+            URL NVARCHAR(1024),
+            TEXT NCLOB,
+            VECTOR_STR REAL_VECTOR,
+            CHUNK_HASH NVARCHAR(64)
+        )
+    """)
+    cursor.execute(f"""
+        CREATE COLUMN TABLE {manifest_table_name(table_name)} (
+            S3_KEY NVARCHAR(1024) PRIMARY KEY,
+            ETAG NVARCHAR(128),
+            CHUNK_COUNT INTEGER,
+            INDEXED_AT TIMESTAMP
+        )
+    """)
+
+
+def drop_tables(cursor, table_name):
+    """
+    Drops the document table and its manifest table if they exist.
+    """
+    for name in (table_name, manifest_table_name(table_name)):
+        if table_exists(cursor, name):
+            print(f"table is already existed, deleting the table {name}")
+            cursor.execute(f"DROP TABLE {name}")
+
+
+def load_manifest(cursor, table_name):
+    """
+    Loads the manifest of indexed documents.
+
+    Returns:
+        Dict mapping S3 key to the ETag it was indexed with.
+    """
+    cursor.execute(f"SELECT S3_KEY, ETAG FROM {manifest_table_name(table_name)}")
+    return {key: etag for key, etag in cursor.fetchall()}
+
+
+def load_chunk_hashes(cursor, table_name, key):
+    """
+    Returns the set of chunk hashes currently indexed for a document.
+    """
+    cursor.execute(f"SELECT DISTINCT CHUNK_HASH FROM {table_name} WHERE URL = ?", (key,))
+    return {row[0] for row in cursor.fetchall()}
+
+
+def next_row_id(cursor, table_name):
+    """
+    Returns the first free row ID of the document table.
+    """
+    cursor.execute(f"SELECT COALESCE(MAX(ID), 0) FROM {table_name}")
+    return cursor.fetchone()[0] + 1
+
+
+def plan_changes(objects, manifest):
+    """
+    Compares the S3 listing with the manifest.
+
+    Args:
+        objects: Iterable of S3 object summaries currently in the bucket.
+        manifest (dict): S3 key to ETag of indexed documents.
+
+    Returns:
+        Tuple of the new or changed object summaries and the removed keys.
+    """
+    changed = []
+    listed = set()
+    for obj in objects:
+        listed.add(obj['Key'])
+        if manifest.get(obj['Key']) != obj['ETag']:
+            changed.append(obj)
+    removed = sorted(set(manifest) - listed)
+    return changed, removed
+
+
+def delete_chunks(cursor, table_name, key, hashes):
+    """
+    Deletes the rows of the given chunk hashes of a document.
+    """
+    cursor.executemany(
+        f"DELETE FROM {table_name} WHERE URL = ? AND CHUNK_HASH = ?",
+        [(key, h) for h in hashes]
+    )
+
+
+def delete_document(cursor, table_name, key):
+    """
+    Deletes all rows and the manifest entry of a removed document.
+    """
+    cursor.execute(f"DELETE FROM {table_name} WHERE URL = ?", (key,))
+    cursor.execute(f"DELETE FROM {manifest_table_name(table_name)} WHERE S3_KEY = ?", (key,))
+
+
+def upsert_manifest_entry(cursor, table_name, key, etag, chunk_count):
+    """
+    Records that a document has been indexed with the given ETag.
+    """
+    cursor.execute(
+        f"UPSERT {manifest_table_name(table_name)} (S3_KEY, ETAG, CHUNK_COUNT, INDEXED_AT) "
+        f"VALUES (?, ?, ?, CURRENT_UTCTIMESTAMP) WITH PRIMARY KEY",
+        (key, etag, chunk_count)
+    )
@@ -0,0 +1,291 @@
+import html
+import re
+from html.parser import HTMLParser
+
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+PRESERVE_WHITESPACE_TAGS = {"pre", "textarea"}
+VOID_TAGS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link",
+    "menuitem", "meta", "param", "source", "spacer", "track", "wbr", "basefont",
+    "bgsound", "command", "frame", "image", "isindex", "nextid"
+}
+CDATA_CONTENT_TAGS = {"script", "style"}
+FEED_SIZE = 1024 * 1024
+
+# Tokens of well-formed XHTML as written by Tika: start/end tags with quoted
+# attributes, processing instructions, text, and terminated entity references
+XHTML_TOKEN = re.compile(
+    r"<([a-zA-Z][-.a-zA-Z0-9:_]*)((?:\s+[a-zA-Z_:][-.a-zA-Z0-9:_]*\s*=\s*(?:\"[^\"]*\"|'[^']*'))*)\s*(/?)>"
+    r"|</([a-zA-Z][-.a-zA-Z0-9:_]*)\s*>"
+    r"|((?:[^<&]+|&(?:#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);)+)"
+    r"|<\?[^>]*>"
+)
+XHTML_REFERENCE = re.compile(r"&(#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);")
+XHTML_ATTRIBUTE = re.compile(r"([a-zA-Z_:][-.a-zA-Z0-9:_]*)\s*=\s*(?:\"([^\"]*)\"|'([^']*)')")
+
+
+class UnsupportedMarkup(Exception):
+    """
+    Raised by the fast tokenizer on markup it leaves to `html.parser`.
+    """
+
+
+def pre_process_text(text_data):
+    """
+    Cleans text by removing HTML tags and entities.
+    """
+    return re.sub(r"<[^>]*>|&\w+;", "", text_data)
+
+
+def decode_entityref(name):
+    """
+    Decodes a named reference like BeautifulSoup: unknown names stay literal.
+    """
+    character = html.entities.html5.get(name + ";")
+    return character if character is not None else "&" + name
+
+
+def decode_charref(name):
+    """
+    Decodes a numeric reference, e.g. "#233" or "#xE9" without the "#".
+    """
+    return html.unescape(f"&#{name};")
+
+
+def decode_reference(match):
+    reference = match.group(1)
+    if reference.startswith("#"):
+        return decode_charref(reference[1:])
+    return decode_entityref(reference)
+
+
+class PageTextParser(HTMLParser):
+    """
+    Streaming parser collecting the text of the page divs of Tika XHTML.
+
+    It reproduces the page texts of `find_all("div", class_="page")` on a
+    BeautifulSoup `html.parser` tree followed by `pre_process_text(str(page))`,
+    without building the tree or serializing the pages again: tags are
+    tracked on a stack of names only, text is collected per page, and the
+    characters which the serializer would have escaped (and the regex would
+    then have removed) are dropped.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=False)
+        self.stack = []
+        self.text = []
+        self.pages = []
+        self.open_pages = []
+        self.emitted = 0
+        self.preserve_whitespace = 0
+        self.closed_void_tags = []
+
+    def flush_text(self):
+        if not self.text:
+            return
+        text = "".join(self.text)
+        self.text = []
+        if not self.open_pages:
+            return
+        if not self.preserve_whitespace and not text.strip(ASCII_SPACES):
+            text = "\n" if "\n" in text else " "
+        # The serializer escapes these characters, and the regex of
+        # `pre_process_text` then removes them together with the entity
+        self.append(text.replace("&", "").replace("<", "").replace(">", ""))
+
+    def append(self, text):
+        for page in self.open_pages:
+            self.pages[page].append(text)
+
+    def handle_starttag(self, tag, attrs, closed=True):
+        self.flush_text()
+        if tag in VOID_TAGS:
+            if closed:
+                # A later explicit end tag of this void element is ignored
+                self.closed_void_tags.append(tag)
+            return
+        page = None
+        if tag == "div":
+            classes = dict((key, value or "") for key, value in attrs).get("class", "")
+            if "page" in classes.split():
+                page = len(self.pages)
+                self.pages.append([])
+                self.open_pages.append(page)
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace += 1
+        self.stack.append((tag, page))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, closed=False)
+        self.handle_endtag(tag, check_closed=False)
+
+    def handle_endtag(self, tag, check_closed=True):
+        if check_closed and tag in self.closed_void_tags:
+            self.closed_void_tags.remove(tag)
+            return
+        self.flush_text()
+        if not any(name == tag for name, _ in self.stack):
+            return
+        while True:
+            name, page = self.stack.pop()
+            if name in PRESERVE_WHITESPACE_TAGS:
+                self.preserve_whitespace -= 1
+            if page is not None:
+                self.open_pages.remove(page)
+            if name == tag:
+                break
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+    def handle_entityref(self, name):
+        self.text.append(decode_entityref(name))
+
+    def handle_charref(self, name):
+        self.text.append(decode_charref(name))
+
+    def handle_comment(self, data):
+        self.flush_text()
+        self.append(pre_process_text(f"<!--{data}-->"))
+
+    def handle_decl(self, decl):
+        self.flush_text()
+
+    def handle_pi(self, data):
+        self.flush_text()
+
+    def unknown_decl(self, data):
+        self.flush_text()
+        if data.upper().startswith("CDATA["):
+            self.append(pre_process_text(f"<![CDATA[{data[len('CDATA['):]}]]>"))
+
+    def completed_pages(self):
+        """
+        Returns the texts of pages completed since the last call, in document order.
+        """
+        completed = []
+        while self.emitted < len(self.pages) and self.emitted not in self.open_pages:
+            completed.append("".join(self.pages[self.emitted]))
+            self.pages[self.emitted] = None
+            self.emitted += 1
+        return completed
+
+    def close(self):
+        super().close()
+        self.flush_text()
+        self.open_pages = []
+
+
+def scan_pages(parser, file_content):
+    """
+    Drives the parser with a regex tokenizer for well-formed Tika XHTML.
+
+    This is several times faster than `html.parser`, which remains the
+    reference: any markup outside the tokens above raises
+    `UnsupportedMarkup`.
+
+    Yields:
+        The cleaned text of every page div, in document order.
+    """
+    match = XHTML_TOKEN.match
+    pos, end = 0, len(file_content)
+    while pos < end:
+        token = match(file_content, pos)
+        if token is None:
+            raise UnsupportedMarkup(file_content[pos:pos + 20])
+        pos = token.end()
+        start_tag, attributes, self_closing, end_tag, text = token.groups()
+        if text is not None:
+            parser.handle_data(XHTML_REFERENCE.sub(decode_reference, text) if "&" in text else text)
+        elif start_tag is not None:
+            tag = start_tag.lower()
+            if tag in CDATA_CONTENT_TAGS:
+                raise UnsupportedMarkup(tag)
+            attrs = [
+                (name.lower(), html.unescape(double or single))
+                for name, double, single in XHTML_ATTRIBUTE.findall(attributes)
+            ] if attributes else []
+            if self_closing:
+                parser.handle_startendtag(tag, attrs)
+            else:
+                parser.handle_starttag(tag, attrs)
+        elif end_tag is not None:
+            parser.handle_endtag(end_tag.lower())
+            yield from parser.completed_pages()
+        else:
+            parser.handle_pi(token.group()[2:-1])
+    parser.flush_text()
+    parser.open_pages = []
+    yield from parser.completed_pages()
+
+
+def parse_pages(file_content, feed_size=FEED_SIZE):
+    """
+    Parses XHTML incrementally with `html.parser`.
+
+    Yields:
+        The cleaned text of every page div, in document order.
+    """
+    parser = PageTextParser()
+    for start in range(0, len(file_content or ""), feed_size):
+        parser.feed(file_content[start:start + feed_size])
+        yield from parser.completed_pages()
+    parser.close()
+    yield from parser.completed_pages()
+
+
+def iter_pages(file_content):
+    """
+    Extracts the page texts of Tika XHTML without building a document tree.
+
+    Documents are scanned with the fast tokenizer. If it meets markup it does
+    not support, parsing continues with `html.parser`, skipping the pages
+    which were already yielded.
+
+    Yields:
+        The cleaned text of every page div, in document order.
+    """
+    yielded = 0
+    try:
+        for page in scan_pages(PageTextParser(), file_content or ""):
+            yielded += 1
+            yield page
+        return
+    except UnsupportedMarkup:
+        pass
+    for number, page in enumerate(parse_pages(file_content)):
+        if number >= yielded:
+            yield page
+
+
+def extract_pdf_metadata_page(file_content, metadata, file_name):
+    """
+    Extracts metadata and content of a PDF file.
+    """
+    pages = list(iter_pages(file_content))
+    total_pages = len(pages)
+
+    metadata_fields = {
+        "total_pages": metadata.get('meta:page-count', total_pages),
+        "title": metadata.get('pdf:docinfo:title', ""),
+        "keywords": metadata.get('pdf:docinfo:keywords', ""),
+        "create_date": metadata.get('xmp:CreateDate', ""),
+        "modify_date": metadata.get('xmp:ModifyDate', "")
+    }
+
+    doc_list = []
+    for page_num, page_content in enumerate(pages, start=1):
+        doc = {
+            "file_name": file_name,
+            "total_pages": metadata_fields["total_pages"],
+            "keywords": metadata_fields["keywords"],
+            "create_date": metadata_fields["create_date"],
+            "modify_date": metadata_fields["modify_date"],
+            "page_content": page_content,
+            "page_number": page_num,
+            "content_length": len(page_content)
+        }
+        doc_list.append(doc)
+
+    return doc_list
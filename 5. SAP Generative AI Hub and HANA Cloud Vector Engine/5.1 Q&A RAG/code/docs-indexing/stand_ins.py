@@ -0,0 +1,320 @@
+"""
+Local stand-ins for the services used by the indexer.
+
+They let the indexing pipeline run offline, e.g. in `benchmark_indexing.py`:
+
+- `LocalS3Client`: a directory served through the subset of the boto3 S3
+  client API used by the indexer.
+- `passthrough_parse`: a replacement of Tika for files which already hold
+  Tika XHTML, as written by `write_synthetic_corpus`.
+- `FakeEmbeddingProvider`: deterministic embeddings with configurable latency.
+- `FakeHanaDatabase`: an in-memory HANA which records the statements it runs.
+"""
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from benchmark_page_extractor import synthetic_xhtml
+from hana_loader import decode_real_vector
+
+
+class LocalS3Client:
+    """
+    Serves the files below a directory like objects of an S3 bucket.
+    """
+
+    def __init__(self, root, page_size=1000, latency=0.0) -> None:
+        self.root = root
+        self.page_size = page_size
+        self.latency = latency
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, Bucket, Prefix=""):
+        keys = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, "/")
+                if key.startswith(Prefix or ""):
+                    keys.append(key)
+        keys.sort()
+        for start in range(0, len(keys), self.page_size):
+            contents = []
+            for key in keys[start:start + self.page_size]:
+                stat = os.stat(os.path.join(self.root, key))
+                contents.append({
+                    "Key": key,
+                    "ETag": f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"',
+                    "Size": stat.st_size
+                })
+            yield {"Contents": contents}
+
+    def get_object(self, Bucket, Key):
+        if self.latency:
+            time.sleep(self.latency)
+        with open(os.path.join(self.root, Key), "rb") as f:
+            return {"Body": io.BytesIO(f.read())}
+
+
+def passthrough_parse(file_content):
+    """
+    Stands in for Tika on files which already contain Tika XHTML.
+    """
+    content = file_content.decode("utf-8")
+    return content, {"meta:page-count": str(content.count('<div class="page">'))}
+
+
+def write_synthetic_corpus(root, documents, pages, paragraphs=12, copies=0.0, seed=0):
+    """
+    Writes synthetic documents of Tika XHTML named like PDFs.
+
+    A share `copies` of the documents are copies of earlier ones, like the
+    same manual stored in several folders, so the corpus contains duplicate
+    chunks.
+
+    Returns:
+        Total size of the corpus in bytes.
+    """
+    os.makedirs(root, exist_ok=True)
+    rng = random.Random(seed)
+    size = 0
+    for number in range(documents):
+        original = rng.randrange(number) if number and rng.random() < copies else number
+        data = synthetic_xhtml(pages, paragraphs=paragraphs, seed=seed + original).encode("utf-8")
+        with open(os.path.join(root, f"doc-{number:06d}.pdf"), "wb") as f:
+            f.write(data)
+        size += len(data)
+    return size
+
+
+class FakeEmbeddingProvider:
+    """
+    Deterministic embedding model with configurable latency.
+
+    Embeddings are unit vectors seeded by the sha256 of the text, so equal
+    texts get equal vectors. Every request sleeps `latency` seconds plus
+    `per_item_latency` seconds per text, with uniform `jitter`, and every
+    `throttle_every`-th request fails with a 429 to exercise the back-off.
+    """
+
+    def __init__(self, dimension=1536, latency=0.0, per_item_latency=0.0, jitter=0.0, throttle_every=0) -> None:
+        self.dimension = dimension
+        self.latency = latency
+        self.per_item_latency = per_item_latency
+        self.jitter = jitter
+        self.throttle_every = throttle_every
+        self.requests = 0
+        self.items = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def embed(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dimension).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def __call__(self, model, texts):
+        with self._lock:
+            self.requests += 1
+            throttled = self.throttle_every and self.requests % self.throttle_every == 0
+        delay = self.latency + self.per_item_latency * len(texts)
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if throttled:
+            with self._lock:
+                self.throttled += 1
+            raise FakeThrottleError()
+        with self._lock:
+            self.items += len(texts)
+        return [self.embed(text) for text in texts]
+
+
+class FakeThrottleError(Exception):
+    status_code = 429
+
+
+def _vector(parameter):
+    # Vectors are bound in the binary REAL_VECTOR format or as text
+    if isinstance(parameter, (bytes, bytearray, memoryview)):
+        return np.array(decode_real_vector(parameter))
+    return np.array(json.loads(parameter) if isinstance(parameter, str) else parameter, dtype=np.float64)
+
+
+class FakeHanaDatabase:
+    """
+    In-memory stand-in of the HANA tables written by the indexer.
+
+    It understands the statements of `manifest.py`, the row inserts of
+    the loader, and the vector index statements of `vector_index.py`,
+    keeps only row IDs, URLs, and chunk hashes, and counts the statements
+    and rows it receives. `batch_latency` and `row_latency` simulate the
+    round trip and server time of every `executemany`.
+
+    With `record`, it also keeps the vectors, answering top-k searches by
+    an exact scan, and records every statement with its parameters in
+    `executed`, so the SQL sent by the indexer can be checked.
+    """
+
+    def __init__(self, batch_latency=0.0, row_latency=0.0, record=False) -> None:
+        self.batch_latency = batch_latency
+        self.row_latency = row_latency
+        self.record = record
+        self.executed = []
+        self.vectors = {}
+        self.indexes = {}
+        self.tables = set()
+        self.rows = defaultdict(dict)
+        self.manifest = {}
+        self.max_id = 0
+        self.statements = Counter()
+        self.rows_inserted = 0
+        self.commits = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        with self._lock:
+            self.connections += 1
+        return FakeHanaConnection(self)
+
+
+class FakeHanaConnection:
+    def __init__(self, database) -> None:
+        self.database = database
+        self.connected = True
+
+    def cursor(self):
+        return FakeHanaCursor(self.database)
+
+    def setautocommit(self, autocommit):
+        pass
+
+    def commit(self):
+        self.database.commits += 1
+
+    def rollback(self):
+        pass
+
+    def isconnected(self):
+        return self.connected
+
+    def close(self):
+        self.connected = False
+
+
+class FakeHanaCursor:
+    """
+    Cursor recording the statements run against a `FakeHanaDatabase`.
+    """
+
+    def __init__(self, database) -> None:
+        self.database = database
+        self.result = []
+
+    def execute(self, sql, parameters=()):
+        self.run(sql, [parameters or ()])
+
+    def executemany(self, sql, rows):
+        db = self.database
+        delay = db.batch_latency + db.row_latency * len(rows)
+        if delay:
+            time.sleep(delay)
+        self.run(sql, rows)
+
+    def run(self, sql, rows):
+        db = self.database
+        statement = " ".join(sql.split())
+        db.statements[" ".join(statement.split()[:2]).upper()] += len(rows)
+        self.result = []
+        with db._lock:
+            if db.record:
+                db.executed.append((statement, rows[0] if len(rows) == 1 else rows))
+            if statement.startswith("SELECT COUNT(*) FROM M_TABLES"):
+                self.result = [(int(rows[0][0] in db.tables),)]
+            elif statement.startswith("SELECT INDEX_NAME FROM SYS.INDEXES"):
+                table_name, pattern = rows[0]
+                prefix = pattern.replace("\\", "").rstrip("%")
+                self.result = [(name,) for name, table in db.indexes.items()
+                               if table == table_name and name.startswith(prefix)]
+            elif statement.startswith("CREATE HNSW VECTOR INDEX"):
+                name, table_name = re.match(r"CREATE HNSW VECTOR INDEX (\S+) ON (\S+)", statement).groups()
+                db.indexes[name] = table_name.upper()
+            elif statement.startswith("DROP INDEX"):
+                del db.indexes[statement.split()[2]]
+            elif statement.startswith("CREATE"):
+                db.tables.add(re.search(r"TABLE (\S+)", statement).group(1).upper())
+            elif statement.startswith("DROP TABLE"):
+                name = statement.split()[2].upper()
+                db.tables.discard(name)
+                if name.endswith("_MANIFEST"):
+                    db.manifest.clear()
+                else:
+                    db.rows.clear()
+            elif statement.startswith("SELECT S3_KEY, ETAG"):
+                self.result = list(db.manifest.items())
+            elif statement.startswith("SELECT DISTINCT CHUNK_HASH"):
+                self.result = [(h,) for h in db.rows.get(rows[0][0], {})]
+            elif statement.startswith("SELECT COALESCE(MAX(ID)"):
+                self.result = [(db.max_id,)]
+            elif statement.startswith("INSERT INTO"):
+                for row in rows:
+                    db.rows[row[3]][row[6]] = row[0]
+                    db.max_id = max(db.max_id, row[0])
+                    if db.record:
+                        db.vectors[row[0]] = _vector(row[5])
+                db.rows_inserted += len(rows)
+            elif statement.startswith("UPSERT"):
+                for key, etag, _ in rows:
+                    db.manifest[key] = etag
+            elif "_MANIFEST WHERE S3_KEY" in statement:
+                for (key,) in rows:
+                    db.manifest.pop(key, None)
+            elif "WHERE URL = ? AND CHUNK_HASH = ?" in statement:
+                for key, h in rows:
+                    db.rows.get(key, {}).pop(h, None)
+            elif "WHERE URL = ?" in statement and statement.startswith("DELETE"):
+                for (key,) in rows:
+                    db.rows.pop(key, None)
+            elif statement.startswith("SELECT TOP") and statement.endswith("ORDER BY RAND()"):
+                ids = self._ids()
+                size = min(int(statement.split()[2]), len(ids))
+                self.result = [(db.vectors[i],) for i in random.sample(ids, size)]
+            elif statement.startswith("SELECT TOP") and "TO_REAL_VECTOR(?)" in statement:
+                self.result = self._top_k(statement, _vector(rows[0][0]))
+
+    def _ids(self):
+        return sorted(i for hashes in self.database.rows.values() for i in hashes.values()
+                      if i in self.database.vectors)
+
+    def _top_k(self, statement, query):
+        # Exact scan, whether the statement asks for the index or not
+        k, metric = re.match(r"SELECT TOP (\d+) ID FROM \S+ ORDER BY (\w+)\(", statement).groups()
+        ids = self._ids()
+        if not ids:
+            return []
+        vectors = np.array([self.database.vectors[i] for i in ids])
+        if metric == "COSINE_SIMILARITY":
+            scores = -(vectors @ query) / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query))
+        else:
+            scores = np.linalg.norm(vectors - query, axis=1)
+        return [(ids[i],) for i in np.argsort(scores, kind="stable")[:int(k)]]
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def fetchall(self):
+        return self.result
+
+    def close(self):
+        pass
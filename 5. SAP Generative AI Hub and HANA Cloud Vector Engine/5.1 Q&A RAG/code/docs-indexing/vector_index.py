@@ -0,0 +1,169 @@
+import hashlib
+import json
+
+from hana_loader import decode_real_vector, vector_parameter
+
+VECTOR_COLUMN = "VECTOR_STR"
+
+# Sort order of the nearest neighbours for every similarity function
+METRIC_SORT_ORDERS = {
+    "COSINE_SIMILARITY": "DESC",
+    "L2DISTANCE": "ASC"
+}
+
+MAX_K = 1000
+
+DEFAULT_BUILD_CONFIGURATION = {"M": 64, "efConstruction": 128}
+DEFAULT_SEARCH_CONFIGURATION = {"efSearch": 400}
+
+# Makes HANA run an exact search even if the table has a vector index
+EXACT_SEARCH_HINT = "WITH HINT(NO_VECTOR_INDEX)"
+
+
+def sort_order(metric):
+    """
+    Returns the ORDER BY direction ranking the nearest neighbours first.
+    """
+    try:
+        return METRIC_SORT_ORDERS[metric]
+    except KeyError:
+        raise ValueError(f"Unsupported similarity function {metric}, use one of {', '.join(METRIC_SORT_ORDERS)}")
+
+
+def vector_index_name(table_name, metric, build_configuration, search_configuration):
+    """
+    Returns the name of the HNSW index of a table for a configuration.
+
+    The name ends with a digest of the configuration, so an index built with
+    other parameters (or another similarity function) is recognized as stale.
+    """
+    configuration = json.dumps([metric, build_configuration, search_configuration], sort_keys=True)
+    return f"{table_name}_HNSW_{hashlib.sha256(configuration.encode()).hexdigest()[:8]}".upper()
+
+
+def create_vector_index_sql(table_name, index_name, metric, build_configuration, search_configuration, online=True):
+    """
+    Returns the DDL of an HNSW vector index on the vector column of a table.
+    """
+    sort_order(metric)
+    return (
+        f"CREATE HNSW VECTOR INDEX {index_name} ON {table_name} ({VECTOR_COLUMN}) "
+        f"SIMILARITY FUNCTION {metric} "
+        f"BUILD CONFIGURATION '{json.dumps(build_configuration)}' "
+        f"SEARCH CONFIGURATION '{json.dumps(search_configuration)}'"
+        + (" ONLINE" if online else "")
+    )
+
+
+def _escape_like(value):
+    # Underscores of table names would match any character in a LIKE pattern
+    return value.replace("\\", "\\\\").replace("_", "\\_").replace("%", "\\%")
+
+
+def list_vector_indexes(cursor, table_name):
+    """
+    Returns the names of the HNSW indexes created by the indexer on a table.
+    """
+    cursor.execute(
+        "SELECT INDEX_NAME FROM SYS.INDEXES "
+        "WHERE SCHEMA_NAME = CURRENT_SCHEMA AND TABLE_NAME = ? AND INDEX_NAME LIKE ? ESCAPE '\\'",
+        (table_name.upper(), f"{_escape_like(table_name.upper())}\\_HNSW\\_%")
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def ensure_vector_index(cursor, table_name, metric, build_configuration=None, search_configuration=None):
+    """
+    Makes sure the table has an HNSW index of the given configuration.
+
+    Indexes of another configuration are dropped. A missing index is built
+    online, so the table stays searchable while it is built. Once built,
+    HANA maintains the index as rows are inserted and deleted.
+
+    Returns:
+        Tuple of the index name and whether it was created.
+    """
+    # Checked before any index is dropped
+    sort_order(metric)
+    build_configuration = build_configuration or DEFAULT_BUILD_CONFIGURATION
+    search_configuration = search_configuration or DEFAULT_SEARCH_CONFIGURATION
+    index_name = vector_index_name(table_name, metric, build_configuration, search_configuration)
+    existing = list_vector_indexes(cursor, table_name)
+    for name in existing:
+        if name != index_name:
+            print(f"Dropping vector index {name} of another configuration")
+            cursor.execute(f"DROP INDEX {name}")
+    if index_name in existing:
+        return index_name, False
+    print(f"Creating vector index {index_name}")
+    cursor.execute(create_vector_index_sql(table_name, index_name, metric, build_configuration, search_configuration))
+    return index_name, True
+
+
+def drop_vector_indexes(cursor, table_name):
+    """
+    Drops the HNSW indexes created by the indexer on a table.
+    """
+    for name in list_vector_indexes(cursor, table_name):
+        cursor.execute(f"DROP INDEX {name}")
+
+
+def vector_search_sql(table_name, metric, k, exact=False, columns="ID"):
+    """
+    Returns a top-k query taking the query vector as parameter.
+
+    The vector is bound in the binary or the text format (see
+    `vector_parameter`), never pasted into the statement, so all queries of
+    the same options share one statement text and plan. The approximate
+    query has the shape HANA answers from an HNSW index of the same
+    similarity function: TOP k ordered by the similarity to a bound vector.
+    The exact one is forced to scan the table.
+    """
+    if isinstance(k, bool) or not isinstance(k, int) or not 1 <= k <= MAX_K:
+        raise ValueError(f"k must be an integer between 1 and {MAX_K}, got {k!r}")
+    sql = (f"SELECT TOP {k} {columns} FROM {table_name} "
+           f"ORDER BY {metric}({VECTOR_COLUMN}, TO_REAL_VECTOR(?)) {sort_order(metric)}")
+    return f"{sql} {EXACT_SEARCH_HINT}" if exact else sql
+
+
+def sample_query_vectors(cursor, table_name, size):
+    """
+    Samples stored vectors of a table to use as queries.
+    """
+    cursor.execute(f"SELECT TOP {int(size)} {VECTOR_COLUMN} FROM {table_name} ORDER BY RAND()")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _query_parameter(vector, binary):
+    # hdbcli returns REAL_VECTOR values as lists, or in the binary format
+    if isinstance(vector, (bytes, bytearray, memoryview)):
+        vector = decode_real_vector(vector)
+    return vector_parameter(list(vector), binary)
+
+
+def measure_recall(cursor, table_name, metric, k=4, queries=20, binary=True):
+    """
+    Measures the recall@k of the approximate search against the exact search.
+
+    Stored vectors sampled from the table serve as queries, so no embedding
+    model is needed. Each query finds itself in both searches, which biases
+    the recall upwards by at most 1/k.
+
+    Returns:
+        Mean recall@k over the sampled queries, or None if the table is empty.
+    """
+    vectors = sample_query_vectors(cursor, table_name, queries)
+    if not vectors:
+        return None
+    approximate_sql = vector_search_sql(table_name, metric, k)
+    exact_sql = vector_search_sql(table_name, metric, k, exact=True)
+    recalls = []
+    for vector in vectors:
+        parameter = _query_parameter(vector, binary)
+        cursor.execute(exact_sql, (parameter,))
+        exact = {row[0] for row in cursor.fetchall()}
+        cursor.execute(approximate_sql, (parameter,))
+        approximate = {row[0] for row in cursor.fetchall()}
+        if exact:
+            recalls.append(len(exact & approximate) / len(exact))
+    return sum(recalls) / len(recalls) if recalls else None
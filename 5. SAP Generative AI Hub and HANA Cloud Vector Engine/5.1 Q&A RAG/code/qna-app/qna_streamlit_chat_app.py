@@ -1,6 +1,7 @@
 import streamlit as st
 from pydantic import BaseModel
 import requests
+import json
 import uuid
 import os
 from ai_core_sdk.ai_core_v2_client import AICoreV2Client
@@ -12,6 +13,9 @@ load_dotenv()
 # Set up configuration variables
 aicore_resource_group = os.getenv('RESOURCE_GROUP') or "default"
 backend_url = os.getenv('DEPLOYMENT_URL') + '/v2/generate'
+stream_url = os.getenv('DEPLOYMENT_URL') + '/v2/generate/stream'
+# Render the answers as they are generated, unless STREAMING is set to false
+streaming = (os.getenv('STREAMING') or "true").lower() == "true"
 
 # Initialize the AI Core API client
 ai_core_client = AICoreV2Client(
@@ -66,6 +70,41 @@ def get_response(prompt):
         st.error(f"Error fetching response: {e}")
         return "Error retrieving response.", [], ""
 
+# Function to call the streaming backend API and yield the response as it is generated
+def stream_response(prompt, metadata):
+    """
+    Send a query to the streaming backend and yield the bot's response text as it arrives.
+    The associated documents and the timings are stored in `metadata` when received.
+    """
+    try:
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream",
+            "Authorization": ai_core_client.rest_client.get_token(),
+            "AI-Resource-Group": aicore_resource_group
+        }
+        data = {"query": prompt}
+        with requests.post(stream_url, headers=headers, json=data, stream=True) as response:
+            response.raise_for_status()
+            event = None
+            # chunk_size=None hands over every server-sent event as soon as it arrives
+            for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    payload = json.loads(line[len("data:"):])
+                    if event == "token":
+                        yield payload["text"]
+                    elif event == "metadata":
+                        metadata["documents"] = payload.get("documents", [])
+                    elif event == "done":
+                        metadata["timings"] = payload
+                    elif event == "error":
+                        st.error(f"Error generating response: {payload.get('detail')}")
+    except requests.RequestException as e:
+        st.error(f"Error fetching response: {e}")
+        yield "Error retrieving response."
+
 # Function to toggle the visibility of documents for a specific message
 def toggle_document_visibility(id):
     """
@@ -137,7 +176,15 @@ if user_input:
     user_msg = MsgEntry(id=str(uuid.uuid4()), role="user", text=user_input)
     render_message(user_msg, save=True)
 
-    # Fetch and display the bot's response
-    bot_text, documents, log_id = get_response(user_input)
-    bot_msg = MsgEntry(id=str(uuid.uuid4()), role="assistant", text=bot_text, documents=documents, log_id=log_id)
-    render_message(bot_msg, save=True)
+    if streaming:
+        # Display the bot's response as it is generated, then save it
+        metadata = {}
+        with st.chat_message("assistant"):
+            bot_text = st.write_stream(stream_response(user_input, metadata))
+        bot_msg = MsgEntry(id=str(uuid.uuid4()), role="assistant", text=bot_text or "", documents=metadata.get("documents", []))
+        st.session_state.history.append(bot_msg)
+    else:
+        # Fetch and display the bot's response
+        bot_text, documents, log_id = get_response(user_input)
+        bot_msg = MsgEntry(id=str(uuid.uuid4()), role="assistant", text=bot_text, documents=documents, log_id=log_id)
+        render_message(bot_msg, save=True)